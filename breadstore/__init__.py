@@ -1,23 +1,43 @@
 """Web API for breadStore."""
 
+# Standard modules
+import functools
+import os
+import tempfile
+
 # Third-party modules
 from pyramid import authentication
 from pyramid import authorization
-from pyramid import renderers
 from pyramid.config import Configurator
-import simplejson
+from pyramid.settings import asbool
 import sqlalchemy
 import sqlalchemy.orm
 import zope.sqlalchemy
 
 # Application modules
+from . import cache
+from . import entities
+from . import models
+from . import passwords
+from . import photos
+from . import picklist
+from . import planning
+from . import profiling
+from . import renderers
+from . import reporting
 from . import resources
+from . import routing
+from . import search
 from . import security
+from . import statuses
+from . import util
+from . import versions
 
 
 def request_scoped_session(request):
-  """Returns a database session."""
-  session = request.registry.dbmaker()
+  """Returns a database session, reading from a replica where possible."""
+  session = request.registry.replica_router.session(
+      request.registry.dbmaker, request)
 
   def close(_request):
     session.close()
@@ -29,8 +49,18 @@ def request_scoped_session(request):
 def main(global_config, **settings):
   """ This function returns a Pyramid WSGI application."""
   config = Configurator(settings=settings)
-  config.add_renderer(None, renderers.JSON(serializer=simplejson.dumps))
+  debug_lazy_loads = asbool(settings.get('breadstore.debug_lazy_loads', False))
+  compress_threshold = settings.get('breadstore.compress_threshold', 1400)
+  config.add_renderer(None, renderers.StreamingJSON(
+      serializer=renderers.json_serializer(
+          settings.get('breadstore.json_serializer', 'auto')),
+      chunk_size=int(settings.get('breadstore.stream_chunk_size', 65536)),
+      forbid_queries=debug_lazy_loads,
+      compress_threshold=(
+          None if compress_threshold == 'off' else int(compress_threshold)),
+      compress_level=int(settings.get('breadstore.compress_level', 6))))
   config.add_request_method(request_scoped_session, 'db', reify=True)
+  config.add_request_method(security.get_user, 'user', reify=True)
   config.set_authentication_policy(
       authentication.AuthTktAuthenticationPolicy(
           config.registry.settings['authentication_secret'],
@@ -44,8 +74,60 @@ def main(global_config, **settings):
   config.set_authorization_policy(authorization.ACLAuthorizationPolicy())
   config.set_root_factory(resources.Root)
 
+  engine = sqlalchemy.engine_from_config(settings)
+  if debug_lazy_loads:
+    models.guard_lazy_loads(engine)
   config.registry.dbmaker = sqlalchemy.orm.sessionmaker(
-      bind=sqlalchemy.engine_from_config(settings),
+      bind=engine,
+      class_=routing.RoutingSession,
       extension=zope.sqlalchemy.ZopeTransactionExtension())
-  config.scan()
+  config.registry.replica_router = routing.ReplicaRouter(
+      replicas=routing.replica_engines(settings),
+      sticky_seconds=int(settings.get('breadstore.replica_sticky_seconds', 10)))
+  config.registry.customer_codes = util.CustomerCodeAllocator(
+      functools.partial(models.reserve_customer_codes, engine),
+      block_size=int(settings.get('breadstore.customer_code_block', 1000)))
+  config.registry.password_pool = passwords.PasswordPool(
+      processes=int(settings.get('breadstore.password_pool.processes', 2)),
+      queue_limit=int(settings.get('breadstore.password_pool.queue_limit', 16)),
+      timeout=int(settings.get('breadstore.password_pool.timeout', 30)))
+  config.registry.principal_cache = security.PrincipalCache(
+      size=int(settings.get('breadstore.principal_cache.size', 1024)),
+      ttl=int(settings.get('breadstore.principal_cache.ttl', 300)),
+      shared=asbool(settings.get('breadstore.principal_cache.shared', False)),
+      check_interval=int(
+          settings.get('breadstore.principal_cache.check_interval', 5)))
+  config.registry.principal_cache.watch(config.registry.dbmaker)
+  models.reference_data.check_interval = int(
+      settings.get('breadstore.reference_data.check_interval', 60))
+  models.reference_data.watch(config.registry.dbmaker)
+  statuses.watch(config.registry.dbmaker)
+  planning.watch(config.registry.dbmaker)
+  picklist.watch(config.registry.dbmaker)
+  versions.watch(config.registry.dbmaker)
+  reporting.watch(config.registry.dbmaker)
+  config.registry.entity_cache = entities.EntityCache()
+  if asbool(settings.get('breadstore.entity_cache', False)):
+    backend_factory = config.maybe_dotted(settings.get(
+        'breadstore.entity_cache.backend', 'breadstore.cache.LRUCache'))
+    config.registry.entity_cache.backend = backend_factory(
+        size=int(settings.get('breadstore.entity_cache.size', 10000)),
+        ttl=int(settings.get('breadstore.entity_cache.ttl', 60)))
+  config.registry.entity_cache.watch(config.registry.dbmaker)
+  config.registry.thumbnails = photos.ThumbnailCache(
+      settings.get('breadstore.thumbnail_dir', os.path.join(
+          tempfile.gettempdir(), 'breadstore-thumbnails')),
+      size=int(settings.get('breadstore.thumbnail_cache_size', 1000)))
+  config.registry.customer_index = search.CustomerIndex(
+      refresh_interval=int(
+          settings.get('breadstore.search.refresh_interval', 60)),
+      rebuild_interval=int(
+          settings.get('breadstore.search.rebuild_interval', 900)))
+  config.registry.customer_index.watch(config.registry.dbmaker)
+  config.registry.listing_totals = cache.LRUCache(
+      size=256, ttl=int(settings.get('breadstore.listing_total_ttl', 60)))
+  if asbool(settings.get('breadstore.profiling', False)):
+    profiling.setup(config, repeat_threshold=int(
+        settings.get('breadstore.profiling.repeat_threshold', 5)))
+  config.scan('.views')
   return config.make_wsgi_app()
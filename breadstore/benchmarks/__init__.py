@@ -0,0 +1,62 @@
+"""breadStore benchmarks, run in-process against a seeded database.
+
+The cases in `cases` drive the WSGI application over its hot paths. Results
+are plain JSON, so that runs can be compared with an earlier baseline.
+"""
+
+# Standard modules
+import datetime
+import platform
+import time
+
+
+def measure(func, repeat=50, warmup=5):
+  """Runs the function repeatedly, and returns its timings in milliseconds.
+
+  The first `warmup` runs fill caches and connection pools and are not timed.
+  """
+  for _run in xrange(warmup):
+    func()
+  timings = []
+  for _run in xrange(repeat):
+    start = time.time()
+    func()
+    timings.append((time.time() - start) * 1000)
+  timings.sort()
+  return {
+      'repeat': repeat,
+      'min_ms': round(timings[0], 3),
+      'median_ms': round(timings[len(timings) // 2], 3),
+      'mean_ms': round(sum(timings) / len(timings), 3),
+      'p95_ms': round(timings[int(len(timings) * 0.95) - 1], 3)}
+
+
+def run(cases, harness, repeat=50, warmup=5):
+  """Measures the named cases, and returns the results of the run."""
+  results = {}
+  for name, case in cases:
+    results[name] = measure(
+        lambda: case(harness), repeat=repeat, warmup=warmup)
+  return {
+      'created': datetime.datetime.now().isoformat(),
+      'python': platform.python_version(),
+      'database': harness.engine.dialect.name,
+      'cases': results}
+
+
+def compare(results, baseline, threshold=0.2):
+  """Returns the cases whose median is more than `threshold` slower.
+
+  Each regression is a tuple of the case name, the baseline and current
+  median, and their ratio. Cases missing from either run are skipped.
+  """
+  regressions = []
+  for name, current in sorted(results['cases'].iteritems()):
+    previous = baseline['cases'].get(name)
+    if previous is None or not previous['median_ms']:
+      continue
+    ratio = current['median_ms'] / previous['median_ms']
+    if ratio > 1 + threshold:
+      regressions.append(
+          (name, previous['median_ms'], current['median_ms'], ratio))
+  return regressions
@@ -0,0 +1,147 @@
+"""breadStore benchmark cases, covering the hot paths of the API."""
+
+# Standard modules
+import json
+import random
+
+# Third-party modules
+from pyramid import scripting
+from webob import Request
+
+# Application modules
+import breadstore
+from .. import models
+from .. import renderers
+from .. import security
+
+CASES = []
+
+
+def case(func):
+  """Registers the function as a benchmark case, under its name."""
+  CASES.append((func.__name__, func))
+  return func
+
+
+class BenchmarkError(Exception):
+  """Raised when a request of a benchmark case fails."""
+
+
+class Harness(object):
+  """Drives the breadStore WSGI application in-process.
+
+  The application is created with `breadstore.main` from the given settings,
+  and requests are made as the staff member with the given login. Customers
+  and subscriptions to request are drawn from a fixed sample, with a seeded
+  random generator so that runs are comparable. The first 100 subscriptions of
+  the sample are also kept fully loaded, for the serialization case.
+  """
+  def __init__(self, settings, login, password, seed=1, sample_size=1000):
+    self.settings = settings
+    self.app = breadstore.main({}, **settings)
+    self.registry = self.app.registry
+    self.engine = self.registry.dbmaker.kw['bind']
+    self.login = login
+    self.password = password
+    self.random = random.Random(seed)
+    self.cookie = self.log_in()
+    session = self.registry.dbmaker()
+    try:
+      self.user_id = session.query(models.Medewerker.id).filter(
+          models.Medewerker.login == login).scalar()
+      self.customer_ids = [row.klant_id for row in session.query(
+          models.Abonnement.klant_id).distinct().limit(sample_size)]
+      self.subscription_ids = [row.id for row in session.query(
+          models.Abonnement.id).limit(sample_size)]
+      self.subscriptions = session.query(models.Abonnement).filter(
+          models.Abonnement.id.in_(self.subscription_ids[:100])).all()
+    finally:
+      session.close()
+    if not self.customer_ids:
+      raise BenchmarkError('The database has no customers with subscriptions.')
+
+  def log_in(self):
+    """Logs in, and returns the authentication cookie."""
+    response = self.request(
+        'POST', '/session', {'login': self.login, 'password': self.password},
+        status=303, authenticated=False)
+    return '; '.join(
+        cookie.split(';')[0] for cookie in response.headers.getall('Set-Cookie')
+        if cookie.startswith('bs_auth='))
+
+  def request(self, method, path, body=None, status=200, authenticated=True):
+    """Makes a request to the application, and returns the full response."""
+    request = Request.blank(path, method=method)
+    if body is not None:
+      request.body = json.dumps(body)
+      request.content_type = 'application/json'
+    if authenticated:
+      request.headers['Cookie'] = self.cookie
+    response = request.get_response(self.app)
+    response.body  # Consumes streamed responses
+    if response.status_int != status:
+      raise BenchmarkError('%s %s: %s' % (method, path, response.status))
+    return response
+
+  def scripted(self, func):
+    """Calls the function with a prepared request, closing its session."""
+    env = scripting.prepare(registry=self.registry)
+    try:
+      return func(env['request'])
+    finally:
+      env['closer']()
+
+
+@case
+def customer_listing(harness):
+  harness.request('GET', '/klanten?limit=100')
+
+
+@case
+def customer_listing_by_name(harness):
+  harness.request('GET', '/klanten?limit=100&sort=achternaam&totaal=true')
+
+
+@case
+def customer(harness):
+  harness.request(
+      'GET', '/klanten/%d' % harness.random.choice(harness.customer_ids))
+
+
+@case
+def subscription_listing(harness):
+  harness.request('GET', '/klanten/%d/abonnementen' % harness.random.choice(
+      harness.customer_ids))
+
+
+@case
+def subscription(harness):
+  harness.request('GET', '/abonnementen/%d' % harness.random.choice(
+      harness.subscription_ids))
+
+
+@case
+def login(harness):
+  harness.log_in()
+
+
+@case
+def group_finder(harness):
+  harness.scripted(
+      lambda request: security.group_finder(harness.user_id, request))
+
+
+@case
+def load_principals(harness):
+  harness.scripted(
+      lambda request: security.load_principals(harness.user_id, request.db))
+
+
+@case
+def serialization(harness):
+  """Serializes 100 loaded subscriptions with the configured serializer."""
+  serializer = renderers.json_serializer(
+      harness.settings.get('breadstore.json_serializer', 'auto'))
+  serializer(
+      {'abonnementen': harness.subscriptions},
+      default=lambda obj: obj.__json__())
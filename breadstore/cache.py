@@ -0,0 +1,54 @@
+"""breadStore in-process caching utilities."""
+
+# Standard modules
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+  """Thread-safe mapping with a bounded size and a per-entry time to live.
+
+  Entries that have not been used for the longest time are evicted once the
+  cache grows beyond `size`. Entries older than `ttl` seconds are treated as
+  absent. A `ttl` of None disables expiration.
+  """
+  def __init__(self, size=1024, ttl=None):
+    self.size = size
+    self.ttl = ttl
+    self._entries = collections.OrderedDict()
+    self._lock = threading.Lock()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def get(self, key, default=None):
+    """Returns the cached value for the key, or the default if not present."""
+    with self._lock:
+      try:
+        expires, value = self._entries.pop(key)
+      except KeyError:
+        return default
+      if expires is not None and expires < time.time():
+        return default
+      self._entries[key] = expires, value
+      return value
+
+  def set(self, key, value):
+    """Stores a value under the given key, evicting the oldest if required."""
+    expires = None if self.ttl is None else time.time() + self.ttl
+    with self._lock:
+      self._entries.pop(key, None)
+      self._entries[key] = expires, value
+      while len(self._entries) > self.size:
+        self._entries.popitem(last=False)
+
+  def delete(self, key):
+    """Removes the key from the cache, if it is present."""
+    with self._lock:
+      self._entries.pop(key, None)
+
+  def clear(self):
+    """Removes all entries from the cache."""
+    with self._lock:
+      self._entries.clear()
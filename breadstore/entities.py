@@ -0,0 +1,186 @@
+"""breadStore cross-request cache of frequently used entities.
+
+Customers, subscriptions and staff members are cached by primary key, as the
+values of their columns. Relationships are not cached; they load from the
+session when used, as they would for any other instance. Neither are the
+columns in UNCACHED_COLUMNS, which load when first used.
+"""
+
+# Standard modules
+import itertools
+import time
+
+# Third-party modules
+import sqlalchemy
+from sqlalchemy import orm
+
+# Application modules
+from . import models
+from . import versions
+
+CACHED = models.Klant, models.Abonnement, models.Medewerker
+UNCACHED_COLUMNS = {models.Medewerker: frozenset(['wachtwoord'])}
+BEGIN_KEY = 'entities.begin'
+INVALIDATED = '_invalidated'
+
+
+def cache_key(table_name, ident):
+  """Returns the key of an entity in the cache backend."""
+  return '%s:%s' % (table_name, ident)
+
+
+class EntityCache(object):
+  """Cache of entity column values, shared by the requests of a process.
+
+  The `backend` needs the `get`, `set` and `delete` methods of
+  `cache.LRUCache`, which is the per-process default. Only plain column values
+  are stored, so a backend shared between processes can pickle them. Without
+  a backend, every lookup goes to the database.
+
+  Entities changed in a flush, or through `versions`, are invalidated when the
+  transaction that changed them ends. On commit, session transactions
+  invalidate them once more after the database has committed, removing values
+  that concurrent requests loaded in between. On rollback, this removes any
+  uncommitted values stored by the transaction itself.
+
+  Invalidation replaces the values by a marker holding the time it happened.
+  A transaction that began before then may read from a snapshot older than
+  the invalidating commit (as under REPEATABLE READ), so it does not store the
+  entity. As the markers are kept in the backend, this also holds for entities
+  invalidated by other processes sharing it, provided their clocks agree.
+  Entities changed by the transaction itself, or read from a replica, are not
+  stored either.
+  """
+  def __init__(self, backend=None):
+    self.backend = backend
+
+  def get(self, session, cls, ident):
+    """Returns the entity with the given primary key, or None.
+
+    On a cache hit, the entity is added to the session without a query.
+    """
+    values = self.cached(cls.__tablename__, ident)
+    if values is not None:
+      return self.restore(session, cls, values)
+    return self.load(session, cls, ident)
+
+  def load(self, session, cls, ident):
+    """Loads the entity from the database, and caches it."""
+    obj = session.query(cls).get(ident)
+    if obj is not None:
+      self.store(session, obj)
+    return obj
+
+  def version(self, session, cls, ident):
+    """Returns the version of an entity, from the cache where possible."""
+    values = self.cached(cls.__tablename__, ident)
+    if values is not None:
+      return values['versie']
+    return versions.current(session, cls, ident)
+
+  def cached(self, table_name, ident):
+    """Returns the cached column values of an entity, or None."""
+    if self.backend is None:
+      return None
+    values = self.backend.get(cache_key(table_name, ident))
+    if values is None or INVALIDATED in values:
+      return None
+    return values
+
+  def store(self, session, obj):
+    """Stores the column values of an entity loaded by the session.
+
+    Nothing is stored if the entity was invalidated after the session's
+    transaction began, or was changed by that transaction.
+    """
+    began = session.info.get(BEGIN_KEY)
+    if (self.backend is None or began is None or
+        getattr(session, 'replica', None) is not None):
+      return
+    state = sqlalchemy.inspect(obj)
+    table_name = state.mapper.base_mapper.local_table.name
+    ident = state.identity[0]
+    if (table_name, ident) in session.info.get(versions.CHANGED_KEY, ()):
+      return
+    columns = set(state.mapper.column_attrs.keys()).difference(
+        UNCACHED_COLUMNS.get(state.mapper.class_, ()))
+    if state.unloaded.intersection(columns):
+      return
+    key = cache_key(table_name, ident)
+    current = self.backend.get(key)
+    if current is not None and current.get(INVALIDATED, 0) >= began:
+      return
+    self.backend.set(key, dict((column, state.dict[column])
+                               for column in columns))
+
+  def restore(self, session, cls, values):
+    """Returns the cached entity as a persistent instance of the session.
+
+    Columns that are not cached are expired, to load when first used.
+    """
+    obj = cls.__mapper__.class_manager.new_instance()
+    for key, value in values.iteritems():
+      orm.attributes.set_committed_value(obj, key, value)
+    orm.make_transient_to_detached(obj)
+    obj = session.merge(obj, load=False)
+    uncached = UNCACHED_COLUMNS.get(cls)
+    if uncached:
+      state = sqlalchemy.inspect(obj)
+      unloaded = uncached.intersection(state.unloaded)
+      if unloaded:
+        session.expire(obj, unloaded)
+    return obj
+
+  def invalidate(self, keys):
+    """Replaces the entities with the given cache keys by a marker."""
+    marker = {INVALIDATED: time.time()}
+    for key in keys:
+      self.backend.set(key, marker)
+
+  def watch(self, session_factory):
+    """Invalidates entities changed through the factory's engine."""
+    if self.backend is None:
+      return
+    engine = session_factory.kw['bind']
+    sqlalchemy.event.listen(session_factory, 'after_flush', self._after_flush)
+    sqlalchemy.event.listen(session_factory, 'after_begin', self._after_begin)
+    sqlalchemy.event.listen(
+        session_factory, 'after_commit', self._after_commit)
+    sqlalchemy.event.listen(
+        session_factory, 'after_rollback', self._after_rollback)
+    sqlalchemy.event.listen(engine, 'begin', self._begin)
+    sqlalchemy.event.listen(engine, 'commit', self._end)
+    sqlalchemy.event.listen(engine, 'rollback', self._end)
+
+  def _after_flush(self, session, _flush_context):
+    for cls in CACHED:
+      idents = [
+          sqlalchemy.inspect(obj).identity[0]
+          for obj in itertools.chain(session.dirty, session.deleted)
+          if isinstance(obj, cls)]
+      if idents:
+        versions.mark_changed(session.connection(), cls, idents)
+
+  def _after_begin(self, session, _transaction, connection):
+    session.info[BEGIN_KEY] = time.time()
+    changed = connection.info.get(versions.CHANGED_KEY)
+    if changed is not None:
+      session.info[versions.CHANGED_KEY] = changed
+
+  def _after_commit(self, session):
+    session.info.pop(BEGIN_KEY, None)
+    changed = session.info.pop(versions.CHANGED_KEY, None)
+    if changed:
+      self.invalidate(cache_key(*key) for key in changed)
+
+  def _after_rollback(self, session):
+    session.info.pop(BEGIN_KEY, None)
+    session.info.pop(versions.CHANGED_KEY, None)
+
+  def _begin(self, connection):
+    connection.info[versions.CHANGED_KEY] = set()
+
+  def _end(self, connection):
+    changed = connection.info.pop(versions.CHANGED_KEY, None)
+    if changed:
+      self.invalidate(cache_key(*key) for key in changed)
@@ -1,26 +1,37 @@
 """breadStore model definitions."""
 
 # Standard modyles
+import bisect
+import collections
+import contextlib
 import datetime
 import hashlib
+import itertools
 import pytz
 import re
+import threading
+import time
 
 # Third-party modules
-import bcrypt
 import sqlalchemy
 from sqlalchemy import (
     Boolean, Date, Enum, Integer, SmallInteger, String, Text, Unicode)
 from sqlalchemy.dialects import mysql as types
+from sqlalchemy.ext import compiler
 from sqlalchemy.ext import declarative
+from sqlalchemy.ext import hybrid
 from sqlalchemy import orm
 
 # Application modules
+from . import passwords
 from . import util
 
 # ##############################################################################
 # Declarative base for SQLAlchemy and ORM to JSON conversion
 #
+IGNORED_PREFIXES = '__', '_sa_'
+
+
 def declarative_base(cls):
   """Decorator for SQLAlchemy's declarative base."""
   return declarative.declarative_base(cls=cls)
@@ -29,11 +40,18 @@ def declarative_base(cls):
 @declarative_base
 class Base(object):
   """Extended SQLAlchemy declarative base class."""
+  _json_serializer = None
+
   @declarative.declared_attr
   def __tablename__(cls):
     underscorer = lambda match: '_{}'.format(match.group(0).lower())
     return re.sub(r'[A-Z]', underscorer, cls.__name__).strip('_')
 
+  @classmethod
+  def __declare_last__(cls):
+    """Compiles the JSON serializer once the class' mapper is configured."""
+    cls._json_serializer = JsonSerializer(orm.class_mapper(cls))
+
   def __json__(self, request=None):
     """Converts all the properties of the object into a dict for use in JSON.
 
@@ -49,47 +67,157 @@ class Base(object):
         list of relations which need to be eagerly loaded. This applies to
         one-to-one and one-to-many relationships defined in SQLAlchemy classes.
     """
-    prefixes_to_ignore = '__', '_sa_'
+    if self._json_serializer is None:
+      orm.configure_mappers()
+    return self._json_serializer(self, request)
+
+
+class JsonSerializer(object):
+  """ORM to JSON converter, compiled for a single mapped class.
+
+  The blacklists, camelCase key names and value converters for all mapped
+  attributes are determined once, when the class' mapper is configured. Only
+  attributes that are loaded on the instance (or marked for eager loading) are
+  included in the output, as they always have been.
+  """
+  def __init__(self, mapper):
+    cls = mapper.class_
+    self.blacklist = set(getattr(cls, '_base_blacklist', []))
+    self.blacklist.update(getattr(cls, '_json_blacklist', []))
+    self.eager_load = set(getattr(cls, '_json_eager_load', []))
+    self.fields = {}
+    for prop in mapper.iterate_properties:
+      if prop.key in self.blacklist or prop.key.startswith(IGNORED_PREFIXES):
+        continue
+      self.fields[prop.key] = (
+          util.case_transform_json(prop.key), json_converter(prop))
+
+  def __call__(self, obj, request=None):
+    state = vars(obj)
+    for attr in self.eager_load:
+      getattr(obj, attr, None)
+    fields = self.fields
     json_result = {}
+    for key in set(state) | self.eager_load:
+      try:
+        field = fields[key]
+      except KeyError:
+        field = fields[key] = self.unmapped_field(key)
+      if field is not None:
+        value = state[key] if key in state else getattr(obj, key)
+        json_result[field[0]] = field[1](value, request)
+    return json_result
 
-    # Set up the blacklist from its various sources
-    blacklist = set(getattr(self, '_base_blacklist', []))
-    blacklist.update(getattr(self, '_json_blacklist', []))
-
-    # Request all attributes marked for eager loading
-    json_eager_load = set(getattr(self, '_json_eager_load', []))
-    for attr in json_eager_load:
-      getattr(self, attr, None)
+  def unmapped_field(self, key):
+    """Returns the JSON key and converter for a non-mapped attribute.
 
-    # Make a copy of keys and add properties to include in the output
-    for key in set(vars(self)) | json_eager_load:
-      # skip blacklisted, private and SQLAlchemy properties
-      if key in blacklist or key.startswith(prefixes_to_ignore):
-        continue
-      attr = getattr(self, key)
-
-      if isinstance(attr, datetime.date):
-        attr = attr.isoformat()
-      elif isinstance(attr, (datetime.datetime, datetime.time)):
-        attr = pytz.utc.localize(attr).isoformat()
-      else:
-        if isinstance(attr, Base):
-          # Non-list relationship, recursively convert to JSON
-          attr = attr.__json__(request)
-        elif isinstance(attr, orm.collections.InstrumentedList):
-          # List of related objects, iterate and convert all to JSON
-          attr = [x.__json__(request) for x in attr]
-        else:
-          # convert all non float or integer objects to string or if string
-          # conversion is not possible, convert it to Unicode
-          if attr and not isinstance(attr, (int, float)):
-            try:
-              attr = str(attr)
-            except UnicodeEncodeError:
-              attr = unicode(attr)  # .encode('utf-8')
-      # Change naming convention on the key to match JSON norms and store attr
-      json_result[util.case_transform_json(key)] = attr
-    return json_result
+    Returns None for blacklisted, private and SQLAlchemy internal attributes.
+    """
+    if key in self.blacklist or key.startswith(IGNORED_PREFIXES):
+      return None
+    return util.case_transform_json(key), json_value
+
+
+def json_converter(prop):
+  """Returns the JSON value converter for the given mapper property."""
+  if isinstance(prop, orm.RelationshipProperty):
+    return json_related_list if prop.uselist else json_related
+  if isinstance(prop, orm.ColumnProperty) and len(prop.columns) == 1:
+    sql_type = prop.columns[0].type
+    if isinstance(sql_type, (sqlalchemy.Date, sqlalchemy.DateTime)):
+      return json_date
+    elif isinstance(sql_type, Boolean):
+      return json_passthrough(bool)
+    elif isinstance(sql_type, Integer):
+      return json_passthrough(int)
+    elif isinstance(sql_type, sqlalchemy.Float):
+      return json_passthrough(float)
+    elif isinstance(sql_type, String):
+      return json_passthrough(str, unicode)
+  return json_value
+
+
+def json_date(value, request=None):
+  """Converts values of date and datetime columns to their ISO format."""
+  if isinstance(value, datetime.date):
+    return value.isoformat()
+  return json_value(value, request)
+
+
+def json_passthrough(*classes):
+  """Returns a converter that leaves None and values of `classes` unchanged.
+
+  Values of any other type (such as longs from the database driver) are handed
+  off to the generic converter.
+  """
+  def converter(value, request=None):
+    if value is None or value.__class__ in classes:
+      return value
+    return json_value(value, request)
+  return converter
+
+
+def json_related(value, request=None):
+  """Converts a non-list relationship using the related class' serializer."""
+  if value is None:
+    return None
+  return value.__json__(request)
+
+
+def json_related_list(value, request=None):
+  """Converts all objects of a list relationship to JSON."""
+  return [item.__json__(request) for item in value]
+
+
+def json_value(attr, request=None):
+  """Converts a value of unknown type to its JSON representation."""
+  if isinstance(attr, datetime.date):
+    return attr.isoformat()
+  elif isinstance(attr, (datetime.datetime, datetime.time)):
+    return pytz.utc.localize(attr).isoformat()
+  elif isinstance(attr, Base):
+    # Non-list relationship, recursively convert to JSON
+    return attr.__json__(request)
+  elif isinstance(attr, orm.collections.InstrumentedList):
+    # List of related objects, iterate and convert all to JSON
+    return [x.__json__(request) for x in attr]
+  # convert all non float or integer objects to string or if string
+  # conversion is not possible, convert it to Unicode
+  if attr and not isinstance(attr, (int, float)):
+    try:
+      return str(attr)
+    except UnicodeEncodeError:
+      return unicode(attr)  # .encode('utf-8')
+  return attr
+
+
+class LazyLoadError(Exception):
+  """Raised when a query is issued during serialization in debug mode."""
+
+
+_serializing = threading.local()
+
+
+@contextlib.contextmanager
+def forbid_queries():
+  """Marks the current thread as serializing, see `guard_lazy_loads`."""
+  _serializing.active = True
+  try:
+    yield
+  finally:
+    _serializing.active = False
+
+
+def guard_lazy_loads(engine):
+  """Makes the engine raise LazyLoadError for queries during serialization.
+
+  This is a debugging aid to catch serialization that triggers lazy loading of
+  relationships that the originating query did not load.
+  """
+  def check_query(_conn, _cursor, statement, *_args):
+    if getattr(_serializing, 'active', False):
+      raise LazyLoadError('Query during serialization: %s' % statement)
+  sqlalchemy.event.listen(engine, 'before_cursor_execute', check_query)
 
 
 # ##############################################################################
@@ -111,6 +239,35 @@ def StrictForeignKey(field, **kwds):
   return ForeignKey(field, **kwds)
 
 
+def UpdateTimestamp(**kwds):
+  """Returns a timestamp column holding the time its row last changed.
+
+  MySQL moves it forward on every update of the row (ON UPDATE). On other
+  databases, updates issued through SQLAlchemy set it instead.
+  """
+  kwds.setdefault('server_default', UpdateTimestampDefault())
+  kwds.setdefault('onupdate', sqlalchemy.func.current_timestamp())
+  return Column(types.TIMESTAMP, **kwds)
+
+
+class UpdateTimestampDefault(sqlalchemy.sql.expression.ClauseElement):
+  """Server default of `UpdateTimestamp` columns, compiled per dialect."""
+
+
+@compiler.compiles(UpdateTimestampDefault)
+def _compile_update_timestamp(_element, _compiler, **_kwds):
+  return 'CURRENT_TIMESTAMP'
+
+
+@compiler.compiles(UpdateTimestampDefault, 'mysql')
+def _compile_update_timestamp_mysql(_element, _compiler, **_kwds):
+  return 'CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'
+
+
+# SQLite only generates values for primary keys of type INTEGER
+SmallIntegerKey = SmallInteger().with_variant(Integer, 'sqlite')
+
+
 # ##############################################################################
 # The actual breadStore model definition
 #
@@ -123,6 +280,7 @@ class Abonnement(Base):
   datum_einde = Column(Date, nullable=True, index=True)
   pakket_aantal = Column(SmallInteger)
   opmerking = Column(Unicode(200))
+  versie = Column(Integer, server_default='1')
 
   # Relationships
   klant = orm.relationship('Klant')
@@ -135,14 +293,34 @@ class Abonnement(Base):
   # JSON blacklist
   _base_blacklist = 'klant',
 
-  @property
+  @hybrid.hybrid_property
   def completed(self):
     """Returns whether or not the subscription has been completed.
 
     A subscription is considered complete when the provided package count is
     equal to the package count planned for it.
     """
-    return self.pakket_aantal == len(self.packages_provided())
+    return self.pakket_aantal == self.provided_count
+
+  @hybrid.hybrid_property
+  def provided_count(self):
+    """Returns the number of packages that have been handed out.
+
+    This is counted from the packages if those are already loaded, and with a
+    single COUNT query otherwise. On the class, this is a correlated subquery
+    for use in filters and listings.
+    """
+    session = sqlalchemy.inspect(self).session
+    if 'pakketten' in vars(self) or session is None or self.id is None:
+      return len(self.packages_provided())
+    return session.query(sqlalchemy.func.count(Pakket.id)).filter(
+        Pakket.abonnement_id == self.id, Pakket.completed).scalar()
+
+  @provided_count.expression
+  def provided_count(cls):
+    return sqlalchemy.select([sqlalchemy.func.count(Pakket.id)]).where(
+        sqlalchemy.and_(Pakket.abonnement_id == cls.id, Pakket.completed)
+    ).label('provided_count')
 
   def packages_provided(self):
     """Returnst a list of packages that have been handed out to customers.
@@ -159,8 +337,13 @@ t_abonnement_dieet = sqlalchemy.Table(
     Column('dieet_id', ForeignKey('dieet.id'), primary_key=True))
 
 
+class CacheVersie(Base):
+  naam = Column(String(32), primary_key=True)
+  versie = Column(Integer, server_default='0')
+
+
 class Contactpersoon(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   klant_id = Column(ForeignKey('klant.id'))
   rol = Column(Unicode(32), server_default='')
   naam = Column(Unicode(64))
@@ -174,19 +357,20 @@ class Contactpersoon(Base):
 
 
 class Datumwijziging(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   planning = Column(Date, unique=True)
   aanpassing = Column(Date)
 
 
 class Dieet(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   naam = Column(Unicode(45))
   sticker_kleur = Column(String(16))
 
 
 class Gezinslid(Base):
-  __table_args__ = sqlalchemy.Index('klant', 'klant_id', 'naam', unique=True),
+  __table_args__ = sqlalchemy.Index(
+      'klant_naam', 'klant_id', 'naam', unique=True),
 
   id = Column(Integer, primary_key=True)
   klant_id = Column(ForeignKey('klant.id'))
@@ -203,13 +387,14 @@ class Klant(Base):
   klantcode = Column(types.CHAR(8), unique=True)
   voorletters = Column(Unicode(16), server_default='')
   tussenvoegsel = Column(Unicode(16), server_default='')
-  achternaam = Column(Unicode(32))
+  achternaam = Column(Unicode(32), index=True)
   geslacht = Column(Enum('onbekend', 'man', 'vrouw'))
   geboorte_datum = Column(Date, nullable=True)
   email_adres = Column(String(64), nullable=True)
   adres_straat = Column(Unicode(64))
-  adres_postcode = Column(types.CHAR(6))
-  adres_plaats = Column(Unicode(32))
+  adres_postcode = Column(types.CHAR(6), index=True)
+  adres_plaats = Column(Unicode(32), index=True)
+  versie = Column(Integer, server_default='1')
 
   # Relationships
   abonnementen = orm.relationship(
@@ -226,21 +411,46 @@ class Klant(Base):
     return self.abonnementen[-1]
 
   def package_size(self):
-    """Returns the appropriate package size for the current family size."""
+    """Returns the appropriate package size for the current family size.
+
+    The size is looked up in the reference data cache, and only its row loaded.
+    """
     session = sqlalchemy.inspect(self).session
     family_size = len(self.gezin) + 1  # Family members + self
-    required_size = PakketGrootte.min_gezinsgrootte
-    return session.query(PakketGrootte).\
-        filter(family_size >= required_size).\
-        order_by(required_size.desc()).first()
+    size = reference_data.get(session).package_size(family_size)
+    if size is not None:
+      return session.query(PakketGrootte).get(size.id)
+
+
+class KlantcodeReeks(Base):
+  id = Column(SmallIntegerKey, primary_key=True)
+  volgende = Column(sqlalchemy.BigInteger)
 
 
 class KlantFoto(Klant):
   klant_id = Column(ForeignKey('klant.id'), primary_key=True)
-  foto = Column(types.MEDIUMBLOB)
+  foto = orm.deferred(Column(
+      sqlalchemy.LargeBinary().with_variant(types.MEDIUMBLOB, 'mysql')))
+  foto_type = Column(String(32), server_default='image/jpeg')
+  foto_grootte = Column(Integer, server_default='0')
+  foto_etag = Column(types.CHAR(40), server_default='')
+  foto_gewijzigd = UpdateTimestamp()
+
+  # JSON blacklist
+  _json_blacklist = 'foto',
+
+  def set_photo(self, data, content_type='image/jpeg'):
+    """Stores the photo along with the metadata used to serve it."""
+    self.foto = data
+    self.foto_type = content_type
+    self.foto_grootte = len(data)
+    self.foto_etag = hashlib.sha1(data).hexdigest()
 
 
 class KlantStatus(Base):
+  __table_args__ = sqlalchemy.Index(
+      'klant_status_update_tijd', 'update_tijd'),
+
   id = Column(Integer, primary_key=True)
   klant_id = Column(ForeignKey('klant.id'))
   status = Column(Enum(
@@ -249,13 +459,27 @@ class KlantStatus(Base):
   opmerking = Column(Text, server_default='')
   wijzigingsdatum = Column(Date, nullable=True)
   medewerker_id = Column(ForeignKey('medewerker.id'))
-  update_tijd = Column(types.TIMESTAMP, server_default=sqlalchemy.text(
-      'CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP'))
+  update_tijd = UpdateTimestamp()
 
   klant = orm.relationship('Klant')
   medewerker = orm.relationship('Medewerker')
 
 
+class KlantHuidigeStatus(Base):
+  """The current (most recently recorded) status of every customer.
+
+  Maintained by the `statuses` module whenever customer statuses change.
+  """
+  __table_args__ = sqlalchemy.Index('status_klant', 'status', 'klant_id'),
+
+  klant_id = Column(ForeignKey('klant.id'), primary_key=True)
+  klant_status_id = Column(ForeignKey('klant_status.id'))
+  status = Column(Enum(
+      'nieuw', 'afgewezen', 'doorverwezen', 'klant',
+      'verhuisd', 'regulier beeindigd', 'weggestuurd'))
+  wijzigingsdatum = Column(Date, nullable=True)
+
+
 class KlantTelefoonnummer(Base):
   id = Column(Integer, primary_key=True)
   klant_id = Column(ForeignKey('klant.id'))
@@ -266,44 +490,53 @@ class KlantTelefoonnummer(Base):
 
 
 class Locatie(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   naam = Column(Unicode(45))
 
 
 class Medewerker(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   naam = Column(Unicode(32))
   email_adres = Column(String(64))
   rol_id = Column(StrictForeignKey('rol.id'))
   actief = Column(Boolean, server_default='1')
   login = Column(String(32))
   wachtwoord = Column(String(80))
+  wachtwoord_herzien = Column(Boolean, server_default='0')
 
   rol = orm.relationship('Rol')
 
-  def set_password(self, password, work_factor=10):
-    """(Re)sets the password for the user."""
-    salt = bcrypt.gensalt(work_factor)
-    self.wachtwoord = bcrypt.hashpw(password.encode('utf8'), salt)
-
-  def verify_password(self, password):
-    """Checks the provided password against the stored hash."""
-    password = password.encode('utf8')
-    if self.wachtwoord.startswith('$2a$'):
-      pw_hash = bcrypt.hashpw(password, self.wachtwoord)
-      return pw_hash == self.wachtwoord
-    salt = self.wachtwoord[:16].decode('hex')
-    result = ''
-    for _step in range(100):
-      result = hashlib.sha256(salt + result + password).digest()
-    if result == self.wachtwoord[16:].decode('hex'):
-      self.set_password(password)
-      return True
+  def set_password(self, password, work_factor=10, pool=None):
+    """(Re)sets the password for the user.
+
+    The hashing is done in the given PasswordPool, or on the calling thread if
+    no pool is provided.
+    """
+    hasher = pool or passwords
+    self.wachtwoord = hasher.hash_password(password.encode('utf8'), work_factor)
+    self.wachtwoord_herzien = False
+
+  def verify_password(self, password, pool=None):
+    """Checks the provided password against the stored hash.
+
+    A legacy hash is replaced by a bcrypt hash once verified, as part of the
+    same job in the given PasswordPool (or on the calling thread). This is
+    skipped for accounts flagged for a forced rehash, which only pay for the
+    legacy check until their user sets a new password.
+    """
+    checker = pool or passwords
+    valid, new_hash = checker.check_password(
+        password.encode('utf8'), self.wachtwoord,
+        rehash=not self.wachtwoord_herzien)
+    if new_hash is not None:
+      self.wachtwoord = new_hash
+      self.wachtwoord_herzien = False
+    return valid
 
 
 class Pakket(Base):
   __table_args__ = sqlalchemy.Index(
-      'abonnement', 'abonnement_id', 'volgnummer', unique=True),
+      'abonnement_volgnummer', 'abonnement_id', 'volgnummer', unique=True),
 
   id = Column(Integer, primary_key=True)
   abonnement_id = Column(ForeignKey('abonnement.id'))
@@ -315,7 +548,7 @@ class Pakket(Base):
   statussen = orm.relationship(
       'PakketStatus', innerjoin=True, lazy='joined', passive_deletes=True)
 
-  @property
+  @hybrid.hybrid_property
   def completed(self):
     """Returns whether or not a package has been completed.
 
@@ -325,15 +558,25 @@ class Pakket(Base):
     """
     return any(status.verwerkt for status in self.statussen)
 
+  @completed.expression
+  def completed(cls):
+    return sqlalchemy.exists().where(sqlalchemy.and_(
+        PakketStatus.pakket_id == cls.id, PakketStatus.verwerkt))
+
 
 class PakketGrootte(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   code = Column(types.CHAR(1))
   min_gezinsgrootte = Column(SmallInteger)
   omschrijving = Column(Unicode(45), server_default='')
 
 
 class PakketStatus(Base):
+  __table_args__ = (
+      sqlalchemy.Index('pakket_verwerkt', 'pakket_id', 'verwerkt'),
+      sqlalchemy.Index('ophaaldatum', 'ophaaldatum'),
+      sqlalchemy.Index('pakket_status_update_tijd', 'update_tijd'))
+
   id = Column(Integer, primary_key=True)
   pakket_id = Column(ForeignKey('pakket.id'))
   ophaaldatum = Column(Date)
@@ -341,21 +584,63 @@ class PakketStatus(Base):
   opgehaald = Column(Boolean, server_default='0')
   malus = Column(Boolean, server_default='0')
   medewerker_id = Column(ForeignKey('medewerker.id'))
-  update_tijd = Column(
-      types.TIMESTAMP, server_default=sqlalchemy.text('CURRENT_TIMESTAMP'))
+  update_tijd = UpdateTimestamp()
 
   medewerker = orm.relationship('Medewerker')
   pakket = orm.relationship('Pakket')
 
 
 class Permissie(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   naam = Column(String(32))
   omschrijving = Column(Text)
 
 
+class Picklijst(Base):
+  """Materialized pick list, the unprocessed packages due from today on.
+
+  Maintained by the `picklist` module, and read by location and pickup date.
+  """
+  __table_args__ = sqlalchemy.Index(
+      'locatie_datum', 'locatie_id', 'ophaaldatum'),
+
+  pakket_id = Column(ForeignKey('pakket.id'), primary_key=True)
+  abonnement_id = Column(ForeignKey('abonnement.id'), index=True)
+  klant_id = Column(ForeignKey('klant.id'), index=True)
+  locatie_id = Column(ForeignKey('locatie.id'))
+  ophaaldatum = Column(Date)
+  datum_einde = Column(Date, nullable=True)
+  volgnummer = Column(Integer)
+  klantcode = Column(types.CHAR(8))
+  naam = Column(Unicode(70))
+  pakket_grootte = Column(types.CHAR(1))
+  stickers = Column(String(100), server_default='')
+
+
+class RapportageKlant(Base):
+  """Reporting state per customer: the family size."""
+  klant_id = Column(ForeignKey('klant.id'), primary_key=True)
+  gezinsgrootte = Column(SmallInteger)
+
+
+class RapportagePakket(Base):
+  """Daily rollup of processed packages by location and package size."""
+  datum = Column(Date, primary_key=True)
+  locatie_id = Column(ForeignKey('locatie.id'), primary_key=True)
+  pakket_grootte_id = Column(ForeignKey('pakket_grootte.id'), primary_key=True)
+  uitgegeven = Column(Integer, server_default='0')
+  niet_opgehaald = Column(Integer, server_default='0')
+  malus = Column(Integer, server_default='0')
+
+
+class RapportageWatermerk(Base):
+  """Most recent `update_tijd` of a source table included in the rollups."""
+  naam = Column(String(32), primary_key=True)
+  update_tijd = Column(types.DATETIME)
+
+
 class Rol(Base):
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   naam = Column(String(32))
   omschrijving = Column(Unicode(200))
 
@@ -373,7 +658,7 @@ class UitgifteCyclus(Base):
   __table_args__ = sqlalchemy.Index(
       'uitgifte', 'ophaaldag', 'locatie_id', unique=True),
 
-  id = Column(SmallInteger, primary_key=True)
+  id = Column(SmallIntegerKey, primary_key=True)
   omschrijving = Column(Unicode(64))
   ophaaldag = Column(Integer)
   locatie_id = Column(ForeignKey('locatie.id'))
@@ -381,3 +666,161 @@ class UitgifteCyclus(Base):
   kleur = Column(types.CHAR(6))
 
   locatie = orm.relationship('Locatie')
+
+
+# ##############################################################################
+# Reference data cache for rarely changing lookup tables
+#
+class ReferenceSnapshot(object):
+  """Immutable, indexed copy of the reference tables at some point in time.
+
+  Rows are available as records (named tuples) by table name and primary key,
+  e.g. `snapshot.tables['dieet'][1]`.
+  """
+  def __init__(self, tables):
+    self.tables = tables
+    sizes = sorted(
+        tables['pakket_grootte'].values(),
+        key=lambda size: size.min_gezinsgrootte)
+    self._sizes = tuple(sizes)
+    self._size_bounds = tuple(size.min_gezinsgrootte for size in sizes)
+    self.date_changes = dict(
+        (change.planning, change.aanpassing)
+        for change in tables['datumwijziging'].values())
+
+  def package_size(self, family_size):
+    """Returns the largest package size suitable for the family size."""
+    index = bisect.bisect_right(self._size_bounds, family_size)
+    if index:
+      return self._sizes[index - 1]
+
+
+class ReferenceData(object):
+  """Per-process cache of the reference (lookup) tables.
+
+  The tables are loaded into an immutable ReferenceSnapshot on first use. Every
+  `check_interval` seconds a shared version counter in the database is checked,
+  and the snapshot reloaded when the counter has changed. Changes to reference
+  tables increment that counter when flushed, and drop the local snapshot once
+  they are committed. A transaction that changed them but did not commit also
+  drops the snapshot, which may have been loaded with its uncommitted changes.
+  """
+  VERSION_NAME = 'reference_data'
+
+  def __init__(self, check_interval=60):
+    self.check_interval = check_interval
+    self.classes = (
+        Datumwijziging, Dieet, Locatie, PakketGrootte, UitgifteCyclus)
+    self.record_types = dict(
+        (cls.__tablename__, record_type(cls)) for cls in self.classes)
+    self._lock = threading.Lock()
+    self._snapshot = None
+    self._version = None
+    self._checked = 0
+
+  def get(self, session):
+    """Returns the current snapshot, (re)loading it if necessary."""
+    if time.time() - self._checked > self.check_interval:
+      with self._lock:
+        if time.time() - self._checked > self.check_interval:
+          version = cache_version(session, self.VERSION_NAME)
+          if version != self._version:
+            self._snapshot = None
+            self._version = version
+          self._checked = time.time()
+    snapshot = self._snapshot
+    if snapshot is None:
+      with self._lock:
+        if self._snapshot is None:
+          self._snapshot = self.load(session)
+        snapshot = self._snapshot
+    return snapshot
+
+  def load(self, session):
+    """Returns a new snapshot of the reference tables."""
+    tables = {}
+    for name, record in self.record_types.iteritems():
+      table = Base.metadata.tables[name]
+      tables[name] = dict(
+          (row.id, record(*row)) for row in session.execute(table.select()))
+    return ReferenceSnapshot(tables)
+
+  def watch(self, session_factory):
+    """Invalidates the snapshot on changes made through the session factory."""
+    sqlalchemy.event.listen(session_factory, 'after_flush', self._after_flush)
+    sqlalchemy.event.listen(session_factory, 'after_commit', self._after_commit)
+    sqlalchemy.event.listen(
+        session_factory, 'after_transaction_end', self._after_transaction_end)
+
+  def _after_flush(self, session, _flush_context):
+    changed = itertools.chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, self.classes) for obj in changed):
+      session.info['reference_data_changed'] = True
+      bump_cache_version(session.connection(), self.VERSION_NAME)
+
+  def _after_commit(self, session):
+    if session.info.pop('reference_data_changed', False):
+      self._snapshot = None
+      self._checked = 0
+
+  def _after_transaction_end(self, session, transaction):
+    if transaction.parent is None and session.info.pop(
+        'reference_data_changed', False):
+      with self._lock:
+        self._snapshot = None
+        self._version = None
+        self._checked = 0
+
+
+def record_type(cls):
+  """Returns a named tuple type for rows of the class' table."""
+  return collections.namedtuple(cls.__name__, cls.__table__.columns.keys())
+
+
+reference_data = ReferenceData()
+
+
+# ##############################################################################
+# Functions operating on the database outside of the request transaction
+#
+def bump_cache_version(connection, name):
+  """Increments the shared version counter for the named cache."""
+  versions = CacheVersie.__table__
+  result = connection.execute(
+      versions.update()
+      .where(versions.c.naam == name)
+      .values(versie=versions.c.versie + 1))
+  if not result.rowcount:
+    connection.execute(versions.insert(), naam=name, versie=1)
+
+
+def cache_version(connection, name):
+  """Returns the shared version counter for the named cache, or None."""
+  versions = CacheVersie.__table__
+  return connection.execute(
+      sqlalchemy.select([versions.c.versie])
+      .where(versions.c.naam == name)).scalar()
+
+
+def reserve_customer_codes(engine, count):
+  """Reserves a block of `count` customer code sequence numbers.
+
+  The reservation is made in a short transaction of its own, so that it does
+  not hold a lock for the duration of the request, and is never rolled back
+  along with it. Returns the first number of the reserved block.
+  """
+  sequence = KlantcodeReeks.__table__
+  with engine.begin() as conn:
+    first = conn.execute(
+        sqlalchemy.select([sequence.c.volgende])
+        .where(sequence.c.id == 1)
+        .with_for_update()).scalar()
+    if first is None:
+      first = 0
+      conn.execute(sequence.insert(), id=1, volgende=count)
+    else:
+      conn.execute(
+          sequence.update()
+          .where(sequence.c.id == 1)
+          .values(volgende=sequence.c.volgende + count))
+  return first
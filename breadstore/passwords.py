@@ -0,0 +1,114 @@
+"""Password hashing for breadStore, optionally offloaded to worker processes."""
+
+# Standard modules
+import hashlib
+import multiprocessing
+import os
+import threading
+
+# Third-party modules
+import bcrypt
+
+BCRYPT_PREFIXES = '$2a$', '$2b$', '$2y$'
+
+
+class PoolSaturated(Exception):
+  """Raised when the password pool has no room for another job."""
+
+
+def check_password(password, pw_hash, rehash=True):
+  """Checks the encoded password against the stored hash.
+
+  Returns a tuple of the verification result and a bcrypt replacement for the
+  stored hash. The latter is None unless a legacy hash was verified, and
+  `rehash` is set.
+  """
+  if not is_legacy_hash(pw_hash):
+    return bcrypt.hashpw(password, pw_hash) == pw_hash, None
+  salt = pw_hash[:16].decode('hex')
+  result = ''
+  for _step in range(100):
+    result = hashlib.sha256(salt + result + password).digest()
+  if result == pw_hash[16:].decode('hex'):
+    return True, hash_password(password) if rehash else None
+  return False, None
+
+
+def hash_password(password, work_factor=10):
+  """Returns a bcrypt hash of the encoded password."""
+  return bcrypt.hashpw(password, bcrypt.gensalt(work_factor))
+
+
+def is_legacy_hash(pw_hash):
+  """Returns whether the stored hash predates the use of bcrypt."""
+  return not pw_hash.startswith(BCRYPT_PREFIXES)
+
+
+class PasswordPool(object):
+  """Bounded pool of processes for hashing and checking passwords.
+
+  At most `processes` jobs run at the same time, and at most `queue_limit`
+  more wait for a free process. Further jobs are refused immediately with
+  PoolSaturated, rather than tying up the request threads. A job keeps its
+  place until it has finished, even when its caller stopped waiting for it
+  after `timeout` seconds (which also raises PoolSaturated). A pool without
+  processes runs all jobs on the calling thread.
+  """
+  def __init__(self, processes=2, queue_limit=16, timeout=30):
+    self.processes = processes
+    self.timeout = timeout
+    self._slots = threading.BoundedSemaphore(processes + queue_limit)
+    self._lock = threading.Lock()
+    self._pool = None
+    self._pid = None
+
+  def check_password(self, password, pw_hash, rehash=True):
+    """Checks the password in a worker process, see `check_password`."""
+    return self._run(check_password, password, pw_hash, rehash)
+
+  def hash_password(self, password, work_factor=10):
+    """Hashes the password in a worker process, see `hash_password`."""
+    return self._run(hash_password, password, work_factor)
+
+  def _run(self, func, *args):
+    if not self.processes:
+      return func(*args)
+    if not self._slots.acquire(False):
+      raise PoolSaturated('Password pool saturated')
+    try:
+      job = self._worker_pool().apply_async(
+          run_captured, (func,) + args, callback=self._release)
+    except Exception:
+      self._slots.release()
+      raise
+    try:
+      error, result = job.get(self.timeout)
+    except multiprocessing.TimeoutError:
+      raise PoolSaturated('Password pool timed out')
+    if error is not None:
+      raise error
+    return result
+
+  def _release(self, _outcome):
+    """Frees the place of a finished job, called from the pool's thread."""
+    self._slots.release()
+
+  def _worker_pool(self):
+    """Returns the process pool, started lazily in each (forked) process."""
+    with self._lock:
+      if self._pid != os.getpid():
+        self._pool = multiprocessing.Pool(self.processes)
+        self._pid = os.getpid()
+      return self._pool
+
+
+def run_captured(func, *args):
+  """Returns the exception raised by the function, and its result.
+
+  Jobs in the pool run through this, so that they complete (and free their
+  place in the pool) whether or not the function raises.
+  """
+  try:
+    return None, func(*args)
+  except Exception as error:
+    return error, None
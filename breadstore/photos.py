@@ -0,0 +1,166 @@
+"""breadStore customer photo streaming and thumbnail cache."""
+
+# Standard modules
+import cStringIO
+import errno
+import hashlib
+import os
+import tempfile
+import threading
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+from . import versions
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+
+class PhotoChanged(Exception):
+  """The photo changed while its response body was being written."""
+
+
+def photo_etag(data):
+  """Returns the ETag of the given photo data."""
+  return hashlib.sha1(data).hexdigest()
+
+
+def fill_metadata(connection):
+  """Stores the ETag and size of photos stored without this metadata.
+
+  The photos are read one at a time, and the versions of their customers are
+  moved forward. Returns the number of photos updated.
+  """
+  photo = models.KlantFoto.__table__
+  customer_ids = [row.klant_id for row in connection.execute(
+      sqlalchemy.select([photo.c.klant_id]).where(sqlalchemy.or_(
+          photo.c.foto_etag == '', photo.c.foto_etag.is_(None))))]
+  for customer_id in customer_ids:
+    data = connection.execute(
+        sqlalchemy.select([photo.c.foto])
+        .where(photo.c.klant_id == customer_id)).scalar() or ''
+    connection.execute(
+        photo.update()
+        .where(photo.c.klant_id == customer_id)
+        .values(foto_etag=photo_etag(data), foto_grootte=len(data)))
+  versions.bump(connection, models.Klant, customer_ids)
+  return len(customer_ids)
+
+
+class BlobIter(object):
+  """WSGI iterator that reads a customer photo from the database in chunks.
+
+  Each chunk is read with a separate SUBSTRING query, so the photo is never
+  held in memory as a whole. Reading starts once the response body is being
+  written, and supports byte ranges through `app_iter_range`.
+
+  The session is held open until the iterator is closed, so that the chunks
+  are read in the transaction the photo's metadata was read in. Chunks are
+  only read from the photo with the given `etag`; should it have changed
+  regardless, PhotoChanged aborts the response.
+  """
+  def __init__(self, session, customer_id, etag, start, stop,
+               chunk_size=256 * 1024):
+    self.session = session
+    self.customer_id = customer_id
+    self.etag = etag
+    self.start = start
+    self.stop = stop
+    self.chunk_size = chunk_size
+    session.hold()
+
+  def __iter__(self):
+    photo = models.KlantFoto.__table__.c
+    try:
+      for offset in xrange(self.start, self.stop, self.chunk_size):
+        length = min(self.chunk_size, self.stop - offset)
+        chunk = self.session.execute(
+            sqlalchemy.select([sqlalchemy.func.substr(
+                photo.foto, offset + 1, length)])
+            .where(photo.klant_id == self.customer_id)
+            .where(photo.foto_etag == self.etag)).first()
+        if chunk is None:
+          raise PhotoChanged(
+              'Photo of customer %d changed while streaming.' %
+              self.customer_id)
+        yield bytes(chunk[0])
+    finally:
+      self.close()
+
+  def app_iter_range(self, start, stop):
+    """Returns an iterator for the given byte range of the photo."""
+    stop = self.stop if stop is None else min(stop, self.stop)
+    return BlobIter(
+        self.session, self.customer_id, self.etag, self.start + start, stop,
+        chunk_size=self.chunk_size)
+
+  def close(self):
+    """Releases the session, which closes it."""
+    self.session.release()
+
+
+class ThumbnailCache(object):
+  """On-disk cache of resized photos, evicting the least recently used.
+
+  Thumbnails are stored by photo ETag and width, so changed photos never hit a
+  stale thumbnail. Every cache hit updates the file's modification time; once
+  there are more than `size` thumbnails the least recently used are removed.
+  Resizing requires PIL; without it `available` is False.
+  """
+  def __init__(self, directory, size=1000):
+    self.directory = directory
+    self.size = size
+    self.available = Image is not None
+    self._lock = threading.Lock()
+    try:
+      os.makedirs(directory)
+    except OSError as err:
+      if err.errno != errno.EEXIST:
+        raise
+
+  def get(self, etag, width):
+    """Returns the path of the cached thumbnail, or None if not present."""
+    path = self.path(etag, width)
+    try:
+      os.utime(path, None)
+    except OSError:
+      return None
+    return path
+
+  def create(self, etag, width, data):
+    """Stores a thumbnail of the photo data and returns its path."""
+    image = Image.open(cStringIO.StringIO(data))
+    image.thumbnail((width, width * 4), Image.ANTIALIAS)
+    handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    with os.fdopen(handle, 'wb') as temp_file:
+      image.convert('RGB').save(temp_file, 'JPEG', quality=85)
+    path = self.path(etag, width)
+    os.rename(temp_path, path)
+    self.prune()
+    return path
+
+  def path(self, etag, width):
+    return os.path.join(self.directory, '%s-%d.jpg' % (etag, width))
+
+  def prune(self):
+    """Removes the least recently used thumbnails beyond the cache size."""
+    with self._lock:
+      entries = []
+      for name in os.listdir(self.directory):
+        if name.endswith('.jpg'):
+          path = os.path.join(self.directory, name)
+          try:
+            entries.append((os.path.getmtime(path), path))
+          except OSError:
+            pass
+      entries.sort(reverse=True)
+      for _mtime, path in entries[self.size:]:
+        try:
+          os.remove(path)
+        except OSError:
+          pass
@@ -0,0 +1,258 @@
+"""breadStore pick lists, materialized per location and distribution day."""
+
+# Standard modules
+import datetime
+import itertools
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+from . import util
+
+DELETED_DIETS_KEY = 'breadstore.picklist.deleted_diets'
+
+
+def pick_list(session, location_id, date):
+  """Returns the pick list entries for the location on the given date."""
+  entry = models.Picklijst
+  return session.query(entry).filter(
+      entry.locatie_id == location_id,
+      entry.ophaaldatum == date,
+      sqlalchemy.or_(entry.datum_einde == None, entry.datum_einde >= date)
+  ).order_by(entry.naam).all()
+
+
+def rebuild(connection):
+  """Recomputes the pick list entries for all active subscriptions."""
+  subscription = models.Abonnement.__table__
+  connection.execute(models.Picklijst.__table__.delete())
+  active = connection.execute(
+      sqlalchemy.select([subscription.c.id])
+      .where(active_subscription(subscription)))
+  _refresh(connection, [subscription_id for subscription_id, in active])
+
+
+def refresh(connection, subscription_ids=(), package_ids=(), customer_ids=()):
+  """Recomputes the pick list entries of the given subscriptions.
+
+  Subscriptions can also be given by (one of) their package ids, or by the
+  customers they belong to.
+  """
+  subscription_ids = set(subscription_ids)
+  package = models.Pakket.__table__
+  for chunk in util.chunked(set(package_ids), 500):
+    subscription_ids.update(row.abonnement_id for row in connection.execute(
+        sqlalchemy.select([package.c.abonnement_id])
+        .where(package.c.id.in_(chunk))))
+  subscription = models.Abonnement.__table__
+  for chunk in util.chunked(set(customer_ids), 500):
+    subscription_ids.update(row.id for row in connection.execute(
+        sqlalchemy.select([subscription.c.id])
+        .where(subscription.c.klant_id.in_(chunk))))
+  subscription_ids.discard(None)
+  if subscription_ids:
+    table = models.Picklijst.__table__
+    for chunk in util.chunked(subscription_ids, 500):
+      connection.execute(
+          table.delete().where(table.c.abonnement_id.in_(chunk)))
+    _refresh(connection, subscription_ids)
+
+
+def _refresh(connection, subscription_ids):
+  """Inserts the entries for the given subscriptions."""
+  table = models.Picklijst.__table__
+  for chunk in util.chunked(subscription_ids, 500):
+    entries = pick_list_entries(connection, chunk)
+    if entries:
+      connection.execute(table.insert(), entries)
+
+
+def pick_list_entries(connection, subscription_ids):
+  """Returns the pick list entries for the given subscriptions.
+
+  Every package of an active subscription that has not been processed gets an
+  entry, on the pickup date of its most recent status. Those dates already
+  include any date shifts (see `planning`). Packages due before today are left
+  out, so the list of any day from today on holds the subscription's next
+  package as of that day, without relying on a package missed earlier being
+  processed first.
+  """
+  subscription = models.Abonnement.__table__
+  cycle = models.UitgifteCyclus.__table__
+  customer = models.Klant.__table__
+  subscriptions = dict((row.id, row) for row in connection.execute(
+      sqlalchemy.select([
+          subscription.c.id, subscription.c.klant_id,
+          subscription.c.datum_einde, cycle.c.locatie_id, customer.c.klantcode,
+          customer.c.voorletters, customer.c.tussenvoegsel,
+          customer.c.achternaam])
+      .select_from(subscription.join(cycle).join(customer))
+      .where(sqlalchemy.and_(
+          subscription.c.id.in_(subscription_ids),
+          active_subscription(subscription),
+          cycle.c.actief))))
+  if not subscriptions:
+    return []
+  package = models.Pakket.__table__
+  size = models.PakketGrootte.__table__
+  packages = connection.execute(
+      sqlalchemy.select([
+          package.c.id, package.c.abonnement_id, package.c.volgnummer,
+          size.c.code])
+      .select_from(package.join(size))
+      .where(sqlalchemy.and_(
+          package.c.abonnement_id.in_(list(subscriptions)),
+          ~models.Pakket.completed))).fetchall()
+  if not packages:
+    return []
+  status = models.PakketStatus.__table__
+  pickup_dates = {}
+  for chunk in util.chunked([row.id for row in packages], 500):
+    pickup_dates.update(connection.execute(
+        sqlalchemy.select([status.c.pakket_id, status.c.ophaaldatum])
+        .where(status.c.pakket_id.in_(chunk))
+        .order_by(status.c.pakket_id, status.c.id)).fetchall())
+  diet = models.Dieet.__table__
+  diets = models.t_abonnement_dieet
+  stickers = {}
+  for row in connection.execute(
+      sqlalchemy.select([diets.c.abonnement_id, diet.c.sticker_kleur])
+      .select_from(diets.join(diet))
+      .where(diets.c.abonnement_id.in_(list(subscriptions)))
+      .order_by(diets.c.abonnement_id, diet.c.id)):
+    stickers.setdefault(row.abonnement_id, []).append(row.sticker_kleur)
+  today = datetime.date.today()
+  entries = []
+  for row in packages:
+    pickup_date = pickup_dates.get(row.id)
+    if pickup_date is None or pickup_date < today:
+      continue
+    sub = subscriptions[row.abonnement_id]
+    entries.append({
+        'pakket_id': row.id,
+        'abonnement_id': sub.id,
+        'klant_id': sub.klant_id,
+        'locatie_id': sub.locatie_id,
+        'ophaaldatum': pickup_date,
+        'datum_einde': sub.datum_einde,
+        'volgnummer': row.volgnummer,
+        'klantcode': sub.klantcode,
+        'naam': display_name(sub),
+        'pakket_grootte': row.code,
+        'stickers': ','.join(stickers.get(sub.id, ()))[:100]})
+  return entries
+
+
+def affected_subscriptions(connection, diet_ids=(), size_ids=(),
+                           cycle_ids=(), dates=()):
+  """Returns the subscriptions whose entries depend on the reference rows.
+
+  These are the subscriptions with one of the diets or cycles, those listed
+  with a package of one of the sizes, and those with an unprocessed pickup
+  (listed or not) on one of the dates.
+  """
+  subscription = models.Abonnement.__table__
+  package = models.Pakket.__table__
+  status = models.PakketStatus.__table__
+  table = models.Picklijst.__table__
+  diets = models.t_abonnement_dieet
+  queries = []
+  for chunk in util.chunked(set(diet_ids), 500):
+    queries.append(sqlalchemy.select([diets.c.abonnement_id]).where(
+        diets.c.dieet_id.in_(chunk)))
+  for chunk in util.chunked(set(cycle_ids), 500):
+    queries.append(sqlalchemy.select([subscription.c.id]).where(
+        subscription.c.uitgifte_cyclus_id.in_(chunk)))
+  for chunk in util.chunked(set(size_ids), 500):
+    queries.append(
+        sqlalchemy.select([table.c.abonnement_id])
+        .select_from(table.join(package))
+        .where(package.c.pakket_grootte_id.in_(chunk)))
+  for chunk in util.chunked(set(dates), 500):
+    queries.append(sqlalchemy.select([table.c.abonnement_id]).where(
+        table.c.ophaaldatum.in_(chunk)))
+    queries.append(
+        sqlalchemy.select([package.c.abonnement_id])
+        .select_from(status.join(package))
+        .where(sqlalchemy.and_(
+            status.c.ophaaldatum.in_(chunk), ~status.c.verwerkt)))
+  subscription_ids = set()
+  for query in queries:
+    subscription_ids.update(row[0] for row in connection.execute(query))
+  return subscription_ids
+
+
+def active_subscription(subscription):
+  """Returns a filter for subscriptions that have not ended before today."""
+  return sqlalchemy.or_(
+      subscription.c.datum_einde == None,
+      subscription.c.datum_einde >= datetime.date.today())
+
+
+def display_name(customer):
+  """Returns the customer's name as listed, e.g. "Vries, J. de"."""
+  initials = u' '.join(filter(None, (
+      customer.voorletters, customer.tussenvoegsel)))
+  if initials:
+    return u'%s, %s' % (customer.achternaam, initials)
+  return customer.achternaam
+
+
+def watch(session_factory):
+  """Keeps pick lists up to date with changes made through the factory."""
+  sqlalchemy.event.listen(session_factory, 'before_flush', _before_flush)
+  sqlalchemy.event.listen(session_factory, 'after_flush', _after_flush)
+
+
+def _before_flush(session, _flush_context, _instances):
+  """Records the subscriptions of diets about to be deleted.
+
+  Their links to subscriptions are deleted along with them, after which the
+  subscriptions can no longer be found by diet.
+  """
+  diet_ids = [
+      obj.id for obj in session.deleted if isinstance(obj, models.Dieet)]
+  if diet_ids:
+    session.info.setdefault(DELETED_DIETS_KEY, set()).update(
+        affected_subscriptions(session.connection(), diet_ids=diet_ids))
+
+
+def _after_flush(session, _flush_context):
+  """Refreshes the entries affected by the flushed changes.
+
+  Changes to subscriptions, packages, package statuses and customers update
+  the entries of those subscriptions only. Changes to the reference tables used
+  (diets, package sizes, cycles and date shifts) update the entries of the
+  subscriptions that use the changed rows.
+  """
+  subscription_ids = session.info.pop(DELETED_DIETS_KEY, set())
+  package_ids, customer_ids = set(), set()
+  diet_ids, size_ids, cycle_ids, dates = set(), set(), set(), set()
+  for obj in itertools.chain(session.new, session.dirty, session.deleted):
+    if isinstance(obj, models.Abonnement):
+      subscription_ids.add(obj.id)
+    elif isinstance(obj, models.Pakket):
+      subscription_ids.add(obj.abonnement_id)
+    elif isinstance(obj, models.PakketStatus):
+      package_ids.add(obj.pakket_id)
+    elif isinstance(obj, models.Klant):
+      customer_ids.add(obj.id)
+    elif isinstance(obj, models.Dieet):
+      diet_ids.add(obj.id)
+    elif isinstance(obj, models.PakketGrootte):
+      size_ids.add(obj.id)
+    elif isinstance(obj, models.UitgifteCyclus):
+      cycle_ids.add(obj.id)
+    elif isinstance(obj, models.Datumwijziging):
+      attrs = sqlalchemy.inspect(obj).attrs
+      dates.update((obj.planning, obj.aanpassing))
+      dates.update(attrs.planning.history.deleted)
+      dates.update(attrs.aanpassing.history.deleted)
+  dates.discard(None)
+  if diet_ids or size_ids or cycle_ids or dates:
+    subscription_ids.update(affected_subscriptions(
+        session.connection(), diet_ids, size_ids, cycle_ids, dates))
+  if subscription_ids or package_ids or customer_ids:
+    refresh(session.connection(), subscription_ids, package_ids, customer_ids)
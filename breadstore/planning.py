@@ -0,0 +1,193 @@
+"""breadStore package planning for subscriptions."""
+
+# Standard modules
+import datetime
+import itertools
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+from . import resources
+from . import util
+from . import versions
+
+WEEK = datetime.timedelta(days=7)
+
+
+def first_pickup(start, weekday):
+  """Returns the first date on or after `start` on the ISO weekday (1-7)."""
+  return start + datetime.timedelta(days=(weekday - start.isoweekday()) % 7)
+
+
+def pickup_dates(start, weekday, count, date_changes):
+  """Returns the `count` weekly pickup dates from the start date onwards.
+
+  Dates that have been shifted (e.g. for a holiday) are replaced by the date
+  they have been moved to.
+  """
+  first = first_pickup(start, weekday)
+  dates = (first + WEEK * week for week in xrange(count))
+  return [date_changes.get(date, date) for date in dates]
+
+
+def plan(connection, subscription_ids, staff_id):
+  """Creates the planned packages of the subscriptions that are missing.
+
+  Packages are numbered from one up to the subscription's package count, each
+  with a status for its weekly pickup date, recorded by the given staff member.
+  All packages and statuses are inserted with a single bulk insert each. The
+  package size follows from the customer's family size, an ApiError is raised
+  if no size is configured for it. Returns the number of packages created.
+  """
+  subscription = models.Abonnement.__table__
+  cycle = models.UitgifteCyclus.__table__
+  package = models.Pakket.__table__
+  planned = sqlalchemy.select([sqlalchemy.func.count(package.c.id)]).where(
+      package.c.abonnement_id == subscription.c.id).label('planned')
+  family = models.Gezinslid.__table__
+  family_size = sqlalchemy.select([sqlalchemy.func.count(family.c.id) + 1])
+  family_size = family_size.where(
+      family.c.klant_id == subscription.c.klant_id).label('family_size')
+  packages = []
+  dates = {}
+  reference = models.reference_data.get(connection)
+  for chunk in util.chunked(set(subscription_ids), 500):
+    for row in connection.execute(
+        sqlalchemy.select([
+            subscription.c.id, subscription.c.datum_start,
+            subscription.c.pakket_aantal, cycle.c.ophaaldag, planned,
+            family_size])
+        .select_from(subscription.join(cycle))
+        .where(subscription.c.id.in_(chunk))):
+      key = row.datum_start, row.ophaaldag
+      if len(dates.get(key, ())) < row.pakket_aantal:
+        dates[key] = pickup_dates(
+            row.datum_start, row.ophaaldag, row.pakket_aantal,
+            reference.date_changes)
+      size = reference.package_size(row.family_size)
+      if size is None:
+        raise resources.ApiError(
+            'No package size configured for a family of %d.' % row.family_size,
+            code=409)
+      for number in xrange(row.planned + 1, row.pakket_aantal + 1):
+        packages.append({
+            'abonnement_id': row.id,
+            'volgnummer': number,
+            'pakket_grootte_id': size.id,
+            'ophaaldatum': dates[key][number - 1]})
+  if packages:
+    connection.execute(package.insert(), [
+        dict((key, values[key]) for key in (
+            'abonnement_id', 'volgnummer', 'pakket_grootte_id'))
+        for values in packages])
+    insert_planned_statuses(connection, packages, staff_id)
+    versions.bump(connection, models.Abonnement, (
+        values['abonnement_id'] for values in packages))
+  return len(packages)
+
+
+def insert_planned_statuses(connection, packages, staff_id):
+  """Inserts the planned status of newly inserted packages."""
+  package = models.Pakket.__table__
+  package_ids = {}
+  subscription_ids = set(values['abonnement_id'] for values in packages)
+  for chunk in util.chunked(subscription_ids, 500):
+    for row in connection.execute(
+        sqlalchemy.select([
+            package.c.id, package.c.abonnement_id, package.c.volgnummer])
+        .where(package.c.abonnement_id.in_(chunk))):
+      package_ids[row.abonnement_id, row.volgnummer] = row.id
+  connection.execute(models.PakketStatus.__table__.insert(), [{
+      'pakket_id': package_ids[values['abonnement_id'], values['volgnummer']],
+      'ophaaldatum': values['ophaaldatum'],
+      'verwerkt': False,
+      'opgehaald': False,
+      'malus': False,
+      'medewerker_id': staff_id} for values in packages])
+
+
+def replan(connection, dates, current_dates=()):
+  """Moves the planned pickups of the given dates to where they now belong.
+
+  `dates` are the weekly pickup dates (before shifting) whose shift has been
+  added, changed or removed. Unprocessed packages are selected by their
+  current pickup date, which is one of `dates` or `current_dates`, for all
+  subscriptions at once. Each package's own weekly date is recomputed from
+  its subscription's start and cycle. Only packages whose own date is one of
+  `dates` are moved, to where the current date shifts put them. Pickups that
+  another cycle plans on a shifted-to date are left alone.
+
+  The moves are batched UPDATEs, and the subscriptions of moved packages get
+  their next version. Returns the number of statuses moved.
+  """
+  status = models.PakketStatus.__table__
+  processed = status.alias('processed')
+  package = models.Pakket.__table__
+  subscription = models.Abonnement.__table__
+  cycle = models.UitgifteCyclus.__table__
+  changes = current_date_changes(connection)
+  dates = set(dates)
+  moves = {}
+  package_ids = []
+  for row in connection.execute(
+      sqlalchemy.select([
+          status.c.id, status.c.pakket_id, status.c.ophaaldatum,
+          package.c.volgnummer, subscription.c.datum_start, cycle.c.ophaaldag])
+      .select_from(status.join(package).join(subscription).join(cycle))
+      .where(sqlalchemy.and_(
+          status.c.ophaaldatum.in_(dates.union(current_dates)),
+          ~status.c.verwerkt,
+          ~sqlalchemy.exists().where(sqlalchemy.and_(
+              processed.c.pakket_id == status.c.pakket_id,
+              processed.c.verwerkt))))):
+    own_date = (first_pickup(row.datum_start, row.ophaaldag) +
+                WEEK * (row.volgnummer - 1))
+    if own_date not in dates:
+      continue
+    new_date = changes.get(own_date, own_date)
+    if new_date != row.ophaaldatum:
+      moves.setdefault(new_date, []).append(row.id)
+      package_ids.append(row.pakket_id)
+  for new_date, status_ids in moves.iteritems():
+    for chunk in util.chunked(status_ids, 1000):
+      connection.execute(
+          status.update()
+          .where(status.c.id.in_(chunk))
+          .values(ophaaldatum=new_date))
+  versions.bump_packages(connection, package_ids)
+  return len(package_ids)
+
+
+def current_date_changes(connection):
+  """Returns the date shifts as stored, including flushed changes."""
+  shift = models.Datumwijziging.__table__
+  return dict(connection.execute(
+      sqlalchemy.select([shift.c.planning, shift.c.aanpassing])).fetchall())
+
+
+def watch(session_factory):
+  """Replans pickups when date shifts are changed through the factory."""
+  sqlalchemy.event.listen(session_factory, 'after_flush', _after_flush)
+
+
+def _after_flush(session, _flush_context):
+  """Moves the planned pickups affected by new, changed or removed shifts.
+
+  For every changed shift, both its original and shifted date are collected,
+  before and after the change. Pickups may currently be planned on any of
+  these dates.
+  """
+  dates, current_dates = set(), set()
+  for change in itertools.chain(session.new, session.dirty, session.deleted):
+    if isinstance(change, models.Datumwijziging):
+      attrs = sqlalchemy.inspect(change).attrs
+      dates.add(change.planning)
+      dates.update(attrs.planning.history.deleted)
+      current_dates.add(change.aanpassing)
+      current_dates.update(attrs.aanpassing.history.deleted)
+  dates.discard(None)
+  current_dates.discard(None)
+  if dates:
+    replan(session.connection(), dates, current_dates)
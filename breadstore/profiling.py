@@ -0,0 +1,253 @@
+"""breadStore request profiling, with per-route metrics.
+
+Profiling is enabled with the `breadstore.profiling` setting. Without it, none
+of the tweens, subscribers and hooks in this module are installed.
+"""
+
+# Standard modules
+import collections
+import functools
+import logging
+import re
+import threading
+import time
+
+# Third-party modules
+from pyramid import events
+from pyramid import tweens
+import sqlalchemy
+
+# Application modules
+from . import passwords
+from . import schemas
+
+BUCKETS = 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000
+INSTRUMENTED = (
+    ('schema', schemas, 'load'),
+    ('schema', schemas, 'load_many'),
+    ('schema', schemas, 'load_params'),
+    ('bcrypt', passwords.PasswordPool, 'check_password'),
+    ('bcrypt', passwords.PasswordPool, 'hash_password'))
+IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|%\(\w+\)s|:\w+)\s*,)+\s*')
+LOG = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def setup(config, repeat_threshold=5):
+  """Installs the profiling tween, hooks and the metrics view."""
+  config.registry.route_metrics = RouteMetrics()
+  config.registry.repeat_threshold = repeat_threshold
+  config.add_tween('breadstore.profiling.tween_factory', under=tweens.INGRESS)
+  config.add_subscriber(context_found, events.ContextFound)
+  config.add_subscriber(before_render, events.BeforeRender)
+  config.add_view(
+      metrics_view, context='breadstore.resources.Metrics',
+      request_method='GET', permission='view')
+  if not sqlalchemy.event.contains(
+      sqlalchemy.engine.Engine, 'before_cursor_execute', before_execute):
+    sqlalchemy.event.listen(
+        sqlalchemy.engine.Engine, 'before_cursor_execute', before_execute)
+    sqlalchemy.event.listen(
+        sqlalchemy.engine.Engine, 'after_cursor_execute', after_execute)
+  for phase, owner, name in INSTRUMENTED:
+    instrument(phase, owner, name)
+
+
+class RequestProfile(object):
+  """Statement counts and phase timings of a single request."""
+  def __init__(self):
+    self.start = time.time()
+    self.marks = {}
+    self.phases = collections.defaultdict(float)
+    self.statements = collections.Counter()
+    self.sql_count = 0
+    self.sql_time = 0.0
+
+  def mark(self, name):
+    """Records the time at which the request reached the named point."""
+    self.marks[name] = time.time()
+
+  def add_statement(self, statement, duration):
+    """Counts an executed statement by its shape, ignoring IN list lengths."""
+    self.statements[IN_LIST.sub('(', statement)] += 1
+    self.sql_count += 1
+    self.sql_time += duration
+
+  def repeated(self, threshold):
+    """Returns statement shapes executed at least `threshold` times."""
+    return [(statement, count) for statement, count in
+            self.statements.most_common() if count >= threshold]
+
+  def durations(self, end):
+    """Returns the durations of the request phases, in seconds."""
+    found = self.marks.get('context_found', end)
+    rendering = self.marks.get('before_render', end)
+    durations = collections.OrderedDict([
+        ('total', end - self.start),
+        ('traversal', found - self.start),
+        ('view', rendering - found),
+        ('render', end - rendering),
+        ('sql', self.sql_time)])
+    durations.update(sorted(self.phases.items()))
+    return durations
+
+
+class RouteMetrics(object):
+  """Thread-safe histograms of request durations, per route.
+
+  Next to the duration histogram (in milliseconds, with cumulative buckets),
+  the request count and the total number and duration of SQL statements are
+  kept for every route.
+  """
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self._routes = {}
+    self._lock = threading.Lock()
+
+  def record(self, route, duration, sql_count, sql_time):
+    """Adds a request of the given duration (in seconds) to the route."""
+    millis = duration * 1000
+    with self._lock:
+      metrics = self._routes.get(route)
+      if metrics is None:
+        metrics = self._routes[route] = {
+            'verzoeken': 0, 'duur': 0.0, 'sql': 0, 'sqlDuur': 0.0,
+            'histogram': [0] * (len(self.buckets) + 1)}
+      metrics['verzoeken'] += 1
+      metrics['duur'] += millis
+      metrics['sql'] += sql_count
+      metrics['sqlDuur'] += sql_time * 1000
+      for index, bucket in enumerate(self.buckets):
+        if millis <= bucket:
+          metrics['histogram'][index] += 1
+          break
+      else:
+        metrics['histogram'][-1] += 1
+
+  def snapshot(self):
+    """Returns the metrics of all routes, with cumulative histograms."""
+    with self._lock:
+      routes = dict(
+          (route, dict(metrics, histogram=list(metrics['histogram'])))
+          for route, metrics in self._routes.iteritems())
+    bounds = [str(bucket) for bucket in self.buckets] + ['+Inf']
+    result = []
+    for route, metrics in sorted(routes.iteritems()):
+      cumulative, histogram = 0, []
+      for bound, count in zip(bounds, metrics['histogram']):
+        cumulative += count
+        histogram.append({'tot': bound, 'verzoeken': cumulative})
+      metrics.update(route=route, histogram=histogram)
+      result.append(metrics)
+    return result
+
+
+def tween_factory(handler, registry):
+  """Returns a tween that profiles every request it handles.
+
+  The profile covers everything up to the return of the response, including
+  the commit of the transaction. Statements executed while a streamed response
+  is written are not included.
+  """
+  metrics = registry.route_metrics
+  threshold = registry.repeat_threshold
+
+  def profiling_tween(request):
+    profile = _local.profile = RequestProfile()
+    try:
+      response = handler(request)
+    finally:
+      _local.profile = None
+    durations = profile.durations(time.time())
+    route = route_name(request)
+    metrics.record(
+        route, durations['total'], profile.sql_count, profile.sql_time)
+    repeated = profile.repeated(threshold)
+    for statement, count in repeated:
+      LOG.warning(
+          '%s: statement executed %d times: %s', route, count, statement)
+    timings = [response.headers.get('Server-Timing')]
+    timings.extend(
+        '%s;dur=%.1f' % (name, duration * 1000)
+        for name, duration in durations.iteritems())
+    timings.append('sql-count;desc="%d"' % profile.sql_count)
+    if repeated:
+      timings.append('sql-repeated;desc="%d"' % len(repeated))
+    response.headers['Server-Timing'] = ', '.join(filter(None, timings))
+    return response
+  return profiling_tween
+
+
+def route_name(request):
+  """Returns the name the request is recorded under in the metrics.
+
+  This is the request method with the context's resource class and view name,
+  e.g. "GET Customer/foto".
+  """
+  context = getattr(request, 'context', None)
+  name = type(context).__name__ if context is not None else 'None'
+  if getattr(request, 'view_name', None):
+    name = '%s/%s' % (name, request.view_name)
+  return '%s %s' % (request.method, name)
+
+
+def context_found(_event):
+  """Marks the end of traversal for the current profile."""
+  profile = getattr(_local, 'profile', None)
+  if profile is not None:
+    profile.mark('context_found')
+
+
+def before_render(_event):
+  """Marks the end of the view for the current profile."""
+  profile = getattr(_local, 'profile', None)
+  if profile is not None and 'before_render' not in profile.marks:
+    profile.mark('before_render')
+
+
+def before_execute(_conn, _cursor, _statement, _params, context, _many):
+  """Records the start of a statement executed during a profiled request.
+
+  The start is kept on the statement's execution context, which is discarded
+  along with it when the statement fails.
+  """
+  if context is not None and getattr(_local, 'profile', None) is not None:
+    context.profiling_start = time.time()
+
+
+def after_execute(_conn, _cursor, statement, _params, context, _many):
+  """Adds a statement executed during a profiled request to its profile."""
+  profile = getattr(_local, 'profile', None)
+  start = getattr(context, 'profiling_start', None)
+  if profile is not None and start is not None:
+    profile.add_statement(statement, time.time() - start)
+
+
+def instrument(phase, owner, name):
+  """Replaces a function of the module or class with a timed version.
+
+  The time spent in the function during profiled requests is added to the
+  named phase of the profile. Functions are instrumented only once.
+  """
+  func = getattr(owner, name)
+  if getattr(func, 'profiled', False):
+    return
+
+  @functools.wraps(func)
+  def timed(*args, **kwds):
+    profile = getattr(_local, 'profile', None)
+    if profile is None:
+      return func(*args, **kwds)
+    start = time.time()
+    try:
+      return func(*args, **kwds)
+    finally:
+      profile.phases[phase] += time.time() - start
+  timed.profiled = True
+  setattr(owner, name, timed)
+
+
+def metrics_view(request):
+  """Returns the request metrics per route, since the process started."""
+  return {'routes': request.registry.route_metrics.snapshot()}
@@ -0,0 +1,347 @@
+"""breadStore response renderers."""
+
+# Standard modules
+import functools
+import itertools
+import json
+import logging
+import time
+import zlib
+
+# Third-party modules
+from pyramid import renderers
+from pyramid.path import DottedNameResolver
+import simplejson
+
+# Application modules
+from . import models
+from . import versions
+
+# simplejson's own handling of named tuples and decimals is switched off, so
+# that these serialize exactly as they do with the standard library's json.
+SIMPLEJSON_DUMPS = functools.partial(
+    simplejson.dumps, namedtuple_as_object=False, use_decimal=False)
+JSON_SERIALIZERS = {'json': json.dumps, 'simplejson': SIMPLEJSON_DUMPS}
+LOG = logging.getLogger(__name__)
+
+
+class StreamedList(object):
+  """Marks a query result for streaming by the JSON renderer.
+
+  Rows are fetched from the database in batches of `batch_size` and serialized
+  one at a time while the response body is being written. Once the renderer
+  has taken on the list, the query's session is held open for it, also after
+  the request's transaction has ended. The session is closed once the stream
+  is exhausted or closed by the WSGI server.
+
+  With a `limit`, at most that many rows are streamed. A query selecting one
+  row more then sets `more` to tell whether rows follow the streamed ones.
+  The `key` of the last row streamed is kept as `last`, taken as the row is
+  streamed (its attributes may have expired by the time the stream ends).
+  """
+  def __init__(self, query, batch_size=200, limit=None, key=None):
+    self.query = query
+    self.batch_size = batch_size
+    self.limit = limit
+    self.key = key
+    self.last = None
+    self.more = False
+
+  def __iter__(self):
+    try:
+      for count, row in enumerate(self.query.yield_per(self.batch_size)):
+        if count == self.limit:
+          self.more = True
+          break
+        if self.key is not None:
+          self.last = self.key(row)
+        yield row
+    finally:
+      self.query.session.release()
+
+
+class Deferred(object):
+  """Value of a streamed response, computed when the renderer reaches it.
+
+  This allows values to depend on a StreamedList that precedes them in an
+  ordered mapping.
+  """
+  def __init__(self, func):
+    self.func = func
+
+  def __call__(self):
+    return self.func()
+
+
+class RenderTimings(object):
+  """Time spent encoding and compressing the body of a single response."""
+  def __init__(self):
+    self.encode = 0.0
+    self.compress = 0.0
+    self.size = 0
+    self.compressed_size = None
+
+  def server_timing(self):
+    """Returns the timings formatted for a Server-Timing header."""
+    timings = ['json;dur=%.1f' % (self.encode * 1000)]
+    if self.compressed_size is not None:
+      timings.append('gzip;dur=%.1f' % (self.compress * 1000))
+    return ', '.join(timings)
+
+  def log(self, request):
+    """Logs the timings and body sizes of the response to the request."""
+    LOG.debug(
+        '%s %s: %d bytes encoded in %.1fms, %s bytes compressed in %.1fms',
+        request.method, request.path_qs, self.size, self.encode * 1000,
+        self.compressed_size, self.compress * 1000)
+
+
+class StreamingJSON(renderers.JSON):
+  """JSON renderer that streams the body of responses with large collections.
+
+  Responses without StreamedList values are rendered as a single string, as
+  the regular Pyramid JSON renderer does. Otherwise the response is written to
+  the WSGI iterator in chunks of approximately `chunk_size` bytes. The streamed
+  output is identical to what the regular renderer would produce.
+
+  Bodies of at least `compress_threshold` bytes are gzip compressed for clients
+  that accept it, streamed bodies as they are written. The time spent encoding
+  and compressing is kept on the request as `render_timings`, sent in the
+  Server-Timing header for bodies that are not streamed, and logged at debug
+  level once the body has been written.
+  """
+  def __init__(self, serializer=SIMPLEJSON_DUMPS, chunk_size=64 * 1024,
+               forbid_queries=False, compress_threshold=1400, compress_level=6,
+               **kw):
+    super(StreamingJSON, self).__init__(serializer=serializer, **kw)
+    self.chunk_size = chunk_size
+    self.forbid_queries = forbid_queries
+    self.compress_threshold = compress_threshold
+    self.compress_level = compress_level
+
+  def __call__(self, info):
+    render = super(StreamingJSON, self).__call__(info)
+
+    def _render(value, system):
+      request = system.get('request')
+      if request is None:
+        return self.render(render, value, system)
+      timings = request.render_timings = RenderTimings()
+      if not has_streamed_values(value):
+        start = time.time()
+        body = self.render(render, value, system)
+        timings.encode = time.time() - start
+        timings.size = len(body)
+        return self.respond(request, [body], timings, streamed=False)
+      response = request.response
+      if response.content_type == response.default_content_type:
+        response.content_type = 'application/json'
+      streamed = [item for item in value.itervalues()
+                  if isinstance(item, StreamedList)]
+      for item in streamed:
+        item.query.session.hold()
+      default = self._make_default(request)
+      try:
+        return self.respond(
+            request, self.stream(value, default, timings), timings)
+      except Exception:
+        for item in streamed:
+          item.query.session.release()
+        raise
+    return _render
+
+  def render(self, render, value, system):
+    """Renders the value as a single string, optionally forbidding queries."""
+    if self.forbid_queries:
+      with models.forbid_queries():
+        return render(value, system)
+    return render(value, system)
+
+  def respond(self, request, chunks, timings, streamed=True):
+    """Sets the body of the response, compressed if it is large enough.
+
+    Up to `compress_threshold` bytes of the body are encoded first. Bodies that
+    turn out smaller are returned as they are, larger ones are compressed if
+    the client accepts gzip. Without a threshold, streamed bodies are passed on
+    to the response as they are encoded. Returns the body, or None if it has
+    been set on the response. The ETag of a compressed response is suffixed
+    with its encoding.
+    """
+    response = request.response
+    if self.compress_threshold is None:
+      if streamed:
+        response.app_iter = logged_iter(chunks, request, timings, chunks)
+        return None
+      self.finish(request, timings, streamed)
+      return chunks[0]
+    chunks = iter(chunks)
+    head = []
+    size = 0
+    for chunk in chunks:
+      head.append(chunk)
+      size += len(chunk)
+      if size >= self.compress_threshold:
+        break
+    else:
+      self.finish(request, timings, streamed)
+      return ''.join(head) if streamed else head[0]
+    response.vary = tuple(response.vary or ()) + ('Accept-Encoding',)
+    if streamed:
+      body = itertools.chain(head, chunks)
+      if accepts_gzip(request):
+        self.encode(response, 'gzip')
+        body = self.compress(body, timings)
+      response.app_iter = logged_iter(body, request, timings, chunks)
+      return None
+    if accepts_gzip(request):
+      self.encode(response, 'gzip')
+      response.body = ''.join(self.compress(head, timings))
+      self.finish(request, timings, streamed)
+      return None
+    self.finish(request, timings, streamed)
+    return head[0]
+
+  @staticmethod
+  def encode(response, encoding):
+    """Sets the content encoding of the response, and adjusts its ETag."""
+    response.content_encoding = encoding
+    if response.etag:
+      response.etag = versions.encoded_etag(response.etag, encoding)
+
+  @staticmethod
+  def finish(request, timings, streamed):
+    """Reports the timings of a response of which the body has been set."""
+    if not streamed:
+      request.response.headers['Server-Timing'] = timings.server_timing()
+    timings.log(request)
+
+  def compress(self, chunks, timings):
+    """Yields the gzip compressed chunks, as they become available."""
+    compressor = zlib.compressobj(
+        self.compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    timings.compressed_size = 0
+    for chunk in itertools.chain(chunks, [None]):
+      start = time.time()
+      if chunk is None:
+        data = compressor.flush()
+      else:
+        if isinstance(chunk, unicode):
+          chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+      timings.compress += time.time() - start
+      if data:
+        timings.compressed_size += len(data)
+        yield data
+
+  def stream(self, mapping, default, timings):
+    """Yields the JSON encoded mapping in chunks."""
+    def dumps(value):
+      start = time.time()
+      try:
+        if self.forbid_queries:
+          with models.forbid_queries():
+            return self.serializer(value, default=default, **self.kw)
+        return self.serializer(value, default=default, **self.kw)
+      finally:
+        timings.encode += time.time() - start
+    buf = []
+    buf_size = 0
+    separator = '{'
+    for key, value in mapping.iteritems():
+      buf.append('%s%s: ' % (separator, dumps(key)))
+      separator = ', '
+      if isinstance(value, Deferred):
+        value = value()
+      if not isinstance(value, StreamedList):
+        buf.append(dumps(value))
+        continue
+      item_separator = '['
+      for item in value:
+        chunk = item_separator + dumps(item)
+        item_separator = ', '
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= self.chunk_size:
+          chunk = ''.join(buf)
+          timings.size += len(chunk)
+          yield chunk
+          buf = []
+          buf_size = 0
+      buf.append('[]' if item_separator == '[' else ']')
+    buf.append('}' if separator == ', ' else '{}')
+    chunk = ''.join(buf)
+    timings.size += len(chunk)
+    yield chunk
+
+
+def json_serializer(name='auto'):
+  """Returns the named JSON serializer, or the fastest one available.
+
+  The serializers of `simplejson` (with its named tuple and decimal support
+  switched off) and the standard library's `json` produce identical output for
+  breadStore's responses. With 'auto', simplejson is used
+  if its C extension is available, then the standard library's C encoder. If
+  neither is, simplejson's pure-Python encoder is used. Other names are taken
+  as the dotted name of a callable with the signature of `json.dumps`.
+  """
+  if name == 'auto':
+    if simplejson._import_c_make_encoder() is not None:
+      return SIMPLEJSON_DUMPS
+    if json.encoder.c_make_encoder is not None:
+      return json.dumps
+    return SIMPLEJSON_DUMPS
+  if name in JSON_SERIALIZERS:
+    return JSON_SERIALIZERS[name]
+  return DottedNameResolver().resolve(name)
+
+
+def accepts_gzip(request):
+  """Returns whether the client accepts gzip compressed responses.
+
+  Clients that send no Accept-Encoding header get uncompressed responses. An
+  explicit quality for gzip takes precedence over that of the `*` wildcard.
+  """
+  qualities = {}
+  for coding in request.headers.get('Accept-Encoding', '').split(','):
+    name, _sep, params = coding.partition(';')
+    key, _sep, value = params.partition('=')
+    try:
+      quality = float(value) if key.strip().lower() == 'q' else 1.0
+    except ValueError:
+      quality = 0.0
+    qualities[name.strip().lower()] = quality
+  return qualities.get('gzip', qualities.get('*', 0.0)) > 0
+
+
+def close_iter(iterable):
+  """Closes the iterable if it supports this, e.g. a generator."""
+  close = getattr(iterable, 'close', None)
+  if close is not None:
+    close()
+
+
+def logged_iter(chunks, request, timings, source):
+  """Yields the chunks of the body, logging the timings once exhausted.
+
+  The `source` iterator of the chunks is closed when done, also when the WSGI
+  server stops writing the response early. Errors while producing the chunks
+  are logged and raised again, so that the server aborts the response rather
+  than ending a truncated body as if it were complete.
+  """
+  try:
+    for chunk in chunks:
+      yield chunk
+    timings.log(request)
+  except Exception:
+    LOG.exception(
+        'Streaming the response to %s %s failed', request.method,
+        request.path_qs)
+    raise
+  finally:
+    close_iter(source)
+
+
+def has_streamed_values(value):
+  """Returns whether the view result contains values to stream."""
+  return isinstance(value, dict) and any(
+      isinstance(item, StreamedList) for item in value.itervalues())
@@ -0,0 +1,206 @@
+"""breadStore reporting rollups, updated incrementally from status changes."""
+
+# Standard modules
+import datetime
+import itertools
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+from . import util
+
+
+def update(connection, overlap=300):
+  """Updates all rollups with the changes since their watermarks.
+
+  This runs periodically from the `rollups_breadstore` script. Changes of the
+  last `overlap` seconds before the watermarks are processed again, to include
+  transactions that committed late.
+  """
+  update_packages(connection, overlap)
+  update_customers(connection, overlap)
+
+
+def update_packages(connection, overlap):
+  """Recomputes the package rollups for days with recently processed packages.
+
+  Each affected day is recomputed in full from the processed statuses of that
+  day, which makes processing the same changes again harmless.
+  """
+  status = models.PakketStatus.__table__
+  changed = changed_since(
+      connection, status, status.c.ophaaldatum, overlap, status.c.verwerkt)
+  if not changed:
+    return
+  rollup = models.RapportagePakket.__table__
+  package = models.Pakket.__table__
+  subscription = models.Abonnement.__table__
+  cycle = models.UitgifteCyclus.__table__
+  for days in util.chunked(sorted(changed), 100):
+    connection.execute(rollup.delete().where(rollup.c.datum.in_(days)))
+    connection.execute(rollup.insert().from_select(
+        ['datum', 'locatie_id', 'pakket_grootte_id', 'uitgegeven',
+         'niet_opgehaald', 'malus'],
+        sqlalchemy.select([
+            status.c.ophaaldatum, cycle.c.locatie_id,
+            package.c.pakket_grootte_id, count_true(status.c.opgehaald),
+            count_true(~status.c.opgehaald), count_true(status.c.malus)])
+        .select_from(status.join(package).join(subscription).join(cycle))
+        .where(sqlalchemy.and_(
+            status.c.verwerkt, status.c.ophaaldatum.in_(days)))
+        .group_by(
+            status.c.ophaaldatum, cycle.c.locatie_id,
+            package.c.pakket_grootte_id)))
+  set_watermark(connection, status.name, max(changed.itervalues()))
+
+
+def update_customers(connection, overlap):
+  """Recomputes the family sizes of customers with recent status changes."""
+  status = models.KlantStatus.__table__
+  changed = changed_since(connection, status, status.c.klant_id, overlap)
+  if not changed:
+    return
+  refresh_family_sizes(connection, changed)
+  set_watermark(connection, status.name, max(changed.itervalues()))
+
+
+def refresh_family_sizes(connection, customer_ids):
+  """Recomputes the family sizes of the given (existing) customers."""
+  state = models.RapportageKlant.__table__
+  customer = models.Klant.__table__
+  family = models.Gezinslid.__table__
+  members = sqlalchemy.select([sqlalchemy.func.count()]).where(
+      family.c.klant_id == customer.c.id).as_scalar()
+  for chunk in util.chunked(set(customer_ids), 500):
+    connection.execute(state.delete().where(state.c.klant_id.in_(chunk)))
+    connection.execute(state.insert().from_select(
+        ['klant_id', 'gezinsgrootte'],
+        sqlalchemy.select([customer.c.id, members + 1])
+        .where(customer.c.id.in_(chunk))))
+
+
+def changed_since(connection, table, key, overlap, *filters):
+  """Returns the keys of rows changed since the watermark, with their times.
+
+  Rows are selected on their `update_tijd`, starting `overlap` seconds before
+  the table's watermark. The result maps each key to its latest change.
+  """
+  query = sqlalchemy.select([key, sqlalchemy.func.max(table.c.update_tijd)])
+  since = watermark(connection, table.name)
+  if since is not None:
+    since -= datetime.timedelta(seconds=overlap)
+    filters += table.c.update_tijd > since,
+  if filters:
+    query = query.where(sqlalchemy.and_(*filters))
+  return dict(connection.execute(query.group_by(key)).fetchall())
+
+
+def count_true(condition):
+  """Returns an aggregate counting the rows for which the condition holds."""
+  return sqlalchemy.func.sum(sqlalchemy.case([(condition, 1)], else_=0))
+
+
+def watermark(connection, name):
+  """Returns the watermark for the named source table, or None."""
+  marks = models.RapportageWatermerk.__table__
+  return connection.execute(
+      sqlalchemy.select([marks.c.update_tijd])
+      .where(marks.c.naam == name)).scalar()
+
+
+def set_watermark(connection, name, update_time):
+  """Moves the watermark of the named source table forward."""
+  marks = models.RapportageWatermerk.__table__
+  result = connection.execute(
+      marks.update()
+      .where(sqlalchemy.and_(
+          marks.c.naam == name, marks.c.update_tijd < update_time))
+      .values(update_tijd=update_time))
+  if not result.rowcount and watermark(connection, name) is None:
+    connection.execute(marks.insert(), naam=name, update_tijd=update_time)
+
+
+def watch(session_factory):
+  """Keeps family sizes up to date with changes made through the factory."""
+  sqlalchemy.event.listen(session_factory, 'after_flush', _after_flush)
+
+
+def _after_flush(session, _flush_context):
+  """Recomputes the family sizes of customers whose family members changed.
+
+  For members moved to another customer, both customers are recomputed.
+  """
+  customer_ids = set()
+  for obj in itertools.chain(session.new, session.dirty, session.deleted):
+    if isinstance(obj, models.Gezinslid):
+      history = sqlalchemy.inspect(obj).attrs.klant_id.history
+      customer_ids.update(history.deleted)
+      customer_ids.add(obj.klant_id)
+  customer_ids.discard(None)
+  if customer_ids:
+    refresh_family_sizes(session.connection(), customer_ids)
+
+
+# ##############################################################################
+# Reports, read from the rollups
+#
+def package_report(session, start, end, location_id=None):
+  """Returns weekly package counts per location, and totals per package size.
+
+  Counts include the days from `start` up to and including `end`.
+  """
+  rollup = models.RapportagePakket
+  query = session.query(rollup).filter(rollup.datum.between(start, end))
+  if location_id is not None:
+    query = query.filter(rollup.locatie_id == location_id)
+  weeks, sizes = {}, {}
+  for row in query:
+    year, week, _weekday = row.datum.isocalendar()
+    key = '%04d-W%02d' % (year, week), row.locatie_id
+    counts = weeks.setdefault(key, {
+        'week': key[0], 'locatie_id': row.locatie_id,
+        'uitgegeven': 0, 'niet_opgehaald': 0, 'malus': 0})
+    counts['uitgegeven'] += row.uitgegeven
+    counts['niet_opgehaald'] += row.niet_opgehaald
+    counts['malus'] += row.malus
+    sizes[row.pakket_grootte_id] = (
+        sizes.get(row.pakket_grootte_id, 0) + row.uitgegeven)
+  return {
+      'weken': [util.dict_keys_json(weeks[week]) for week in sorted(weeks)],
+      'pakketGroottes': [
+          {'pakketGrootteId': size_id, 'uitgegeven': count}
+          for size_id, count in sorted(sizes.iteritems())]}
+
+
+def customer_report(session, status='klant'):
+  """Returns customer counts per status, and family and package size counts.
+
+  The family and package sizes are counted over customers with the given
+  status, by default the active customers.
+  """
+  current = models.KlantHuidigeStatus
+  statuses = dict(
+      session.query(current.status, sqlalchemy.func.count(current.klant_id))
+      .group_by(current.status))
+  state = models.RapportageKlant
+  family_sizes = dict(
+      session.query(state.gezinsgrootte, sqlalchemy.func.count(state.klant_id))
+      .join(current, current.klant_id == state.klant_id)
+      .filter(current.status == status)
+      .group_by(state.gezinsgrootte))
+  reference = models.reference_data.get(session)
+  package_sizes = {}
+  for family_size, customers in family_sizes.iteritems():
+    size = reference.package_size(family_size)
+    if size is not None:
+      package_sizes[size.id] = package_sizes.get(size.id, 0) + customers
+  return {
+      'statussen': statuses,
+      'gezinsgroottes': [
+          {'gezinsgrootte': family_size, 'klanten': customers}
+          for family_size, customers in sorted(family_sizes.iteritems())],
+      'pakketGroottes': [
+          {'pakketGrootteId': size_id, 'klanten': customers}
+          for size_id, customers in sorted(package_sizes.iteritems())]}
@@ -2,9 +2,11 @@
 
 # Third-party modules
 from pyramid import security
+from pyramid.decorator import reify
 
 # Application modules
 from . import models
+from . import versions
 
 
 class ApiError(Exception):
@@ -25,6 +27,21 @@ class Resource(object):
       setattr(self, key, value)
 
 
+class VersionedResource(Resource):
+  """Baseclass for resources of versioned entities.
+
+  Traversal only looks up the version of the entity, which is enough to answer
+  conditional requests. The entity itself is loaded when first used. Both come
+  from the registry's entity cache where possible.
+  """
+  model = None
+
+  @property
+  def etag(self):
+    """Returns the ETag of the entity's version as found during traversal."""
+    return versions.etag(self.model, int(self.__name__), self.version)
+
+
 class Root(dict):
   """Root resource factory."""
   __parent__ = None
@@ -35,6 +52,10 @@ class Root(dict):
     self['abonnementen'] = SubscriptionCollection(
         self, 'abonnementen', request=request)
     self['klanten'] = CustomerCollection(self, 'klanten', request=request)
+    self['metrics'] = Metrics(self, 'metrics')
+    self['pakketten'] = PackageCollection(self, 'pakketten')
+    self['picklijst'] = PickList(self, 'picklijst')
+    self['rapportages'] = Reports(self, 'rapportages')
     self['session'] = Session(self, 'session')
 
   def __acl__(self):
@@ -51,27 +72,67 @@ class CustomerCollection(Resource):
     yield security.DENY_ALL
 
   def __getitem__(self, key):
-    """Loads and returns a customer based on its primary key."""
+    """Returns a customer based on its primary key."""
     if key.isdigit():
-      customer = self.request.db.query(models.Klant).get(key)
-      if customer:
-        return Customer(self, key, customer=customer)
+      version = self.request.registry.entity_cache.version(
+          self.request.db, models.Klant, key)
+      if version is not None:
+        return Customer(
+            self, key, request=self.request, customer_id=int(key),
+            version=version)
     raise KeyError
 
 
-class Customer(Resource):
+class Customer(VersionedResource):
   """Singular customer API."""
+  model = models.Klant
+
+  @reify
+  def customer(self):
+    """The customer, loaded on first use."""
+    return self.request.registry.entity_cache.get(
+        self.request.db, models.Klant, self.customer_id)
+
   def __acl__(self):
     yield 'Allow', 'priv:klant.aanpassen', 'update'
     yield 'Allow', 'priv:klant.verwijderen', 'delete'
     yield 'Allow', 'priv:abonnement.aanmaken', 'add_subscription'
 
 
+class Metrics(Resource):
+  """Request metrics per route, served only when profiling is enabled."""
+  def __acl__(self):
+    yield 'Allow', 'priv:rapportage.bekijken', 'view'
+    yield security.DENY_ALL
+
+
+class PackageCollection(Resource):
+  """Package collection exists for bulk status updates only."""
+  def __acl__(self):
+    yield 'Allow', 'priv:pakket.uitgeven', 'update'
+    yield security.DENY_ALL
+
+
+class PickList(Resource):
+  """Pick list of packages due at a location on a distribution day."""
+  def __acl__(self):
+    yield 'Allow', 'priv:pakket.uitgeven', 'view'
+    yield security.DENY_ALL
+
+
+class Reports(Resource):
+  """Management reports, served from the reporting rollups."""
+  def __acl__(self):
+    yield 'Allow', 'priv:rapportage.bekijken', 'view'
+    yield security.DENY_ALL
+
+
 class Session(Resource):
   """Login session tracker."""
   def __acl__(self):
     yield 'Allow', 'system.Everyone', 'login'
     yield 'Allow', 'system.Authenticated', 'get'
+    yield 'Allow', 'system.Authenticated', 'change_password'
     yield 'Allow', 'system.Authenticated', 'logout'
 
 
@@ -81,16 +142,27 @@ class SubscriptionCollection(Resource):
   Subscriptions can be listed/created in the context of a Customer only.
   """
   def __getitem__(self, key):
-    """Loads and returns a subscription based on its primary key."""
+    """Returns a subscription based on its primary key."""
     if key.isdigit():
-      subscription = self.request.db.query(models.Abonnement).get(key)
-      if subscription:
-        return Subscription(self, key, subscription=subscription)
+      version = self.request.registry.entity_cache.version(
+          self.request.db, models.Abonnement, key)
+      if version is not None:
+        return Subscription(
+            self, key, request=self.request, subscription_id=int(key),
+            version=version)
     raise KeyError
 
 
-class Subscription(Resource):
+class Subscription(VersionedResource):
   """Subscription API for viewing, updating and suspending of subscription."""
+  model = models.Abonnement
+
+  @reify
+  def subscription(self):
+    """The subscription, loaded on first use."""
+    return self.request.registry.entity_cache.get(
+        self.request.db, models.Abonnement, self.subscription_id)
+
   def __acl__(self):
     yield 'Allow', 'system.Authenticated', 'view'
     yield 'Allow', 'priv:abonnement.aanpassen', 'update'
@@ -0,0 +1,87 @@
+"""breadStore database routing between the primary and read replicas."""
+
+# Standard modules
+import random
+import time
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import sessions
+
+SAFE_METHODS = frozenset(['GET', 'HEAD'])
+
+
+def replica_engines(settings):
+  """Returns engines for the `breadstore.replica_urls` in the settings.
+
+  The replica engines share all other `sqlalchemy.` options with the primary.
+  """
+  return [
+      sqlalchemy.engine_from_config(dict(settings, **{'sqlalchemy.url': url}))
+      for url in settings.get('breadstore.replica_urls', '').split()]
+
+
+class RoutingSession(sessions.HoldableSession):
+  """Session that reads from a replica for as long as it does not write.
+
+  Without a `replica`, this is a regular session on the primary. Otherwise
+  SELECT statements go to the replica, and everything else (flushes, other
+  statements and connections requested without a statement) to the primary.
+  After the first write, all statements go to the primary, so the session
+  reads its own writes.
+  """
+  def __init__(self, replica=None, **kwds):
+    super(RoutingSession, self).__init__(**kwds)
+    self.replica = replica
+    self.wrote = False
+
+  def get_bind(self, mapper=None, clause=None):
+    """Returns the replica for reads, or the primary."""
+    if not isinstance(clause, sqlalchemy.sql.expression.SelectBase):
+      self.wrote = True
+    elif self.replica is not None and not self.wrote:
+      return self.replica
+    return super(RoutingSession, self).get_bind(mapper=mapper, clause=clause)
+
+
+class ReplicaRouter(object):
+  """Picks the database for the session of a request.
+
+  Sessions for safe (GET and HEAD) requests read from a randomly chosen
+  replica. Clients that wrote to the primary are sent a cookie that keeps
+  their requests on the primary for `sticky_seconds`, so they read their own
+  writes while the replicas catch up.
+  """
+  COOKIE_NAME = 'bs_primary'
+
+  def __init__(self, replicas=(), sticky_seconds=10):
+    self.replicas = list(replicas)
+    self.sticky_seconds = sticky_seconds
+
+  def session(self, session_factory, request):
+    """Returns a new session from the factory, routed for the request."""
+    replica = None
+    if (self.replicas and request.method in SAFE_METHODS and
+        not self.sticky(request)):
+      replica = random.choice(self.replicas)
+    session = session_factory(replica=replica)
+    if self.replicas:
+      request.add_response_callback(
+          lambda request, response: self.stick(session, response))
+    return session
+
+  def sticky(self, request):
+    """Returns whether the client should stay on the primary."""
+    try:
+      return float(request.cookies.get(self.COOKIE_NAME, 0)) > time.time()
+    except ValueError:
+      return False
+
+  def stick(self, session, response):
+    """Keeps the client on the primary for a while if the session wrote."""
+    if session.wrote:
+      response.set_cookie(
+          self.COOKIE_NAME, str(int(time.time()) + self.sticky_seconds),
+          max_age=self.sticky_seconds, httponly=True)
@@ -2,6 +2,7 @@
 
 # Third-party modules
 import colander
+import simplejson
 
 # Application modules
 from . import resources
@@ -22,6 +23,56 @@ def load(schema, request, content_type='application/json'):
   return schema().deserialize(util.dict_keys_python(values))
 
 
+def load_many(schema, request):
+  """Deserializes a JSON array or NDJSON request body record by record.
+
+  Returns a list of (index, values) tuples for the records that are valid
+  according to the Colander schema, and a list of errors for all others.
+  """
+  if request.content_type == 'application/x-ndjson':
+    records = ndjson_records(request.body_file)
+  elif request.content_type == 'application/json':
+    try:
+      records = request.json_body
+    except ValueError:
+      raise resources.ApiError('Cannot deserialize request body, invalid JSON.')
+    if not isinstance(records, list):
+      raise resources.ApiError('Request body must be a list of records.')
+    records = [(record, None) for record in records]
+  else:
+    raise resources.ApiError(
+        'content_type must be application/json or application/x-ndjson',
+        code=415)
+  node = schema()
+  valid, errors = [], []
+  for index, (record, error) in enumerate(records):
+    if error is None and not isinstance(record, dict):
+      error = 'Record must be a JSON object.'
+    if error is not None:
+      errors.append({'index': index, 'error': error})
+      continue
+    try:
+      valid.append((index, node.deserialize(util.dict_keys_python(record))))
+    except colander.Invalid as err:
+      errors.append({'index': index, 'invalid': err.asdict()})
+  return valid, errors
+
+
+def ndjson_records(body_file):
+  """Yields (record, error) tuples for all non-empty lines in the body."""
+  for line in body_file:
+    if line.strip():
+      try:
+        yield simplejson.loads(line), None
+      except ValueError:
+        yield None, 'Cannot deserialize record, invalid JSON.'
+
+
+def load_params(schema, request):
+  """Deserializes the query string parameters according to the given schema."""
+  return schema().deserialize(util.dict_keys_python(request.GET.mixed()))
+
+
 class Customer(colander.MappingSchema):
   """Schema for a customer, creation and/or updates."""
   klantcode = colander.SchemaNode(
@@ -60,12 +111,133 @@ class Customer(colander.MappingSchema):
       validator=colander.Length(max=32))
 
 
+class CustomerListing(colander.MappingSchema):
+  """Schema for the pagination and filter parameters of the customer list."""
+  limit = colander.SchemaNode(
+      colander.Integer(),
+      missing=50,
+      validator=colander.Range(min=1, max=500))
+  after = colander.SchemaNode(
+      colander.String(),
+      missing=None)
+  sort = colander.SchemaNode(
+      colander.String(),
+      missing='id',
+      validator=colander.OneOf(['id', 'achternaam', 'adres_postcode']))
+  postcode = colander.SchemaNode(
+      colander.String(),
+      missing=None,
+      validator=colander.Length(max=6))
+  plaats = colander.SchemaNode(
+      colander.String(),
+      missing=None,
+      validator=colander.Length(max=32))
+  achternaam = colander.SchemaNode(
+      colander.String(),
+      missing=None,
+      validator=colander.Length(max=32))
+  status = colander.SchemaNode(
+      colander.String(),
+      missing=None,
+      validator=colander.OneOf([
+          'nieuw', 'afgewezen', 'doorverwezen', 'klant',
+          'verhuisd', 'regulier beeindigd', 'weggestuurd']))
+  totaal = colander.SchemaNode(
+      colander.Boolean(),
+      missing=False)
+
+
 class Login(colander.MappingSchema):
   """Schema for logging in, requires a login name and password."""
   login = colander.SchemaNode(colander.String())
   password = colander.SchemaNode(colander.String())
 
 
+class PasswordChange(colander.MappingSchema):
+  """Schema for a new password, requires the current password as well."""
+  password = colander.SchemaNode(colander.String())
+  new_password = colander.SchemaNode(colander.String())
+
+
+class CustomerSearch(colander.MappingSchema):
+  """Schema for the parameters of the customer search."""
+  q = colander.SchemaNode(
+      colander.String(),
+      validator=colander.Length(min=2, max=100))
+  limit = colander.SchemaNode(
+      colander.Integer(),
+      missing=10,
+      validator=colander.Range(min=1, max=50))
+
+
+class PackageStatus(colander.MappingSchema):
+  """Schema for a new package status, recorded at checkout by default.
+
+  The pickup date defaults to today, the staff member to the current user.
+  """
+  pakket_id = colander.SchemaNode(
+      colander.Integer())
+  ophaaldatum = colander.SchemaNode(
+      colander.Date(),
+      missing=None)
+  verwerkt = colander.SchemaNode(
+      colander.Boolean(),
+      missing=True)
+  opgehaald = colander.SchemaNode(
+      colander.Boolean(),
+      missing=True)
+  malus = colander.SchemaNode(
+      colander.Boolean(),
+      missing=False)
+  medewerker_id = colander.SchemaNode(
+      colander.Integer(),
+      missing=None)
+
+
+class Photo(colander.MappingSchema):
+  """Schema for the parameters of a customer photo request."""
+  breedte = colander.SchemaNode(
+      colander.Integer(),
+      missing=None,
+      validator=colander.Range(min=16, max=1024))
+
+
+class PickList(colander.MappingSchema):
+  """Schema for the location and date (default today) of a pick list."""
+  locatie = colander.SchemaNode(
+      colander.Integer())
+  datum = colander.SchemaNode(
+      colander.Date(),
+      missing=None)
+
+
+class CustomerReport(colander.MappingSchema):
+  """Schema for the customer report, sizes are counted for the given status."""
+  status = colander.SchemaNode(
+      colander.String(),
+      missing='klant')
+
+
+class PackageReport(colander.MappingSchema):
+  """Schema for the period and optional location of the package report."""
+  van = colander.SchemaNode(
+      colander.Date(),
+      missing=None)
+  tot = colander.SchemaNode(
+      colander.Date(),
+      missing=None)
+  locatie = colander.SchemaNode(
+      colander.Integer(),
+      missing=None)
+
+
+class SubscriptionListing(colander.MappingSchema):
+  """Schema for the filter parameters of the subscription list."""
+  afgerond = colander.SchemaNode(
+      colander.Boolean(),
+      missing=None)
+
+
 class Subscription(colander.MappingSchema):
   """Schema to create or update an existing susbcription.
 
@@ -0,0 +1,66 @@
+# Standard modules
+import json
+import os
+import sys
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+
+# Application modules
+from .. import benchmarks
+from ..benchmarks import cases
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [login=benchmark] [password=benchmark]\n'
+        '       [repeat=50] [warmup=5] [cases=name,...] [output=file]\n'
+        '       [baseline=file] [threshold=0.2]\n'
+        '(example: "%s development.ini output=benchmark.json")' % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+
+  paster.setup_logging(config_uri)
+  settings = paster.get_appsettings(config_uri, options=options)
+  selected = cases.CASES
+  if options.get('cases'):
+    names = options['cases'].split(',')
+    selected = [(name, case) for name, case in cases.CASES if name in names]
+  harness = cases.Harness(
+      settings,
+      options.get('login', 'benchmark'),
+      options.get('password', 'benchmark'))
+  results = benchmarks.run(
+      selected, harness,
+      repeat=int(options.get('repeat', 50)),
+      warmup=int(options.get('warmup', 5)))
+  print_results(results)
+  if options.get('output'):
+    with open(options['output'], 'w') as output:
+      json.dump(results, output, indent=2, sort_keys=True)
+  if options.get('baseline'):
+    with open(options['baseline']) as baseline:
+      regressions = benchmarks.compare(
+          results, json.load(baseline),
+          threshold=float(options.get('threshold', 0.2)))
+    for name, previous, current, ratio in regressions:
+      print('Regression in %s: %.3fms -> %.3fms (%.2fx)' % (
+          name, previous, current, ratio))
+    if regressions:
+      sys.exit(1)
+
+
+def print_results(results):
+  """Prints the timings of all cases as a table."""
+  print('%-26s %10s %10s %10s %10s' % ('case', 'min', 'median', 'mean', 'p95'))
+  for name, timings in sorted(results['cases'].iteritems()):
+    print('%-26s %10.3f %10.3f %10.3f %10.3f' % (
+        name, timings['min_ms'], timings['median_ms'], timings['mean_ms'],
+        timings['p95_ms']))
@@ -0,0 +1,240 @@
+# Standard modules
+import csv
+import datetime
+import gzip
+import os
+import sys
+import time
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+import sqlalchemy
+
+# Application modules
+from .. import models
+from .. import renderers
+from .. import routing
+from .. import util
+
+CSV_TABLES = 'klant', 'gezinslid', 'abonnement', 'pakket', 'pakket_status'
+FORMATS = 'csv', 'ndjson'
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [format=ndjson|csv] [output=path]\n'
+        '       [gzip=true] [batch_size=1000]\n'
+        '(example: "%s production.ini format=csv output=export gzip=true")\n'
+        'NDJSON is written to the output file (default: stdout), CSV to one\n'
+        'file per table in the output directory (default: current).'
+        % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+  export_format = options.get('format', 'ndjson')
+  if export_format not in FORMATS:
+    usage(argv)
+
+  paster.setup_logging(config_uri)
+  settings = paster.get_appsettings(config_uri, options=options)
+  engine = (routing.replica_engines(settings) or
+            [sqlalchemy.engine_from_config(settings, 'sqlalchemy.')])[0]
+  exporter = Exporter(engine, batch_size=int(options.get('batch_size', 1000)))
+  compress = options.get('gzip') == 'true'
+  start = time.time()
+  if export_format == 'csv':
+    directory = options.get('output', '.')
+    for table in CSV_TABLES:
+      filename = os.path.join(directory, table + '.csv')
+      with open_output(filename, compress) as output:
+        count = exporter.write_csv(table, output)
+      report('%d rows of %s' % (count, table), start)
+  else:
+    with open_output(options.get('output', '-'), compress) as output:
+      count = exporter.write_ndjson(output)
+    report('%d customers' % count, start)
+
+
+def open_output(filename, compress=False):
+  """Opens the named file (or stdout for '-') for writing, optionally gzipped.
+
+  Gzipped files are given the .gz extension, if they do not have it already.
+  """
+  if filename == '-':
+    output = os.fdopen(os.dup(sys.stdout.fileno()), 'wb')
+    return gzip.GzipFile(fileobj=output, mode='wb') if compress else output
+  if compress:
+    if not filename.endswith('.gz'):
+      filename += '.gz'
+    return gzip.open(filename, 'wb')
+  return open(filename, 'wb')
+
+
+def report(message, start):
+  """Writes progress to stderr, so that stdout can carry the export."""
+  sys.stderr.write('Exported %s in %.1fs.\n' % (message, time.time() - start))
+
+
+class Exporter(object):
+  """Streams customers with their related data out of the database.
+
+  Every table is read through its own connection, with a server-side cursor
+  (`stream_results`) fetching `batch_size` rows at a time. Related rows are
+  attached by merging streams that are sorted on the same key, rather than
+  by querying per customer, so memory use does not grow with the export.
+
+  As the tables are read in separate transactions, writes made while the
+  export runs may show up in some tables and not in others.
+  """
+  def __init__(self, engine, batch_size=1000):
+    self.engine = engine
+    self.batch_size = batch_size
+    self.tables = models.Base.metadata.tables
+
+  def stream(self, query):
+    """Yields the rows of the query, fetched in batches from a cursor."""
+    conn = self.engine.connect().execution_options(stream_results=True)
+    try:
+      result = conn.execute(query)
+      while True:
+        rows = result.fetchmany(self.batch_size)
+        if not rows:
+          break
+        for row in rows:
+          yield row
+    finally:
+      conn.close()
+
+  def write_csv(self, name, output):
+    """Writes all rows of the named table as CSV, returns the row count."""
+    table = self.tables[name]
+    writer = csv.writer(output)
+    writer.writerow([column.name for column in table.columns])
+    count = 0
+    for row in self.stream(table.select().order_by(*table.primary_key)):
+      writer.writerow([csv_value(value) for value in row])
+      count += 1
+    return count
+
+  def write_ndjson(self, output):
+    """Writes a JSON document per customer, returns the customer count.
+
+    Each document holds the customer's columns, the family members as
+    `gezin` and the subscriptions as `abonnementen`. Subscriptions contain
+    their `pakketten`, and packages their `statussen`.
+    """
+    serializer = renderers.json_serializer()
+    count = 0
+    for customer in self.customers():
+      output.write(serializer(customer, default=json_default))
+      output.write('\n')
+      count += 1
+    return count
+
+  def customers(self):
+    """Yields customer documents, merging the streams of related tables."""
+    customer, family = self.tables['klant'], self.tables['gezinslid']
+    customers = self.stream(customer.select().order_by(customer.c.id))
+    families = self.stream(family.select().order_by(
+        family.c.klant_id, family.c.id))
+    to_customer = json_document(customer)
+    to_member = json_document(family)
+    subscriptions = merge_join(
+        merge_join(customers, families, lambda row: row.id,
+                   lambda row: row.klant_id),
+        self.subscriptions(), lambda pair: pair[0].id,
+        lambda subscription: subscription['klantId'])
+    for (row, members), customer_subscriptions in subscriptions:
+      document = to_customer(row)
+      document['gezin'] = map(to_member, members)
+      document['abonnementen'] = customer_subscriptions
+      yield document
+
+  def subscriptions(self):
+    """Yields subscription documents with packages, ordered by customer."""
+    subscription = self.tables['abonnement']
+    package, status = self.tables['pakket'], self.tables['pakket_status']
+    subscriptions = self.stream(subscription.select().order_by(
+        subscription.c.klant_id, subscription.c.id))
+    packages = self.stream(sqlalchemy.select(
+        [package, subscription.c.klant_id],
+        package.c.abonnement_id == subscription.c.id).order_by(
+            subscription.c.klant_id, package.c.abonnement_id, package.c.id))
+    statuses = self.stream(sqlalchemy.select(
+        [status, subscription.c.klant_id, package.c.abonnement_id],
+        sqlalchemy.and_(status.c.pakket_id == package.c.id,
+                        package.c.abonnement_id == subscription.c.id)
+    ).order_by(subscription.c.klant_id, package.c.abonnement_id,
+               status.c.pakket_id, status.c.id))
+    to_subscription = json_document(subscription)
+    to_package = json_document(package)
+    to_status = json_document(status)
+    packages = merge_join(
+        packages, statuses,
+        lambda row: (row.klant_id, row.abonnement_id, row.id),
+        lambda row: (row.klant_id, row.abonnement_id, row.pakket_id))
+    for row, package_rows in merge_join(
+        subscriptions, packages, lambda row: (row.klant_id, row.id),
+        lambda pair: (pair[0].klant_id, pair[0].abonnement_id)):
+      document = to_subscription(row)
+      document['pakketten'] = []
+      for package_row, status_rows in package_rows:
+        package_document = to_package(package_row)
+        package_document['statussen'] = map(to_status, status_rows)
+        document['pakketten'].append(package_document)
+      yield document
+
+
+def merge_join(parents, children, parent_key, child_key):
+  """Yields every parent with the list of its children.
+
+  Both iterables must be sorted on their key. Children without a parent are
+  skipped, so that only the children of a single parent are held in memory.
+  """
+  children = iter(children)
+  child = next(children, None)
+  for parent in parents:
+    key = parent_key(parent)
+    matched = []
+    while child is not None and child_key(child) <= key:
+      if child_key(child) == key:
+        matched.append(child)
+      child = next(children, None)
+    yield parent, matched
+
+
+def json_document(table):
+  """Returns a converter from rows of the table to dicts with camelCase keys.
+
+  Only the table's own columns are included, not those joined for ordering.
+  """
+  keys = [(column.name, util.case_transform_json(column.name))
+          for column in table.columns]
+
+  def converter(row):
+    return dict((json_key, row[name]) for name, json_key in keys)
+  return converter
+
+
+def json_default(value):
+  """Converts dates and datetimes to their ISO format."""
+  if isinstance(value, datetime.date):
+    return value.isoformat()
+  raise TypeError('%r is not JSON serializable' % value)
+
+
+def csv_value(value):
+  """Returns the value as written to a CSV file."""
+  if value is None:
+    return ''
+  if isinstance(value, unicode):
+    return value.encode('utf8')
+  if isinstance(value, datetime.date):
+    return value.isoformat()
+  return value
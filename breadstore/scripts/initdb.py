@@ -10,6 +10,9 @@ import sqlalchemy.orm
 
 # Application modules
 from .. import models
+from .. import photos
+from .. import picklist
+from .. import statuses
 
 
 def usage(argv):
@@ -31,3 +34,16 @@ def main(argv=sys.argv):
   if options.get('recreate') == 'true':
     models.Base.metadata.drop_all(engine)
   models.Base.metadata.create_all(engine)
+  seed_sequences(engine)
+  with engine.begin() as conn:
+    statuses.rebuild(conn)
+    picklist.rebuild(conn)
+    photos.fill_metadata(conn)
+
+
+def seed_sequences(engine):
+  """Creates the rows of sequence tables, if they do not exist yet."""
+  sequence = models.KlantcodeReeks.__table__
+  with engine.begin() as conn:
+    if conn.execute(sequence.select()).first() is None:
+      conn.execute(sequence.insert(), id=1, volgende=0)
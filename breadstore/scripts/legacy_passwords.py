@@ -0,0 +1,46 @@
+# Standard modules
+import os
+import sys
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+import sqlalchemy
+
+# Application modules
+from .. import models
+from .. import passwords
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [flag=true] [var=value]\n'
+        '(example: "%s development.ini flag=true")' % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+
+  paster.setup_logging(config_uri)
+  settings = paster.get_appsettings(config_uri, options=options)
+  engine = sqlalchemy.engine_from_config(settings, 'sqlalchemy.')
+  staff = models.Medewerker.__table__
+  legacy = legacy_hash_filter()
+  with engine.begin() as conn:
+    count = conn.execute(sqlalchemy.select([sqlalchemy.func.count()])
+                         .select_from(staff).where(legacy)).scalar()
+    print('%d account(s) with a legacy password hash.' % count)
+    if count and options.get('flag') == 'true':
+      conn.execute(staff.update().where(legacy).values(wachtwoord_herzien=True))
+      print('Flagged %d account(s) for a forced password rehash.' % count)
+
+
+def legacy_hash_filter():
+  """Returns a filter selecting staff whose password is a legacy hash."""
+  password = models.Medewerker.__table__.c.wachtwoord
+  return sqlalchemy.not_(sqlalchemy.or_(*(
+      password.startswith(prefix) for prefix in passwords.BCRYPT_PREFIXES)))
@@ -0,0 +1,39 @@
+# Standard modules
+import os
+import sys
+import time
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+import sqlalchemy
+
+# Application modules
+from .. import reporting
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [overlap=300] [interval=seconds]\n'
+        '(example: "%s production.ini interval=60")\n'
+        'Without an interval, the rollups are updated once.' % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+
+  paster.setup_logging(config_uri)
+  settings = paster.get_appsettings(config_uri, options=options)
+  engine = sqlalchemy.engine_from_config(settings, 'sqlalchemy.')
+  overlap = int(options.get('overlap', 300))
+  interval = int(options.get('interval', 0))
+  while True:
+    with engine.begin() as conn:
+      reporting.update(conn, overlap)
+    if not interval:
+      break
+    time.sleep(interval)
@@ -0,0 +1,325 @@
+# Standard modules
+import datetime
+import os
+import random
+import sys
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+import sqlalchemy
+
+# Application modules
+from .. import models
+from .. import passwords
+from .. import picklist
+from .. import planning
+from .. import reporting
+from .. import statuses
+from .. import util
+from . import initdb
+
+PERMISSIONS = (
+    'abonnement.aanmaken', 'abonnement.aanpassen', 'abonnement.dieet.beheren',
+    'abonnement.stoppen', 'klant.aanmaken', 'klant.aanpassen',
+    'klant.verwijderen', 'pakket.uitgeven', 'rapportage.bekijken')
+VOLUNTEER_PERMISSIONS = 'klant.aanmaken', 'klant.aanpassen', 'pakket.uitgeven'
+FIRST_NAMES = (
+    u'Anna', u'Bram', u'Daan', u'Emma', u'Fatima', u'Jan', u'Julia', u'Lars',
+    u'Mohammed', u'Noah', u'Sanne', u'Sem', u'Sophie', u'Tess', u'Yusuf')
+LAST_NAMES = (
+    (u'', u'Bakker'), (u'', u'Bos'), (u'van', u'Dijk'), (u'de', u'Groot'),
+    (u'', u'Jansen'), (u'van der', u'Linden'), (u'', u'Meijer'),
+    (u'', u'Mulder'), (u'', u'Peters'), (u'de', u'Vries'), (u'', u'Visser'),
+    (u'', u'Yilmaz'), (u'', u'El Amrani'), (u'van', u'Leeuwen'))
+PLACES = u'Amersfoort', u'Hilversum', u'Utrecht', u'Zeist'
+STREETS = u'Dorpsstraat', u'Kerkstraat', u'Molenweg', u'Stationsplein'
+LOCATIONS = u'Centrum', u'Noord', u'Zuid'
+PACKAGE_SIZES = ('A', 1, u'Klein'), ('B', 3, u'Middel'), ('C', 5, u'Groot')
+DIETS = (
+    (u'Halal', 'groen'), (u'Vegetarisch', 'geel'), (u'Glutenvrij', 'rood'),
+    (u'Lactosevrij', 'blauw'))
+TABLE_ORDER = (
+    'klant', 'gezinslid', 'klant_status', 'abonnement', 'abonnement_dieet',
+    'pakket', 'pakket_status')
+REFERENCE_TABLES = (
+    'permissie', 'rol', 'medewerker', 'locatie', 'uitgifte_cyclus',
+    'pakket_grootte', 'dieet')
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [customers=100000] [staff=25] [seed=1]\n'
+        '       [password=benchmark] [recreate=true]\n'
+        '(example: "%s development.ini customers=1000")\n'
+        'Seeding requires an empty database, or recreate=true to drop all\n'
+        'existing data first.' % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+
+  paster.setup_logging(config_uri)
+  settings = paster.get_appsettings(config_uri, options=options)
+  engine = sqlalchemy.engine_from_config(settings, 'sqlalchemy.')
+  if options.get('recreate') == 'true':
+    models.Base.metadata.drop_all(engine)
+  models.Base.metadata.create_all(engine)
+  filled = filled_tables(engine)
+  if filled:
+    print('The database already holds data (in %s); use recreate=true to '
+          'replace it.' % ', '.join(filled))
+    sys.exit(1)
+  initdb.seed_sequences(engine)
+  rng = random.Random(int(options.get('seed', 1)))
+  customers = int(options.get('customers', 100000))
+  reference = seed_reference_data(
+      engine, rng, staff_count=int(options.get('staff', 25)),
+      password=options.get('password', 'benchmark'))
+  first_code = models.reserve_customer_codes(engine, customers)
+  with engine.begin() as conn:
+    writer = BulkWriter(conn)
+    for number in xrange(customers):
+      add_customer(
+          writer, rng, reference, util.sequence_customer_code(
+              first_code + number))
+    writer.flush()
+  print('Seeded %d customers with %s.' % (customers, ', '.join(
+      '%d %s' % (count, table) for table, count in writer.counts())))
+  with engine.begin() as conn:
+    statuses.rebuild(conn)
+    picklist.rebuild(conn)
+    reporting.update(conn, overlap=0)
+
+
+def seed_reference_data(engine, rng, staff_count, password):
+  """Inserts permissions, roles, staff, locations and the other lookup data.
+
+  The staff member with login "benchmark" has all permissions, the others are
+  volunteers. They all share the given password, which is hashed only once.
+  Returns the inserted data needed to generate customers.
+  """
+  tables = models.Base.metadata.tables
+  with engine.begin() as conn:
+    permission_ids = dict(zip(
+        PERMISSIONS, next_ids(conn, 'permissie', len(PERMISSIONS))))
+    conn.execute(tables['permissie'].insert(), [
+        {'id': permission_id, 'naam': name, 'omschrijving': u''}
+        for name, permission_id in permission_ids.iteritems()])
+    admin_role, volunteer_role = next_ids(conn, 'rol', 2)
+    conn.execute(tables['rol'].insert(), [
+        {'id': admin_role, 'naam': 'beheerder', 'omschrijving': u''},
+        {'id': volunteer_role, 'naam': 'vrijwilliger', 'omschrijving': u''}])
+    conn.execute(tables['rol_permissie'].insert(), [
+        {'rol_id': admin_role, 'permissie_id': permission_id}
+        for permission_id in permission_ids.itervalues()] + [
+        {'rol_id': volunteer_role, 'permissie_id': permission_ids[name]}
+        for name in VOLUNTEER_PERMISSIONS])
+    pw_hash = passwords.hash_password(password.encode('utf8'))
+    staff_ids = next_ids(conn, 'medewerker', staff_count + 1)
+    conn.execute(tables['medewerker'].insert(), [{
+        'id': staff_id,
+        'naam': u'Medewerker %d' % number,
+        'email_adres': 'medewerker%d@example.org' % number,
+        'rol_id': volunteer_role if number else admin_role,
+        'login': 'medewerker%d' % number if number else 'benchmark',
+        'wachtwoord': pw_hash} for number, staff_id in enumerate(staff_ids)])
+    location_ids = next_ids(conn, 'locatie', len(LOCATIONS))
+    conn.execute(tables['locatie'].insert(), [
+        {'id': location_id, 'naam': name}
+        for location_id, name in zip(location_ids, LOCATIONS)])
+    cycles = []
+    cycle_ids = iter(next_ids(conn, 'uitgifte_cyclus', 2 * len(LOCATIONS)))
+    for location_id in location_ids:
+      for weekday in rng.sample(range(1, 6), 2):
+        cycles.append({
+            'id': next(cycle_ids), 'omschrijving': u'Uitgifte %d' % weekday,
+            'ophaaldag': weekday, 'locatie_id': location_id,
+            'kleur': '%06x' % rng.randrange(0x1000000)})
+    conn.execute(tables['uitgifte_cyclus'].insert(), cycles)
+    size_ids = next_ids(conn, 'pakket_grootte', len(PACKAGE_SIZES))
+    conn.execute(tables['pakket_grootte'].insert(), [
+        {'id': size_id, 'code': code, 'min_gezinsgrootte': minimum,
+         'omschrijving': description}
+        for size_id, (code, minimum, description) in zip(
+            size_ids, PACKAGE_SIZES)])
+    diet_ids = next_ids(conn, 'dieet', len(DIETS))
+    conn.execute(tables['dieet'].insert(), [
+        {'id': diet_id, 'naam': name, 'sticker_kleur': color}
+        for diet_id, (name, color) in zip(diet_ids, DIETS)])
+    return {
+        'cycles': cycles,
+        'diets': diet_ids,
+        'sizes': zip([minimum for _code, minimum, _desc in PACKAGE_SIZES],
+                     size_ids),
+        'staff': staff_ids,
+        'ids': dict((table, next_id(conn, table)) for table in TABLE_ORDER
+                    if table != 'abonnement_dieet')}
+
+
+def add_customer(writer, rng, reference, code):
+  """Adds a customer with family, status history and subscriptions."""
+  today = datetime.date.today()
+  customer_id = allocate_id(reference, 'klant')
+  prefix, last_name = rng.choice(LAST_NAMES)
+  registered = today - datetime.timedelta(days=rng.randint(0, 2 * 365))
+  writer.add('klant', {
+      'id': customer_id,
+      'klantcode': code,
+      'voorletters': u'%s.' % rng.choice(FIRST_NAMES)[0],
+      'tussenvoegsel': prefix,
+      'achternaam': last_name,
+      'geslacht': rng.choice(('man', 'vrouw', 'onbekend')),
+      'geboorte_datum': today - datetime.timedelta(
+          days=rng.randint(18 * 365, 85 * 365)),
+      'email_adres': None,
+      'adres_straat': u'%s %d' % (rng.choice(STREETS), rng.randint(1, 200)),
+      'adres_postcode': '%04d%s' % (rng.randint(1000, 9999), ''.join(
+          rng.choice('ABCDEFGHJKLMNPRSTVWXZ') for _ in range(2))),
+      'adres_plaats': rng.choice(PLACES)})
+  family_size = rng.choice((1, 1, 2, 2, 3, 3, 4, 4, 5, 6, 7))
+  for member in xrange(family_size - 1):
+    writer.add('gezinslid', {
+        'id': allocate_id(reference, 'gezinslid'),
+        'klant_id': customer_id,
+        'naam': u'%s %s' % (rng.choice(FIRST_NAMES), member),
+        'geboorte_datum': today - datetime.timedelta(
+            days=rng.randint(0, 80 * 365)),
+        'geslacht': rng.choice(('man', 'vrouw'))})
+  history = ['nieuw', rng.choice(
+      ('klant',) * 8 + ('afgewezen', 'doorverwezen', 'verhuisd'))]
+  for days, status in enumerate(history):
+    writer.add('klant_status', {
+        'id': allocate_id(reference, 'klant_status'),
+        'klant_id': customer_id,
+        'status': status,
+        'opmerking': u'',
+        'wijzigingsdatum': registered + datetime.timedelta(days=days * 7),
+        'medewerker_id': rng.choice(reference['staff'])})
+  if history[-1] == 'klant':
+    start = registered + datetime.timedelta(days=7)
+    size_id = [size for minimum, size in reference['sizes']
+               if minimum <= family_size][-1]
+    for _subscription in xrange(rng.choice((1, 1, 2))):
+      if start > today:
+        break
+      start = add_subscription(
+          writer, rng, reference, customer_id, start, size_id)
+
+
+def add_subscription(writer, rng, reference, customer_id, start, size_id):
+  """Adds a subscription with its packages and their status history.
+
+  Packages planned before today have been processed, most of them collected.
+  Returns the date after the last package, when a next subscription starts.
+  """
+  today = datetime.date.today()
+  subscription_id = allocate_id(reference, 'abonnement')
+  cycle = rng.choice(reference['cycles'])
+  count = 12
+  dates = planning.pickup_dates(start, cycle['ophaaldag'], count, {})
+  writer.add('abonnement', {
+      'id': subscription_id,
+      'klant_id': customer_id,
+      'uitgifte_cyclus_id': cycle['id'],
+      'datum_start': start,
+      'datum_einde': dates[-1] if dates[-1] < today else None,
+      'pakket_aantal': count,
+      'opmerking': u''})
+  if rng.random() < 0.2:
+    writer.add('abonnement_dieet', {
+        'abonnement_id': subscription_id,
+        'dieet_id': rng.choice(reference['diets'])})
+  staff_id = rng.choice(reference['staff'])
+  for number, date in enumerate(dates, 1):
+    package_id = allocate_id(reference, 'pakket')
+    writer.add('pakket', {
+        'id': package_id,
+        'abonnement_id': subscription_id,
+        'volgnummer': number,
+        'pakket_grootte_id': size_id})
+    writer.add('pakket_status', {
+        'id': allocate_id(reference, 'pakket_status'),
+        'pakket_id': package_id,
+        'ophaaldatum': date,
+        'verwerkt': False,
+        'opgehaald': False,
+        'malus': False,
+        'medewerker_id': staff_id})
+    if date < today:
+      collected = rng.random() < 0.9
+      writer.add('pakket_status', {
+          'id': allocate_id(reference, 'pakket_status'),
+          'pakket_id': package_id,
+          'ophaaldatum': date,
+          'verwerkt': True,
+          'opgehaald': collected,
+          'malus': not collected and rng.random() < 0.5,
+          'medewerker_id': rng.choice(reference['staff'])})
+  return dates[-1] + datetime.timedelta(days=rng.randint(7, 60))
+
+
+class BulkWriter(object):
+  """Buffers rows per table, and inserts them in batches.
+
+  All buffers are written at once, in foreign key order, whenever one of them
+  holds `batch_size` rows.
+  """
+  def __init__(self, connection, batch_size=5000):
+    self.connection = connection
+    self.batch_size = batch_size
+    self._rows = dict((table, []) for table in TABLE_ORDER)
+    self._counts = dict.fromkeys(TABLE_ORDER, 0)
+
+  def add(self, table, row):
+    """Adds a row for the table, writing all buffers if this one is full."""
+    rows = self._rows[table]
+    rows.append(row)
+    if len(rows) >= self.batch_size:
+      self.flush()
+
+  def counts(self):
+    """Returns the number of rows written per table."""
+    return [(table, self._counts[table]) for table in TABLE_ORDER]
+
+  def flush(self):
+    """Writes the buffered rows of all tables."""
+    tables = models.Base.metadata.tables
+    for table in TABLE_ORDER:
+      rows = self._rows[table]
+      if rows:
+        self.connection.execute(tables[table].insert(), rows)
+        self._counts[table] += len(rows)
+        del rows[:]
+
+
+def filled_tables(engine):
+  """Returns the names of the tables written by seeding that hold rows."""
+  tables = models.Base.metadata.tables
+  with engine.connect() as conn:
+    return [name for name in REFERENCE_TABLES + TABLE_ORDER
+            if conn.execute(tables[name].select().limit(1)).first()]
+
+
+def allocate_id(reference, table):
+  """Returns the next primary key for a generated row of the table."""
+  ident = reference['ids'][table]
+  reference['ids'][table] += 1
+  return ident
+
+
+def next_id(conn, table):
+  """Returns the first unused primary key value of the table."""
+  key = models.Base.metadata.tables[table].c.id
+  return (conn.execute(sqlalchemy.select([sqlalchemy.func.max(key)]))
+          .scalar() or 0) + 1
+
+
+def next_ids(conn, table, count):
+  """Returns `count` unused primary key values for the table."""
+  first = next_id(conn, table)
+  return range(first, first + count)
@@ -0,0 +1,152 @@
+# Standard modules
+import errno
+import gc
+import logging
+import multiprocessing
+import os
+import random
+import signal
+import socket
+import sys
+import time
+
+# Third-party modules
+from pyramid import paster
+from pyramid.scripts import common
+import sqlalchemy.orm
+import waitress
+
+# Application modules
+from .. import models
+
+LOG = logging.getLogger(__name__)
+
+
+def usage(argv):
+  cmd = os.path.basename(argv[0])
+  print('usage: %s <config_uri> [host=0.0.0.0] [port=6543] [workers=N]\n'
+        '       [threads=4] [var=value]\n'
+        '(example: "%s production.ini workers=4")\n'
+        'The number of workers defaults to the number of CPUs.' % (cmd, cmd))
+  sys.exit(1)
+
+
+def main(argv=sys.argv):
+  if len(argv) < 2:
+    usage(argv)
+  config_uri = argv[1]
+  options = common.parse_vars(argv[2:])
+
+  paster.setup_logging(config_uri)
+  start = time.time()
+  env = paster.bootstrap(config_uri, options=options)
+  try:
+    warm(env['request'])
+  finally:
+    env['closer']()
+  dispose_engines(env['registry'])
+  LOG.info('Application loaded and warmed in %.2fs.', time.time() - start)
+  sock = listen(options.get('host', '0.0.0.0'), int(options.get('port', 6543)))
+  Arbiter(
+      env['app'], sock,
+      workers=int(options.get('workers', multiprocessing.cpu_count())),
+      threads=int(options.get('threads', 4))).run()
+
+
+def warm(request):
+  """Does the work that would otherwise fall on the first requests.
+
+  This configures the mappers (compiling their JSON serializers), and loads
+  the reference data and the customer search index. All of this is then
+  shared by the forked workers.
+  """
+  sqlalchemy.orm.configure_mappers()
+  session = request.db
+  try:
+    models.reference_data.get(session)
+    request.registry.customer_index.warm(session)
+  finally:
+    session.close()
+
+
+def dispose_engines(registry):
+  """Closes the pooled connections of the primary and replica engines.
+
+  Workers must not share the connections of the master, so these are closed
+  before forking. Each worker opens connections of its own when first needed.
+  """
+  registry.dbmaker.kw['bind'].dispose()
+  for engine in registry.replica_router.replicas:
+    engine.dispose()
+
+
+def listen(host, port, backlog=1024):
+  """Returns a listening socket, to be shared by all workers."""
+  sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  sock.bind((host, port))
+  sock.listen(backlog)
+  LOG.info('Listening on http://%s:%d', host, port)
+  return sock
+
+
+class Arbiter(object):
+  """Forks the workers serving the application, and replaces any that exit.
+
+  Every worker is a separate process running a threaded waitress server on
+  the shared socket, so that CPU-bound requests in one worker do not hold up
+  requests in others. SIGINT and SIGTERM stop the workers, then the master.
+  """
+  def __init__(self, app, sock, workers, threads):
+    self.app = app
+    self.sock = sock
+    self.workers = workers
+    self.threads = threads
+    self.pids = set()
+    self.stopping = False
+
+  def run(self):
+    """Starts the workers, and waits for them until stopped."""
+    signal.signal(signal.SIGINT, self.stop)
+    signal.signal(signal.SIGTERM, self.stop)
+    gc.collect()
+    for _number in xrange(self.workers):
+      self.spawn()
+    while self.pids:
+      try:
+        pid, status = os.wait()
+      except OSError as error:
+        if error.errno == errno.EINTR:
+          continue
+        raise
+      self.pids.discard(pid)
+      if not self.stopping:
+        LOG.warning('Worker %d exited with status %d, replacing.', pid, status)
+        time.sleep(1)
+        self.spawn()
+    LOG.info('All workers stopped.')
+
+  def spawn(self):
+    """Forks a worker process."""
+    pid = os.fork()
+    if pid:
+      self.pids.add(pid)
+      return
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    random.seed()
+    try:
+      waitress.serve(self.app, sockets=[self.sock], threads=self.threads)
+    except Exception:
+      LOG.exception('Worker %d failed.', os.getpid())
+      os._exit(1)
+    os._exit(0)
+
+  def stop(self, _signum, _frame):
+    """Stops all workers, after which `run` returns."""
+    self.stopping = True
+    for pid in self.pids:
+      try:
+        os.kill(pid, signal.SIGTERM)
+      except OSError:
+        pass
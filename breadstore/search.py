@@ -0,0 +1,348 @@
+"""breadStore in-memory customer search index."""
+
+# Standard modules
+import bisect
+import collections
+import heapq
+import itertools
+import re
+import threading
+import time
+import unicodedata
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+
+INDEXED_COLUMNS = (
+    'id', 'klantcode', 'voorletters', 'tussenvoegsel', 'achternaam',
+    'adres_postcode', 'geboorte_datum')
+SCORE_EXACT, SCORE_PREFIX, SCORE_SUBSTRING = 3, 2, 1
+# Up to this many term entries are inserted or removed in place, more are
+# merged into copies of the term lists.
+IN_PLACE_ENTRIES = 64
+
+
+def normalize(text):
+  """Returns the text in lowercase ASCII, with accents removed."""
+  if isinstance(text, str):
+    text = text.decode('utf8', 'replace')
+  text = unicodedata.normalize('NFKD', text)
+  return text.encode('ascii', 'ignore').lower()
+
+
+def query_words(text):
+  """Returns the normalized search words in the query text."""
+  return re.findall(r'[\w-]+', normalize(text))
+
+
+def customer_terms(customer):
+  """Returns the set of searchable terms for the customer or customer row.
+
+  These are the words of the customer's name, the customer code, the postcode
+  as a whole and in parts, and the birth date in ISO and Dutch notation.
+  """
+  name = '%s %s' % (
+      normalize(customer.tussenvoegsel or u''),
+      normalize(customer.achternaam or u''))
+  terms = set(re.findall(r'\w+', name))
+  terms.update(re.findall(r'[\w-]+', name))
+  if customer.klantcode:
+    terms.add(customer.klantcode.lower())
+  if customer.adres_postcode:
+    postcode = customer.adres_postcode.replace(' ', '').lower()
+    terms.add(postcode)
+    terms.update(re.findall(r'\d+|[a-z]+', postcode))
+  if customer.geboorte_datum:
+    terms.add(customer.geboorte_datum.strftime('%Y-%m-%d'))
+    terms.add(customer.geboorte_datum.strftime('%d-%m-%Y'))
+  return frozenset(terms)
+
+
+def sort_key(customer):
+  """Returns the key to order equally matching customers by, by name and id."""
+  return '%s\0%s\0%010d' % (
+      normalize(customer.achternaam or u''),
+      normalize(customer.voorletters or u''), customer.id)
+
+
+def trigrams(term):
+  """Returns the set of three-letter substrings of an alphabetic term.
+
+  Codes, dates and numbers are only matched by prefix, they have no trigrams.
+  """
+  if not term.isalpha():
+    return set()
+  return set(term[i:i + 3] for i in range(len(term) - 2))
+
+
+class CustomerIndex(object):
+  """Per-process prefix and trigram index over the customers' search terms.
+
+  The index is built on first use. Customers added or updated through the ORM
+  are reindexed when their session commits. Every `refresh_interval` seconds,
+  customers with a higher id than any indexed are added, which picks up bulk
+  imports and customers created by other processes. Every `rebuild_interval`
+  seconds the index is rebuilt, to include updates made by other processes.
+
+  Refreshes and rebuilds read the database without holding the index lock,
+  so searches go on using the current index meanwhile. Only the first build
+  makes searches wait. A rebuilt index is swapped in as a whole, after which
+  the changes committed while it was built are applied to it.
+
+  Terms are kept in a sorted list, with the customer ids in a list alongside
+  it, so that all customers matching a prefix are found as a single slice.
+  The entries of equal terms are ordered by customer id.
+  """
+  def __init__(self, refresh_interval=60, rebuild_interval=900):
+    self.refresh_interval = refresh_interval
+    self.rebuild_interval = rebuild_interval
+    self._lock = threading.Lock()
+    self._update_lock = threading.Lock()
+    self._built = 0
+    self._refreshed = 0
+    self._pending = None
+    self._documents = {}
+    self._sort_keys = {}
+    self._term_keys = []
+    self._term_ids = []
+    self._trigrams = {}
+
+  def search(self, session, text, limit=10):
+    """Returns the ids of the best matching customers, best match first.
+
+    Every word in the text has to match a term of the customer, exactly, as a
+    prefix or (for alphabetic words of three letters or more) anywhere in the
+    term. The results are ranked by how well the words match, then by name.
+    """
+    words = query_words(text)
+    if not words:
+      return []
+    self._update(session)
+    with self._lock:
+      scores = self._match(words[0])
+      for word in words[1:]:
+        word_scores = self._match(word)
+        scores = dict(
+            (customer_id, score + word_scores[customer_id])
+            for customer_id, score in scores.iteritems()
+            if customer_id in word_scores)
+      results = []
+      for score in sorted(set(scores.itervalues()), reverse=True):
+        matches = [key for key, value in scores.iteritems() if value == score]
+        results.extend(heapq.nsmallest(
+            limit - len(results), matches, key=self._sort_keys.__getitem__))
+        if len(results) == limit:
+          break
+    return results
+
+  def warm(self, session):
+    """Builds the index now, rather than on the first search."""
+    self._update(session)
+
+  def refresh_after_commit(self, session):
+    """Indexes new customers inserted outside of the ORM after commit."""
+    session.info['customer_index_refresh'] = True
+
+  def watch(self, session_factory):
+    """Updates the index on changes made through the session factory."""
+    sqlalchemy.event.listen(session_factory, 'after_flush', self._after_flush)
+    sqlalchemy.event.listen(session_factory, 'after_commit', self._after_commit)
+    sqlalchemy.event.listen(
+        session_factory, 'after_rollback', self._after_rollback)
+
+  def _after_flush(self, session, _flush_context):
+    changes = session.info.setdefault('customer_index_changes', {})
+    for customer in itertools.chain(session.new, session.dirty):
+      if isinstance(customer, models.Klant):
+        changes[customer.id] = customer_terms(customer), sort_key(customer)
+    for customer in session.deleted:
+      if isinstance(customer, models.Klant):
+        changes[customer.id] = None
+
+  def _after_commit(self, session):
+    changes = session.info.pop('customer_index_changes', {})
+    refresh = session.info.pop('customer_index_refresh', False)
+    with self._lock:
+      if self._pending is not None:
+        self._pending.update(changes)
+      if self._built:
+        self._apply(changes)
+      if refresh:
+        self._refreshed = 0
+
+  def _after_rollback(self, session):
+    session.info.pop('customer_index_changes', None)
+    session.info.pop('customer_index_refresh', None)
+
+  # ############################################################################
+  # Index maintenance. Methods from `_apply` on require the lock to be held.
+  #
+  def _update(self, session):
+    """Builds, rebuilds or refreshes the index when it is due.
+
+    Searches wait for the first build only. Once built, an update already
+    running in another thread is not waited for.
+    """
+    if not self._due(time.time()):
+      return
+    if not self._update_lock.acquire(not self._built):
+      return
+    try:
+      now = time.time()
+      if now - self._built > self.rebuild_interval:
+        self._rebuild(session, now)
+      elif now - self._refreshed > self.refresh_interval:
+        self._refresh(session, now)
+    finally:
+      self._update_lock.release()
+
+  def _due(self, now):
+    return (now - self._built > self.rebuild_interval or
+            now - self._refreshed > self.refresh_interval)
+
+  def _rebuild(self, session, now):
+    """Builds a new index for all customers, and swaps it in."""
+    with self._lock:
+      self._pending = {}
+    try:
+      documents, sort_keys, entries = {}, {}, []
+      postings = collections.defaultdict(set)
+      for customer in self._customers(session):
+        terms = customer_terms(customer)
+        documents[customer.id] = terms
+        sort_keys[customer.id] = sort_key(customer)
+        for term in terms:
+          entries.append((term, customer.id))
+          for trigram in trigrams(term):
+            postings[trigram].add(customer.id)
+      entries.sort()
+      with self._lock:
+        self._documents = documents
+        self._sort_keys = sort_keys
+        self._term_keys = [term for term, _customer_id in entries]
+        self._term_ids = [customer_id for _term, customer_id in entries]
+        self._trigrams = dict(postings)
+        self._apply(self._pending)
+        self._built = self._refreshed = now
+    finally:
+      with self._lock:
+        self._pending = None
+
+  def _refresh(self, session, now):
+    """Adds the customers with a higher id than any indexed."""
+    with self._lock:
+      after = max(self._documents) if self._documents else 0
+    changes = dict(
+        (customer.id, (customer_terms(customer), sort_key(customer)))
+        for customer in self._customers(session, after=after))
+    with self._lock:
+      self._apply(changes)
+      self._refreshed = now
+
+  def _customers(self, session, after=0):
+    """Yields the indexed columns of all customers with an id beyond `after`."""
+    columns = [getattr(models.Klant, name) for name in INDEXED_COLUMNS]
+    query = session.query(*columns).filter(models.Klant.id > after)
+    return query.yield_per(1000)
+
+  def _apply(self, changes):
+    """Reindexes customers by id, removing those whose document is None."""
+    self._remove(changes)
+    entries = []
+    for customer_id, document in changes.iteritems():
+      if document is None:
+        continue
+      terms, key = document
+      self._documents[customer_id] = terms
+      self._sort_keys[customer_id] = key
+      for term in terms:
+        entries.append((term, customer_id))
+        for trigram in trigrams(term):
+          self._trigrams.setdefault(trigram, set()).add(customer_id)
+    self._insert(entries)
+
+  def _insert(self, entries):
+    """Merges the (term, customer id) entries into the sorted term lists.
+
+    Larger batches are merged into copies of the lists, made in a single pass
+    of slices between the insertion positions.
+    """
+    if len(entries) <= IN_PLACE_ENTRIES:
+      for term, customer_id in entries:
+        position = self._term_position(term, customer_id)
+        self._term_keys.insert(position, term)
+        self._term_ids.insert(position, customer_id)
+      return
+    entries.sort()
+    term_keys, term_ids = [], []
+    start = 0
+    for term, customer_id in entries:
+      position = self._term_position(term, customer_id, start)
+      term_keys.extend(self._term_keys[start:position])
+      term_ids.extend(self._term_ids[start:position])
+      term_keys.append(term)
+      term_ids.append(customer_id)
+      start = position
+    term_keys.extend(self._term_keys[start:])
+    term_ids.extend(self._term_ids[start:])
+    self._term_keys, self._term_ids = term_keys, term_ids
+
+  def _remove(self, customer_ids):
+    """Removes the customers from the index, see `_insert`."""
+    positions = []
+    for customer_id in customer_ids:
+      terms = self._documents.pop(customer_id, None)
+      if terms is None:
+        continue
+      del self._sort_keys[customer_id]
+      for term in terms:
+        positions.append(self._term_position(term, customer_id))
+        for trigram in trigrams(term):
+          self._trigrams[trigram].discard(customer_id)
+    if len(positions) <= IN_PLACE_ENTRIES:
+      for position in sorted(positions, reverse=True):
+        del self._term_keys[position]
+        del self._term_ids[position]
+      return
+    positions.sort()
+    term_keys, term_ids = [], []
+    start = 0
+    for position in positions:
+      term_keys.extend(self._term_keys[start:position])
+      term_ids.extend(self._term_ids[start:position])
+      start = position + 1
+    term_keys.extend(self._term_keys[start:])
+    term_ids.extend(self._term_ids[start:])
+    self._term_keys, self._term_ids = term_keys, term_ids
+
+  def _term_position(self, term, customer_id, start=0):
+    """Returns the position of the entry for the term and customer id."""
+    start, stop = self._term_range(term, exact=True, start=start)
+    return bisect.bisect_left(self._term_ids, customer_id, start, stop)
+
+  def _term_range(self, word, exact=False, start=0):
+    """Returns the range of positions of terms equal to or prefixed by word."""
+    start = bisect.bisect_left(self._term_keys, word, start)
+    if exact:
+      return start, bisect.bisect_right(self._term_keys, word, start)
+    return start, bisect.bisect_left(self._term_keys, word + '\x7f', start)
+
+  def _match(self, word):
+    """Returns a dictionary of customer ids matching the word, with scores."""
+    start, stop = self._term_range(word)
+    scores = dict.fromkeys(self._term_ids[start:stop], SCORE_PREFIX)
+    start, stop = self._term_range(word, exact=True)
+    scores.update(dict.fromkeys(self._term_ids[start:stop], SCORE_EXACT))
+    word_trigrams = trigrams(word)
+    if word_trigrams:
+      postings = sorted(
+          (self._trigrams.get(trigram, ()) for trigram in word_trigrams),
+          key=len)
+      candidates = set(postings[0]).intersection(*postings[1:])
+      for customer_id in candidates.difference(scores):
+        if any(word in term for term in self._documents[customer_id]):
+          scores[customer_id] = SCORE_SUBSTRING
+    return scores
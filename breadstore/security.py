@@ -1,22 +1,99 @@
 """Security model for breadStore."""
 
+# Standard modules
+import itertools
+import time
+
 # Third-party modules
+import sqlalchemy
 from sqlalchemy import orm
 
 # Application modules
+from . import cache
 from . import models
 
 
 def group_finder(user_id, request):
-  """Retrieves the user and returns the list of principals for this user
+  """Returns the list of principals for the user, or None for unknown users.
+
+  Principals are served from the process' principal cache where possible. The
+  user object itself is available as `request.user`, loaded when first used.
+  """
+  return request.registry.principal_cache.principals(user_id, request.db)
+
+
+def get_user(request):
+  """Returns the authenticated user, used as the reified `request.user`.
 
-  In addition to providing the principals, the user object is stored on the
-  request, allowing easy access to it in views.
+  The user is served from the entity cache where possible.
   """
-  user = request.db.query(models.Medewerker).options(
+  user_id = request.authenticated_userid
+  if user_id is not None:
+    return request.registry.entity_cache.get(
+        request.db, models.Medewerker, user_id)
+
+
+def load_principals(user_id, session):
+  """Retrieves the user and returns a tuple of principals for this user."""
+  user = session.query(models.Medewerker).options(
       orm.joinedload('rol.permissies', innerjoin=True)).get(user_id)
   if user:
-    request.user = user
     principals = ['user:%s' % user.id, 'group:%s' % user.rol.naam]
     principals.extend('priv:%s' % priv.naam for priv in user.rol.permissies)
-    return principals
+    return tuple(principals)
+
+
+class PrincipalCache(object):
+  """Per-process cache of the principals of users, keyed by user id.
+
+  Entries expire after `ttl` seconds, and the least recently used entries are
+  evicted beyond `size`. The cache is cleared when a session that changed any
+  staff member, role or permission commits. With `shared` enabled, such changes
+  also increment a version counter in the database. Every `check_interval`
+  seconds, that counter is compared to clear caches in all other processes.
+  """
+  VERSION_NAME = 'principals'
+  WATCHED = models.Medewerker, models.Permissie, models.Rol
+
+  def __init__(self, size=1024, ttl=300, shared=False, check_interval=5):
+    self.entries = cache.LRUCache(size=size, ttl=ttl)
+    self.shared = shared
+    self.check_interval = check_interval
+    self._checked = 0
+    self._version = None
+
+  def principals(self, user_id, session):
+    """Returns the list of principals for the user id, or None if unknown."""
+    if self.shared and time.time() - self._checked > self.check_interval:
+      self.check_version(session)
+    principals = self.entries.get(user_id)
+    if principals is None:
+      principals = load_principals(user_id, session)
+      if principals is None:
+        return None
+      self.entries.set(user_id, principals)
+    return list(principals)
+
+  def check_version(self, session):
+    """Clears the cache if the shared version counter has changed."""
+    version = models.cache_version(session, self.VERSION_NAME)
+    if version != self._version:
+      self.entries.clear()
+      self._version = version
+    self._checked = time.time()
+
+  def watch(self, session_factory):
+    """Invalidates the cache on changes made through the session factory."""
+    sqlalchemy.event.listen(session_factory, 'after_flush', self._after_flush)
+    sqlalchemy.event.listen(session_factory, 'after_commit', self._after_commit)
+
+  def _after_flush(self, session, _flush_context):
+    changed = itertools.chain(session.new, session.dirty, session.deleted)
+    if any(isinstance(obj, self.WATCHED) for obj in changed):
+      session.info['principals_changed'] = True
+      if self.shared:
+        models.bump_cache_version(session.connection(), self.VERSION_NAME)
+
+  def _after_commit(self, session):
+    if session.info.pop('principals_changed', False):
+      self.entries.clear()
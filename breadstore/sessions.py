@@ -0,0 +1,38 @@
+"""breadStore database sessions that outlive their request's transaction."""
+
+# Third-party modules
+from sqlalchemy import orm
+
+
+class HoldableSession(orm.Session):
+  """Session that can be held open for a response that streams from it.
+
+  pyramid_tm and the request close the session when they finish, before the
+  WSGI server writes a streamed response body. While the session is held,
+  closing it is deferred until the hold is released, so the body is read in
+  the request's transaction. As that transaction goes on, the instances loaded
+  in it are not expired by the transaction manager either, which would reload
+  every row already fetched for the stream.
+  """
+  def __init__(self, **kwds):
+    super(HoldableSession, self).__init__(**kwds)
+    self.held = False
+
+  def hold(self):
+    """Keeps the session open until `release` is called."""
+    self.held = True
+
+  def release(self):
+    """Ends the hold on the session, and closes it."""
+    self.held = False
+    self.close()
+
+  def close(self):
+    """Closes the session, unless it is held open."""
+    if not self.held:
+      super(HoldableSession, self).close()
+
+  def expire_all(self):
+    """Expires all instances of the session, unless it is held open."""
+    if not self.held:
+      super(HoldableSession, self).expire_all()
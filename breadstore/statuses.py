@@ -0,0 +1,61 @@
+"""breadStore current customer status, maintained alongside the history."""
+
+# Standard modules
+import itertools
+
+# Third-party modules
+import sqlalchemy
+
+# Application modules
+from . import models
+from . import util
+
+
+def latest_statuses(customer_ids=None):
+  """Returns a query for the most recently recorded status of customers.
+
+  Without customer ids, this selects the latest status of all customers.
+  """
+  status = models.KlantStatus.__table__
+  latest = status.alias('latest')
+  latest_ids = sqlalchemy.select([sqlalchemy.func.max(latest.c.id)])
+  if customer_ids is not None:
+    latest_ids = latest_ids.where(latest.c.klant_id.in_(customer_ids))
+  return sqlalchemy.select([
+      status.c.klant_id, status.c.id, status.c.status,
+      status.c.wijzigingsdatum]).where(
+          status.c.id.in_(latest_ids.group_by(latest.c.klant_id)))
+
+
+def rebuild(connection):
+  """Recomputes the current status of all customers from their history."""
+  current = models.KlantHuidigeStatus.__table__
+  connection.execute(current.delete())
+  connection.execute(current.insert().from_select(
+      ['klant_id', 'klant_status_id', 'status', 'wijzigingsdatum'],
+      latest_statuses()))
+
+
+def update_current(connection, customer_ids):
+  """Recomputes the current status of the given customers."""
+  current = models.KlantHuidigeStatus.__table__
+  for chunk in util.chunked(customer_ids, 500):
+    connection.execute(current.delete().where(current.c.klant_id.in_(chunk)))
+    connection.execute(current.insert().from_select(
+        ['klant_id', 'klant_status_id', 'status', 'wijzigingsdatum'],
+        latest_statuses(chunk)))
+
+
+def watch(session_factory):
+  """Keeps current statuses up to date with changes made through the factory."""
+  sqlalchemy.event.listen(session_factory, 'after_flush', _after_flush)
+
+
+def _after_flush(session, _flush_context):
+  """Updates the current status of customers whose statuses were flushed."""
+  changed = itertools.chain(session.new, session.dirty, session.deleted)
+  customer_ids = set(
+      obj.klant_id for obj in changed if isinstance(obj, models.KlantStatus))
+  customer_ids.discard(None)
+  if customer_ids:
+    update_current(session.connection(), customer_ids)
@@ -2,10 +2,11 @@
 
 # Standard modules
 import base64
-import random
+import json
+import os
 import re
 import struct
-import time
+import threading
 
 
 def case_transform_python(name):
@@ -22,6 +23,38 @@ def case_transform_json(name):
   return re.sub('(?:_([a-z]))', converter, name)
 
 
+def chunked(iterable, size):
+  """Yields lists of at most `size` consecutive items from the iterable."""
+  chunk = []
+  for item in iterable:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def decode_cursor(token):
+  """Returns the list of values stored in an opaque pagination cursor.
+
+  Raises ValueError if the token was not produced by `encode_cursor`.
+  """
+  try:
+    padding = '=' * (-len(token) % 4)
+    values = json.loads(base64.urlsafe_b64decode(str(token + padding)))
+  except (TypeError, UnicodeEncodeError):
+    raise ValueError('Malformed cursor %r' % token)
+  if not isinstance(values, list):
+    raise ValueError('Malformed cursor %r' % token)
+  return values
+
+
+def encode_cursor(values):
+  """Returns an opaque, URL-safe pagination cursor for the given values."""
+  return base64.urlsafe_b64encode(json.dumps(list(values))).rstrip('=')
+
+
 def dict_keys_python(mapping):
   """Reformats a dictionary, JSON naming scheme to Python naming scheme."""
   return mapping_visitor(mapping, case_transform_python)
@@ -42,8 +75,39 @@ def mapping_visitor(mapping, key_func):
   return transformed
 
 
-def timebased_customer_code(offset=0):
-  """Current time plus two random bytes to to generate a unique code."""
-  curtime = int(time.time() + offset) % 2 ** 31
-  code = struct.pack('<lB', curtime, random.randrange(256))
+def sequence_customer_code(number):
+  """Returns the 8-character customer code for a sequence number.
+
+  The codes have the same five byte layout as the time-based codes issued
+  before, but with the high bit of the fourth byte set. That bit is never set
+  in time-based codes (their time value is below 2 ** 31), so codes from the
+  sequence can never collide with those. Numbers up to 2 ** 39 are supported.
+  """
+  code = struct.pack('<LB', (number & 0x7fffffff) | 0x80000000, number >> 31)
   return base64.b32encode(code).lower()
+
+
+class CustomerCodeAllocator(object):
+  """Hands out unique customer codes from blocks of reserved sequence numbers.
+
+  The `reserve` callable is given the block size and returns the first number
+  of a freshly reserved block. Blocks are reserved only when the current one is
+  used up, and are discarded by forked child processes.
+  """
+  def __init__(self, reserve, block_size=1000):
+    self.reserve = reserve
+    self.block_size = block_size
+    self._lock = threading.Lock()
+    self._next = self._end = 0
+    self._pid = None
+
+  def allocate(self):
+    """Returns the next unique customer code."""
+    with self._lock:
+      if self._next >= self._end or self._pid != os.getpid():
+        self._next = self.reserve(self.block_size)
+        self._end = self._next + self.block_size
+        self._pid = os.getpid()
+      number = self._next
+      self._next += 1
+    return sequence_customer_code(number)
@@ -0,0 +1,210 @@
+"""breadStore entity versions, for ETags and optimistic concurrency.
+
+Customers and subscriptions carry a version that moves forward whenever their
+JSON representation changes. For subscriptions, this includes changes to their
+packages and package statuses, and to their diets and issue cycle.
+"""
+
+# Standard modules
+import itertools
+
+# Third-party modules
+import sqlalchemy
+from sqlalchemy import orm
+
+# Application modules
+from . import models
+from . import util
+
+CHANGED_KEY = 'breadstore.versions.changed'
+CLAIMED_KEY = 'breadstore.versions.claimed'
+ENCODINGS = 'gzip',
+
+
+def current(session, cls, ident):
+  """Returns the current version of the entity, or None if it does not exist.
+
+  This is a single query for the version column of the entity's base table,
+  which does not load the entity itself.
+  """
+  table = cls.__table__
+  return session.execute(
+      sqlalchemy.select([table.c.versie])
+      .where(table.c.id == ident)).scalar()
+
+
+def etag(cls, ident, version):
+  """Returns the ETag for the given version of an entity."""
+  return '%s-%s-%d' % (cls.__tablename__, ident, version)
+
+
+def encoded_etag(etag, encoding):
+  """Returns the ETag for a representation with the given content encoding.
+
+  The compressed and identity bodies of a response differ byte for byte, so
+  they cannot share a strong ETag.
+  """
+  return '%s-%s' % (etag, encoding)
+
+
+def match(etags, etag):
+  """Returns the ETag in an If-Match or If-None-Match header that matches.
+
+  Matches are for the given ETag of an entity, or that of any of its content
+  encoded representations. Returns None if none of them matches.
+  """
+  candidates = itertools.chain(
+      [etag], (encoded_etag(etag, encoding) for encoding in ENCODINGS))
+  for candidate in candidates:
+    if candidate in etags:
+      return candidate
+
+
+def claim(session, cls, ident, version):
+  """Moves the entity to its next version, if it is at the given version.
+
+  The conditional update locks the entity's row for the rest of the
+  transaction, so only one of several concurrent updates based on the same
+  version can succeed. Changes to the entity flushed later in the transaction
+  do not move its version again. Returns whether the version was claimed.
+  """
+  table = cls.__table__
+  result = session.connection().execute(
+      table.update()
+      .where(sqlalchemy.and_(table.c.id == ident, table.c.versie == version))
+      .values(versie=table.c.versie + 1))
+  if result.rowcount != 1:
+    return False
+  session.info.setdefault(CLAIMED_KEY, set()).add((cls.__tablename__, ident))
+  mark_changed(session.connection(), cls, [ident])
+  expire_versions(session, cls, [ident])
+  return True
+
+
+def bump(connection, cls, idents):
+  """Moves the given entities to their next version."""
+  table = cls.__table__
+  idents = set(idents)
+  for chunk in util.chunked(idents, 500):
+    connection.execute(
+        table.update()
+        .where(table.c.id.in_(chunk))
+        .values(versie=table.c.versie + 1))
+  mark_changed(connection, cls, idents)
+
+
+def bump_packages(connection, package_ids):
+  """Moves the subscriptions of the given packages to their next version.
+
+  The subscriptions are selected first and updated by primary key, so that the
+  changed subscriptions are known to `mark_changed`.
+  """
+  bump(connection, models.Abonnement,
+       package_subscriptions(connection, package_ids))
+
+
+def package_subscriptions(connection, package_ids):
+  """Returns the keys of the subscriptions of the given packages."""
+  package = models.Pakket.__table__
+  subscription_ids = set()
+  for chunk in util.chunked(set(package_ids), 500):
+    subscription_ids.update(row.abonnement_id for row in connection.execute(
+        sqlalchemy.select([package.c.abonnement_id])
+        .where(package.c.id.in_(chunk))))
+  subscription_ids.discard(None)
+  return subscription_ids
+
+
+def subscriptions_using(connection, diet_ids, cycle_ids):
+  """Returns the keys of subscriptions with any of the diets or cycles."""
+  subscription = models.Abonnement.__table__
+  diets = models.t_abonnement_dieet
+  subscription_ids = set()
+  for chunk in util.chunked(set(diet_ids), 500):
+    subscription_ids.update(row.abonnement_id for row in connection.execute(
+        sqlalchemy.select([diets.c.abonnement_id])
+        .where(diets.c.dieet_id.in_(chunk))))
+  for chunk in util.chunked(set(cycle_ids), 500):
+    subscription_ids.update(row.id for row in connection.execute(
+        sqlalchemy.select([subscription.c.id])
+        .where(subscription.c.uitgifte_cyclus_id.in_(chunk))))
+  return subscription_ids
+
+
+def expire_versions(session, cls, idents):
+  """Expires the version of the given entities, if loaded in the session."""
+  for ident in idents:
+    obj = session.identity_map.get(orm.util.identity_key(cls, ident))
+    if obj is not None:
+      session.expire(obj, ['versie'])
+
+
+def mark_changed(connection, cls, idents):
+  """Records entities changed in the transaction of the connection.
+
+  Caches that track the connection (see `entities.EntityCache`) invalidate
+  these entities once the transaction commits. For other connections, this
+  does nothing.
+  """
+  changed = connection.info.get(CHANGED_KEY)
+  if changed is not None:
+    changed.update((cls.__tablename__, ident) for ident in idents)
+
+
+def watch(session_factory):
+  """Keeps versions up to date with changes made through the factory."""
+  sqlalchemy.event.listen(session_factory, 'after_flush', _after_flush)
+  sqlalchemy.event.listen(
+      session_factory, 'after_transaction_end', _after_transaction_end)
+
+
+def _after_flush(session, _flush_context):
+  """Moves the versions of changed customers and subscriptions forward.
+
+  Subscriptions move forward for changes to their own columns, diets and
+  packages, for changes to the statuses of their packages, and for changes to
+  the diets and cycle they use. Entities claimed in the transaction already
+  moved to their next version. The version of loaded instances is expired, to
+  be reloaded when used.
+  """
+  customer_ids, subscription_ids, package_ids = set(), set(), set()
+  diet_ids, cycle_ids = set(), set()
+  for obj in session.dirty:
+    if isinstance(obj, models.Klant):
+      if session.is_modified(obj, include_collections=False):
+        customer_ids.add(obj.id)
+    elif isinstance(obj, models.Abonnement):
+      if session.is_modified(obj):
+        subscription_ids.add(obj.id)
+  for obj in itertools.chain(session.new, session.dirty, session.deleted):
+    if isinstance(obj, models.Pakket):
+      subscription_ids.add(obj.abonnement_id)
+    elif isinstance(obj, models.PakketStatus):
+      package_ids.add(obj.pakket_id)
+  for obj in itertools.chain(session.dirty, session.deleted):
+    if isinstance(obj, models.Dieet):
+      diet_ids.add(obj.id)
+    elif isinstance(obj, models.UitgifteCyclus):
+      cycle_ids.add(obj.id)
+  package_ids.discard(None)
+  if not (customer_ids or subscription_ids or package_ids or diet_ids or
+          cycle_ids):
+    return
+  connection = session.connection()
+  subscription_ids.update(package_subscriptions(connection, package_ids))
+  subscription_ids.update(subscriptions_using(connection, diet_ids, cycle_ids))
+  subscription_ids.discard(None)
+  claimed = session.info.get(CLAIMED_KEY, ())
+  bump(connection, models.Klant, (
+      ident for ident in customer_ids
+      if (models.Klant.__tablename__, ident) not in claimed))
+  bump(connection, models.Abonnement, (
+      ident for ident in subscription_ids
+      if (models.Abonnement.__tablename__, ident) not in claimed))
+  expire_versions(session, models.Klant, customer_ids)
+  expire_versions(session, models.Abonnement, subscription_ids)
+
+
+def _after_transaction_end(session, transaction):
+  if transaction.parent is None:
+    session.info.pop(CLAIMED_KEY, None)
@@ -1,9 +1,46 @@
 """breadStore API views."""
 
 # Third-party modules
+from pyramid import httpexceptions as exc
 from pyramid.view import view_config
+from webob.etag import AnyETag
+
+# Application modules
+from .. import resources
+from .. import versions
 
 
 @view_config(context='..resources.Root')
 def root(request):
   return {'application': 'breadStore'}
+
+
+def not_modified(request, context):
+  """Sets the ETag of the response to that of the versioned context.
+
+  Returns a 304 Not Modified response if the client already has this version,
+  in any content encoding, and None otherwise.
+  """
+  request.response.etag = context.etag
+  etag = versions.match(request.if_none_match, context.etag)
+  if etag is not None:
+    request.response.etag = etag
+    return exc.HTTPNotModified(
+        headers={'ETag': request.response.headers['ETag']})
+
+
+def require_version(request, context):
+  """Claims the next version of the context for an update.
+
+  If the request has an If-Match header, the update is refused unless the
+  header matches the current version of the entity in any content encoding,
+  and no other update has claimed that version in the mean time. Without the
+  header (or with `*`), updates are not conditional.
+  """
+  if request.if_match is AnyETag:
+    return
+  matched = versions.match(request.if_match, context.etag)
+  if matched is None or not versions.claim(
+      request.db, context.model, int(context.__name__), context.version):
+    raise resources.ApiError(
+        'The resource has been changed, reload and try again.', code=412)
@@ -1,13 +1,30 @@
 """breadStore API views - customer module."""
 
+# Standard modules
+import collections
+import datetime
+import os
+
 # Third-party modules
+from pyramid import httpexceptions as exc
+from pyramid.response import FileIter
 from pyramid.view import view_config
 from pyramid.view import view_defaults
+import sqlalchemy
+import zope.sqlalchemy
 
 # Application modules
 from .. import models
+from .. import photos
+from .. import picklist
+from .. import planning
+from .. import renderers
+from .. import resources
 from .. import schemas
 from .. import util
+from .. import versions
+from . import not_modified
+from . import require_version
 
 
 @view_defaults(context='..resources.CustomerCollection')
@@ -18,8 +35,96 @@ class CustomerCollectionView(object):
 
   @view_config(request_method='GET', permission='view')
   def list(self):
-    """Returns a list of customers in the system."""
-    return {'klanten': self.request.db.query(models.Klant).all()}
+    """Returns a page of customers in the system, optionally filtered.
+
+    Pages are selected by keyset on the sort column and primary key, making each
+    page equally expensive to retrieve. The `volgende` cursor of the response is
+    passed as the `after` parameter to retrieve the next page. It is taken from
+    the last customer streamed, so it follows from the same query. An
+    approximate total (cached for a short while) is included when `totaal` is
+    requested.
+    """
+    params = schemas.load_params(schemas.CustomerListing, self.request)
+    limit = params['limit']
+    sort_column = getattr(models.Klant, params['sort'])
+    query = filter_customers(self.request.db.query(models.Klant), params)
+    if params['after'] is not None:
+      query = query.filter(keyset_after(sort_column, params['after']))
+    if sort_column is models.Klant.id:
+      query = query.order_by(models.Klant.id)
+    else:
+      query = query.order_by(sort_column, models.Klant.id)
+    customers = renderers.StreamedList(
+        query.limit(limit + 1), limit=limit,
+        key=lambda customer: (getattr(customer, params['sort']), customer.id))
+
+    def next_cursor():
+      if customers.more:
+        return util.encode_cursor(customers.last)
+    response = collections.OrderedDict([
+        ('klanten', customers),
+        ('volgende', renderers.Deferred(next_cursor))])
+    if params['totaal']:
+      response['totaal'] = self.approximate_total(params)
+    return response
+
+  @view_config(name='bulk', request_method='POST', permission='create')
+  def bulk_create(self):
+    """Creates customers in bulk from a JSON array or NDJSON request body.
+
+    Every record is validated separately. Valid records are inserted in
+    batches in a single transaction, errors are reported per record by their
+    index in the request body.
+    """
+    records, errors = schemas.load_many(schemas.Customer, self.request)
+    records = reject_known_codes(self.request.db, records, errors)
+    if not records:
+      raise resources.ApiError('No valid customers provided.', fouten=errors)
+    chunk_size = int(self.request.registry.settings.get(
+        'breadstore.bulk_chunk_size', 1000))
+    customers = [customer for _index, customer in records]
+    for customer in customers:
+      if not customer['klantcode']:
+        customer['klantcode'] = self.request.registry.customer_codes.allocate()
+    insert = models.Klant.__table__.insert()
+    for chunk in util.chunked(customers, chunk_size):
+      self.request.db.execute(insert, chunk)
+    zope.sqlalchemy.mark_changed(self.request.db)
+    self.request.registry.customer_index.refresh_after_commit(self.request.db)
+    self.request.response.status_int = 201
+    return {'aangemaakt': len(records), 'fouten': errors}
+
+  @view_config(name='zoek', request_method='GET', permission='view')
+  def search(self):
+    """Returns the customers best matching the search query `q`.
+
+    Customers are matched on name, customer code, postcode and birth date, using
+    the process' in-memory search index, and loaded in a single query.
+    """
+    params = schemas.load_params(schemas.CustomerSearch, self.request)
+    customer_ids = self.request.registry.customer_index.search(
+        self.request.db, params['q'], limit=params['limit'])
+    if not customer_ids:
+      return {'klanten': []}
+    customers = self.request.db.query(models.Klant).filter(
+        models.Klant.id.in_(customer_ids))
+    ranking = dict((customer_id, rank) for rank, customer_id in enumerate(
+        customer_ids))
+    return {'klanten': sorted(
+        customers, key=lambda customer: ranking[customer.id])}
+
+  def approximate_total(self, params):
+    """Returns the number of customers matching the filters, briefly cached."""
+    key = (
+        params['postcode'], params['plaats'], params['achternaam'],
+        params['status'])
+    totals = self.request.registry.listing_totals
+    total = totals.get(key)
+    if total is None:
+      count = sqlalchemy.func.count(models.Klant.id)
+      total = filter_customers(self.request.db.query(count), params).scalar()
+      totals.set(key, total)
+    return total
 
   @view_config(request_method='POST', permission='create')
   def create(self):
@@ -35,22 +140,101 @@ class CustomerCollectionView(object):
 class CustomerView(object):
   """Defines the singular customer API."""
   def __init__(self, context, request):
+    self.context = context
     self.request = request
-    self.customer = context.customer
+
+  @property
+  def customer(self):
+    """The customer, loaded from the database when first used."""
+    return self.context.customer
 
   @view_config(request_method='GET', permission='view')
   def get(self):
-    """Returns the information of a customer."""
-    return {'klant': self.customer}
+    """Returns the information of a customer.
+
+    The response carries the ETag of the customer's version. Clients that have
+    the current version get a 304 response without the customer being loaded.
+    """
+    return not_modified(self.request, self.context) or {'klant': self.customer}
 
   @view_config(request_method='PUT', permission='update')
   def update(self):
-    """Updates an existing customer."""
+    """Updates an existing customer, if it matches a given If-Match header."""
+    require_version(self.request, self.context)
     schema = load_customer_schema(self.request)
     for key, value in schema.iteritems():
       setattr(self.customer, key, value)
+    self.request.db.flush()
+    self.request.response.etag = versions.etag(
+        models.Klant, self.customer.id, self.customer.versie)
     return {'klant': self.customer}
 
+  @view_config(name='foto', request_method='GET', permission='view')
+  def photo(self):
+    """Streams the photo of the customer, or a thumbnail of the given width.
+
+    Responses carry a strong ETag and Last-Modified header, and conditional and
+    Range requests are honored. Thumbnails are served from an on-disk cache.
+    """
+    params = schemas.load_params(schemas.Photo, self.request)
+    photo = models.KlantFoto.__table__.c
+    meta = self.request.db.execute(
+        sqlalchemy.select([
+            photo.foto_type, photo.foto_grootte, photo.foto_etag,
+            photo.foto_gewijzigd])
+        .where(photo.klant_id == self.context.customer_id)).first()
+    if meta is None:
+      raise exc.HTTPNotFound()
+    data = None
+    if meta.foto_etag:
+      etag, size = meta.foto_etag, meta.foto_grootte
+    else:
+      # Stored without metadata, until initdb fills it in.
+      data = self.load_photo()
+      etag, size = photos.photo_etag(data), len(data)
+    response = self.request.response
+    response.conditional_response = True
+    response.last_modified = meta.foto_gewijzigd
+    width = params['breedte']
+    if width is None:
+      response.etag = etag
+      response.content_type = meta.foto_type
+      if data is not None:
+        response.body = data
+        return response
+      response.app_iter = photos.BlobIter(
+          self.request.db, self.context.customer_id, etag, 0, size)
+      response.content_length = size
+      return response
+    thumbnails = self.request.registry.thumbnails
+    if not thumbnails.available:
+      raise resources.ApiError('Thumbnails are not supported.', code=501)
+    response.etag = '%s-%d' % (etag, width)
+    if response.etag in self.request.if_none_match:
+      return exc.HTTPNotModified(headers={'ETag': response.headers['ETag']})
+    thumbnail = None
+    path = thumbnails.get(etag, width)
+    if path is not None:
+      try:
+        thumbnail = open(path, 'rb')
+      except IOError:
+        pass  # Pruned by another request since, create it anew
+    if thumbnail is None:
+      if data is None:
+        data = self.load_photo()
+      thumbnail = open(thumbnails.create(etag, width, data), 'rb')
+    response.content_type = 'image/jpeg'
+    response.app_iter = FileIter(thumbnail)
+    response.content_length = os.fstat(thumbnail.fileno()).st_size
+    return response
+
+  def load_photo(self):
+    """Returns the full photo data of the customer."""
+    photo = models.KlantFoto.__table__.c
+    return self.request.db.execute(
+        sqlalchemy.select([photo.foto])
+        .where(photo.klant_id == self.context.customer_id)).scalar()
+
   # ############################################################################
   # List or add subscriptions to a customer.
   #
@@ -59,25 +243,108 @@ class CustomerView(object):
       request_method='GET',
       permission='view')
   def list_subscriptions(self):
-    """Lists the current subscriptions for the customer."""
-    return {'abonnementen': self.customer.abonnementen}
+    """Lists the subscriptions for the customer.
+
+    The list can be filtered on (in)complete subscriptions using `afgerond`.
+    """
+    params = schemas.load_params(schemas.SubscriptionListing, self.request)
+    subscriptions = self.request.db.query(models.Abonnement).filter(
+        models.Abonnement.klant_id == self.context.customer_id)
+    if params['afgerond'] is not None:
+      subscriptions = subscriptions.filter(
+          models.Abonnement.completed == params['afgerond'])
+    return {'abonnementen': renderers.StreamedList(subscriptions)}
 
   @view_config(
       name='abonnementen',
       request_method='POST',
       permission='add_subscription')
   def add_subscription(self):
-    """Adds a subscription to the customer and returns the new subscription."""
+    """Adds a subscription to the customer and returns the new subscription.
+
+    All packages of the subscription are planned right away, starting on the
+    first pickup day of the subscription's cycle.
+    """
     schema = schemas.load(schemas.Subscription, self.request)
+    diet_ids = schema.pop('dieten')
+    if schema['datum_start'] is None:
+      schema['datum_start'] = datetime.date.today()
     subscription = self.customer.add_subscription(**schema)
+    if diet_ids:
+      subscription.dieets = self.request.db.query(models.Dieet).filter(
+          models.Dieet.id.in_(diet_ids)).all()
     self.request.db.flush()
+    connection = self.request.db.connection()
+    planning.plan(
+        connection, [subscription.id], self.request.authenticated_userid)
+    picklist.refresh(connection, [subscription.id])
+    subscription = self.request.db.query(
+        models.Abonnement).populate_existing().get(subscription.id)
     self.request.response.status_int = 201
     return {'abonnement': subscription}
 
 
+def filter_customers(query, params):
+  """Applies the postcode, place, surname and status filters to the query.
+
+  The status filter joins the customers' current status, not their history.
+  """
+  if params['postcode']:
+    postcode = params['postcode'].replace(' ', '').upper()
+    query = query.filter(models.Klant.adres_postcode.startswith(postcode))
+  if params['plaats']:
+    query = query.filter(models.Klant.adres_plaats == params['plaats'])
+  if params['achternaam']:
+    query = query.filter(
+        models.Klant.achternaam.startswith(params['achternaam']))
+  if params['status']:
+    current = models.KlantHuidigeStatus
+    query = query.join(current, current.klant_id == models.Klant.id).filter(
+        current.status == params['status'])
+  return query
+
+
+def reject_known_codes(session, records, errors):
+  """Returns the records whose customer code is not already in use.
+
+  Records with a code that is taken, or that occurs earlier in the same batch,
+  are added to the list of errors.
+  """
+  codes = set(values['klantcode'] for _index, values in records)
+  codes.discard(None)
+  known = set()
+  for chunk in util.chunked(codes, 1000):
+    query = session.query(models.Klant.klantcode).filter(
+        models.Klant.klantcode.in_(chunk))
+    known.update(code for code, in query)
+  accepted = []
+  for index, values in records:
+    if values['klantcode'] in known:
+      errors.append({'index': index, 'error': 'Customer code already in use.'})
+      continue
+    if values['klantcode']:
+      known.add(values['klantcode'])
+    accepted.append((index, values))
+  errors.sort(key=lambda error: error['index'])
+  return accepted
+
+
+def keyset_after(sort_column, cursor):
+  """Returns a filter selecting customers that sort after the cursor."""
+  try:
+    value, last_id = util.decode_cursor(cursor)
+  except ValueError:
+    raise resources.ApiError('Invalid value for "after", not a valid cursor.')
+  if sort_column is models.Klant.id:
+    return models.Klant.id > last_id
+  return sqlalchemy.or_(
+      sort_column > value,
+      sqlalchemy.and_(sort_column == value, models.Klant.id > last_id))
+
+
 def load_customer_schema(request):
   """Loads the customer schema and sets a customer code if it's None."""
   schema = schemas.load(schemas.Customer, request)
   if not schema['klantcode']:
-    schema['klantcode'] = util.timebased_customer_code()
+    schema['klantcode'] = request.registry.customer_codes.allocate()
   return schema
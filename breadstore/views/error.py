@@ -20,6 +20,13 @@ def bad_request_body(err, request):
   return error_response(request, err.message, code=err.code, **err.kwds)
 
 
+@view_config(context='..passwords.PoolSaturated')
+def pool_saturated(err, request):
+  """Handles requests refused because the password pool is saturated."""
+  request.response.headers['Retry-After'] = '1'
+  return error_response(request, 'service busy, try again later', code=503)
+
+
 @view_config(context=exc.HTTPForbidden)
 def forbidden_view(request):
   """Handles requests that the client is forbidden from performing."""
@@ -0,0 +1,100 @@
+"""breadStore API views - package module."""
+
+# Standard modules
+import datetime
+
+# Third-party modules
+from pyramid.view import view_config
+from pyramid.view import view_defaults
+import zope.sqlalchemy
+
+# Application modules
+from .. import models
+from .. import picklist
+from .. import resources
+from .. import schemas
+from .. import util
+from .. import versions
+
+
+@view_defaults(context='..resources.PackageCollection')
+class PackageCollectionView(object):
+  """Defines the package collection API."""
+  def __init__(self, request):
+    self.request = request
+
+  @view_config(name='statussen', request_method='POST', permission='update')
+  def record_statuses(self):
+    """Records new statuses for packages in bulk, e.g. at checkout.
+
+    The records are validated together with a few set-based queries, and all
+    valid statuses are inserted in batches in a single transaction. The results
+    list every record by its index in the request body, with an error if it was
+    not recorded.
+    """
+    records, errors = schemas.load_many(schemas.PackageStatus, self.request)
+    today = datetime.date.today()
+    for _index, values in records:
+      values['ophaaldatum'] = values['ophaaldatum'] or today
+      values['medewerker_id'] = (
+          values['medewerker_id'] or self.request.authenticated_userid)
+    records = reject_invalid_statuses(self.request.db, records, errors)
+    if not records:
+      raise resources.ApiError(
+          'No valid package statuses provided.', resultaten=errors)
+    chunk_size = int(self.request.registry.settings.get(
+        'breadstore.bulk_chunk_size', 1000))
+    statuses = [values for _index, values in records]
+    insert = models.PakketStatus.__table__.insert()
+    for chunk in util.chunked(statuses, chunk_size):
+      self.request.db.execute(insert, chunk)
+    zope.sqlalchemy.mark_changed(self.request.db)
+    package_ids = [status['pakket_id'] for status in statuses]
+    picklist.refresh(self.request.db.connection(), package_ids=package_ids)
+    versions.bump_packages(self.request.db.connection(), package_ids)
+    results = errors + [
+        {'index': index, 'pakketId': values['pakket_id']}
+        for index, values in records]
+    results.sort(key=lambda result: result['index'])
+    self.request.response.status_int = 201
+    return {'aangemaakt': len(records), 'resultaten': results}
+
+
+def reject_invalid_statuses(session, records, errors):
+  """Returns the status records that can be recorded.
+
+  Records for unknown or already processed packages, for packages that occur
+  earlier in the same batch, or by unknown or inactive staff are added to the
+  list of errors instead.
+  """
+  package_ids = set(values['pakket_id'] for _index, values in records)
+  staff_ids = set(values['medewerker_id'] for _index, values in records)
+  known, processed, staff = set(), set(), set()
+  for chunk in util.chunked(package_ids, 1000):
+    known.update(package_id for package_id, in session.query(
+        models.Pakket.id).filter(models.Pakket.id.in_(chunk)))
+    processed.update(package_id for package_id, in session.query(
+        models.PakketStatus.pakket_id).filter(
+            models.PakketStatus.pakket_id.in_(chunk),
+            models.PakketStatus.verwerkt).distinct())
+  for chunk in util.chunked(staff_ids, 1000):
+    staff.update(staff_id for staff_id, in session.query(
+        models.Medewerker.id).filter(
+            models.Medewerker.id.in_(chunk), models.Medewerker.actief))
+  accepted, seen = [], set()
+  for index, values in records:
+    package_id = values['pakket_id']
+    if package_id not in known:
+      error = 'Unknown package.'
+    elif package_id in processed:
+      error = 'Package already processed.'
+    elif package_id in seen:
+      error = 'Package occurs earlier in the same batch.'
+    elif values['medewerker_id'] not in staff:
+      error = 'Unknown or inactive staff member.'
+    else:
+      seen.add(package_id)
+      accepted.append((index, values))
+      continue
+    errors.append({'index': index, 'pakketId': package_id, 'error': error})
+  return accepted
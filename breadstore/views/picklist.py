@@ -0,0 +1,34 @@
+"""breadStore API views - pick list module."""
+
+# Standard modules
+import datetime
+
+# Third-party modules
+from pyramid.view import view_config
+from pyramid.view import view_defaults
+
+# Application modules
+from .. import picklist
+from .. import schemas
+
+
+@view_defaults(context='..resources.PickList')
+class PickListView(object):
+  """Defines the pick list API."""
+  def __init__(self, request):
+    self.request = request
+
+  @view_config(request_method='GET', permission='view')
+  def get(self):
+    """Returns the packages due at the location on the given day.
+
+    The pick list is read from its materialized table, which is kept up to date
+    as subscriptions and packages change.
+    """
+    params = schemas.load_params(schemas.PickList, self.request)
+    date = params['datum'] or datetime.date.today()
+    return {
+        'datum': date.isoformat(),
+        'locatie': params['locatie'],
+        'picklijst': picklist.pick_list(
+            self.request.db, params['locatie'], date)}
@@ -0,0 +1,43 @@
+"""breadStore API views - report module."""
+
+# Standard modules
+import datetime
+
+# Third-party modules
+from pyramid.view import view_config
+from pyramid.view import view_defaults
+
+# Application modules
+from .. import reporting
+from .. import schemas
+
+
+@view_defaults(context='..resources.Reports', permission='view')
+class ReportsView(object):
+  """Defines the management reports API.
+
+  Reports are read from the rollups as last updated by `rollups_breadstore`.
+  """
+  def __init__(self, request):
+    self.request = request
+
+  @view_config(name='klanten', request_method='GET')
+  def customers(self):
+    """Returns customer counts by status, family size and package size."""
+    params = schemas.load_params(schemas.CustomerReport, self.request)
+    return reporting.customer_report(self.request.db, params['status'])
+
+  @view_config(name='pakketten', request_method='GET')
+  def packages(self):
+    """Returns weekly package counts per location, by default for 12 weeks.
+
+    Packages are counted by the date they were processed, for the period from
+    `van` up to and including `tot`, optionally for a single location.
+    """
+    params = schemas.load_params(schemas.PackageReport, self.request)
+    end = params['tot'] or datetime.date.today()
+    start = params['van'] or end - datetime.timedelta(weeks=12)
+    report = reporting.package_report(
+        self.request.db, start, end, location_id=params['locatie'])
+    report.update(van=start.isoformat(), tot=end.isoformat())
+    return report
@@ -23,7 +23,9 @@ class SessionApi(object):
   def get(self):
     """Return an object describing the permissions of the user."""
     get_name = operator.attrgetter('naam')
-    return {'permissies': map(get_name, self.request.user.rol.permissies)}
+    return {
+        'permissies': map(get_name, self.request.user.rol.permissies),
+        'wachtwoordHerzien': self.request.user.wachtwoord_herzien}
 
   @view_config(request_method='POST', permission='login')
   def login(self):
@@ -35,11 +37,27 @@ class SessionApi(object):
     schema = schemas.load(schemas.Login, self.request)
     user = self.request.db.query(models.Medewerker).filter(
         models.Medewerker.login == schema['login']).first()
-    if user and user.verify_password(schema['password']):
+    pool = self.request.registry.password_pool
+    if user and user.verify_password(schema['password'], pool=pool):
       auth_ticket = security.remember(self.request, user.id)
       return exc.HTTPSeeOther('/session', headers=auth_ticket)
     return exc.HTTPUnauthorized(json={'error': 'bad credentials'})
 
+  @view_config(request_method='PUT', permission='change_password')
+  def change_password(self):
+    """Sets a new password for the user, given their current password.
+
+    This also completes a forced rehash of a legacy password hash. Returns 401
+    Unauthorized if the current password is incorrect.
+    """
+    schema = schemas.load(schemas.PasswordChange, self.request)
+    pool = self.request.registry.password_pool
+    user = self.request.user
+    if not user.verify_password(schema['password'], pool=pool):
+      return exc.HTTPUnauthorized(json={'error': 'bad credentials'})
+    user.set_password(schema['new_password'], pool=pool)
+    return exc.HTTPNoContent()
+
   @view_config(request_method='DELETE', permission='logout')
   def logout(self):
     """Logs out the user, has no return."""
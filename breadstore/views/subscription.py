@@ -6,34 +6,57 @@ from pyramid.view import view_config
 from pyramid.view import view_defaults
 
 # Application modules
+from .. import models
 from .. import resources
 from .. import schemas
+from .. import versions
+from . import not_modified
+from . import require_version
 
 @view_defaults(context='..resources.Subscription')
 class SubscriptionView(object):
   """Defines the singular customer API."""
   def __init__(self, context, request):
+    self.context = context
     self.request = request
-    self.sub = context.subscription
+
+  @property
+  def sub(self):
+    """The subscription, loaded from the database when first used."""
+    return self.context.subscription
 
   @view_config(request_method='GET', permission='view')
   def get(self):
-    """Returns the information of a subscription."""
-    return {'subscription': self.sub}
+    """Returns the information of a subscription.
+
+    The response carries the ETag of the subscription's version. Clients that
+    have the current version get a 304 response without any loading.
+    """
+    return not_modified(self.request, self.context) or {
+        'subscription': self.sub}
 
   @view_config(request_method='PUT', permission='update')
   def update(self):
-    """Updates an existing subscription."""
+    """Updates an existing subscription, if it matches a given If-Match."""
+    require_version(self.request, self.context)
     schema = schemas.load(schemas.Subscription, self.request)
-    for key, value in schema:
+    diet_ids = schema.pop('dieten')
+    if schema['datum_start'] is None:
+      del schema['datum_start']
+    for key, value in schema.iteritems():
       setattr(self.sub, key, value)
+    self.sub.dieets = self.request.db.query(models.Dieet).filter(
+        models.Dieet.id.in_(diet_ids)).all() if diet_ids else []
+    self.request.db.flush()
+    self.request.response.etag = versions.etag(
+        models.Abonnement, self.sub.id, self.sub.versie)
     return {'subscription': self.sub}
 
 
   @view_config(request_method='DELETE', permission='delete')
   def delete(self):
     """Deletes the subscription, as long as zero packages were handed out."""
-    if self.sub.packages_provided():
+    if self.sub.provided_count:
       raise resources.ApiError(
           'Cannot delete subscription when packages have been handed out.',
           provided_packages=self.sub.packages_provided())
@@ -45,7 +45,16 @@ setup(
     zip_safe=False,
     install_requires=REQUIREMENTS,
     entry_points={
-        'console_scripts': 'initdb_breadstore = breadstore.scripts.initdb:main',
+        'console_scripts': [
+            'initdb_breadstore = breadstore.scripts.initdb:main',
+            'legacy_passwords_breadstore = '
+            'breadstore.scripts.legacy_passwords:main',
+            'export_breadstore = breadstore.scripts.export:main',
+            'seed_breadstore = breadstore.scripts.seed:main',
+            'benchmark_breadstore = breadstore.scripts.benchmark:main',
+            'serve_breadstore = breadstore.scripts.serve:main',
+            'rollups_breadstore = breadstore.scripts.rollups:main',
+        ],
         'paste.app_factory': 'main = breadstore:main',
     }
 )